@@ -0,0 +1,273 @@
+"""
+重い集計APIの同時実行制御（アドミッション制御）
+
+期間指定の集計（日次稼働率の月表示など）はSQLiteを数秒占有することがある。
+エンドポイントは async def のため、そのまま実行するとイベントループを占有し、
+その間はMQTT受信（DB書き込み）や現在状況APIまで待たされる。
+
+- @heavy_endpoint() を付けたエンドポイントは専用の実行枠（HEAVY_CONCURRENCY 件）でワーカースレッドで実行する
+  イベントループはMQTT受信・軽いAPI専用のレーンとして空けておく
+- 実行枠が空くまで HEAVY_QUEUE_TIMEOUT 秒待ち、待ち行列が HEAVY_MAX_QUEUE 件に達しているか
+  待ち時間を超えた場合は 503（Retry-After 付き）を返す
+- WALモードのため、ワーカースレッドの読み取りは受信データの書き込みをブロックしない
+  （HEAVY_CONCURRENCY はコネクションプール（5）より小さくし、受信用の接続を残すこと）
+- 実行時間の上限（HEAVY_TIME_BUDGET 秒、エンドポイントごとに指定可）を超えたらSQLを打ち切って 504
+- 実行中にクライアントが切断した場合（タブを閉じた・画面遷移した）もSQLを打ち切る
+- ?profile=1（query_accounting.py）の計測はワーカースレッドにも引き継ぐ
+- ストリーミングで返す重いAPIは HeavyStreamingResponse で、本文の送信が終わるまで実行枠を使い続ける
+"""
+import asyncio
+import functools
+import inspect
+import logging
+import math
+import os
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+import anyio
+from fastapi import HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from .database import QueryDeadline, set_query_deadline, reset_query_deadline
+from .query_accounting import profile_worker
+
+logger = logging.getLogger(__name__)
+
+# 同時実行設定（環境変数から取得）
+HEAVY_CONCURRENCY = int(os.getenv("HEAVY_CONCURRENCY", "2"))
+HEAVY_MAX_QUEUE = int(os.getenv("HEAVY_MAX_QUEUE", "8"))
+HEAVY_QUEUE_TIMEOUT = float(os.getenv("HEAVY_QUEUE_TIMEOUT", "10"))
+HEAVY_TIME_BUDGET = float(os.getenv("HEAVY_TIME_BUDGET", "30"))
+DISCONNECT_POLL_SECONDS = 0.5    # 実行中にクライアントの切断を確認する間隔
+
+RETRY_AFTER_MAX_SECONDS = 60
+
+
+class ClientDisconnected(Exception):
+    """実行中にクライアントが切断した（応答は不要）"""
+
+
+def _run_coroutine(endpoint, args, kwargs):
+    """ワーカースレッドでエンドポイント（中で await しない async def）を実行（?profile=1 ならこのスレッドも計測）"""
+    with profile_worker():
+        return asyncio.run(endpoint(*args, **kwargs))
+
+
+class AdmissionLane:
+    """同時実行数と待ち行列の長さを制限する実行枠"""
+
+    def __init__(self, name: str, concurrency: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self._avg_seconds = 1.0
+        self._loop = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._limiter: Optional[anyio.CapacityLimiter] = None
+
+    def retry_after(self) -> int:
+        """待ち行列がはけるまでの目安（秒）"""
+        seconds = self._avg_seconds * (self.waiting + self.running) / self.concurrency
+        return max(1, min(RETRY_AFTER_MAX_SECONDS, math.ceil(seconds)))
+
+    def _reject(self, reason: str) -> HTTPException:
+        self.rejected += 1
+        logger.warning(f"{self.name}: {reason}（実行中 {self.running}件 / 待ち {self.waiting}件）")
+        return HTTPException(
+            status_code=503,
+            detail=f"集計処理が混み合っています。しばらくしてから再度お試しください（{reason}）",
+            headers={"Retry-After": str(self.retry_after())}
+        )
+
+    async def run(self, endpoint, args, kwargs, request: Optional[Request] = None,
+                  time_budget: float = HEAVY_TIME_BUDGET):
+        """実行枠を確保してワーカースレッドで実行
+
+        枠を確保できなければ503、time_budget 秒を超えたら504、
+        request のクライアントが切断したら ClientDisconnected。
+        """
+        started = await self._acquire()
+        # 期限はワーカースレッドにコンテキストごと引き継がれる
+        deadline = QueryDeadline(time_budget)
+        token = set_query_deadline(deadline)
+        try:
+            worker = asyncio.ensure_future(
+                anyio.to_thread.run_sync(_run_coroutine, endpoint, args, kwargs, limiter=self._limiter)
+            )
+        finally:
+            reset_query_deadline(token)
+        try:
+            await self._wait(worker, deadline, request)
+            if deadline.cancelled:
+                worker.exception()  # 打ち切りによる例外は不要
+                self.cancelled += 1
+                logger.info(f"{self.name}: クライアント切断のため中断しました")
+                raise ClientDisconnected()
+            try:
+                return worker.result()
+            except Exception:
+                if deadline.expired:
+                    self.timed_out += 1
+                    logger.warning(f"{self.name}: 実行時間の上限（{time_budget:g}秒）を超えたため中断しました")
+                    raise HTTPException(
+                        status_code=504,
+                        detail=f"集計が{time_budget:g}秒以内に終わらなかったため中断しました。期間を短くして再度お試しください"
+                    )
+                raise
+        finally:
+            self._release(started)
+
+    async def _acquire(self) -> float:
+        """実行枠を確保（確保できなければ503）、確保した時刻を返す"""
+        # セマフォはイベントループに紐づくため、ループが変わったら作り直す（テスト実行時など）
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+            self._limiter = anyio.CapacityLimiter(self.concurrency)
+
+        if self.waiting >= self.max_queue:
+            raise self._reject("待ち行列が上限に達しました")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise self._reject(f"{self.queue_timeout:g}秒以内に実行枠が空きませんでした")
+        finally:
+            self.waiting -= 1
+
+        self.running += 1
+        self.admitted += 1
+        return loop.time()
+
+    def _release(self, started: float):
+        self._avg_seconds = self._avg_seconds * 0.8 + (self._loop.time() - started) * 0.2
+        self.running -= 1
+        self._semaphore.release()
+
+    async def in_worker(self, deadline: QueryDeadline, func, *args):
+        """期限を設定してワーカースレッドで実行（実行枠を確保済みの処理用）"""
+        token = set_query_deadline(deadline)
+        try:
+            return await anyio.to_thread.run_sync(func, *args, limiter=self._limiter)
+        finally:
+            reset_query_deadline(token)
+
+    @staticmethod
+    async def _wait(worker: asyncio.Future, deadline: QueryDeadline, request: Optional[Request]):
+        """ワーカーの終了を待つ（途中でクライアントが切断したらSQLを打ち切らせる）"""
+        try:
+            while not worker.done():
+                await asyncio.wait({worker}, timeout=DISCONNECT_POLL_SECONDS)
+                if not worker.done() and request is not None and await request.is_disconnected():
+                    # SQLが打ち切られてスレッドが終わるまで待つ（実行枠を返すのはその後）
+                    deadline.cancel()
+                    await asyncio.wait({worker})
+        except asyncio.CancelledError:
+            deadline.cancel()
+            raise
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "running": self.running,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "cancelled": self.cancelled,
+            "avg_seconds": round(self._avg_seconds, 2),
+        }
+
+
+# 期間集計などの重いAPI用の実行枠
+heavy_lane = AdmissionLane("重い集計API", HEAVY_CONCURRENCY, HEAVY_MAX_QUEUE, HEAVY_QUEUE_TIMEOUT)
+
+
+def heavy_endpoint(lane: AdmissionLane = heavy_lane, time_budget: float = HEAVY_TIME_BUDGET):
+    """重い集計エンドポイントを実行枠つきでワーカースレッドで実行するデコレーター
+
+    キャッシュ系デコレーター（live_cached / past_day_cached）より内側に付けること
+    （キャッシュヒット時は実行枠を使わない）。
+    切断を検知するため、エンドポイントに request がなければ引数に追加する。
+    """
+    def decorator(endpoint):
+        signature = inspect.signature(endpoint)
+        takes_request = "request" in signature.parameters
+
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            request = kwargs["request"] if takes_request else kwargs.pop("request")
+            return await lane.run(endpoint, args, kwargs, request=request, time_budget=time_budget)
+
+        if not takes_request:
+            wrapper.__signature__ = signature.replace(parameters=[
+                *signature.parameters.values(),
+                inspect.Parameter("request", inspect.Parameter.KEYWORD_ONLY, annotation=Request),
+            ])
+        return wrapper
+    return decorator
+
+
+class HeavyStreamingResponse(StreamingResponse):
+    """重い集計のストリーミングレスポンス
+
+    送信を始める前に実行枠を確保し（確保できなければ503）、本文の送信が終わる・失敗する・
+    クライアントが切断するまで使い続ける。generate は本文を少しずつ返す同期ジェネレーター関数で、
+    1件ずつ期限つきでワーカースレッドで取り出す。time_budget 秒を超えたらSQLを打ち切る
+    （ステータスは送信済みのため、応答は不完全なまま終わる）。
+    """
+
+    def __init__(self, generate: Callable[[], Iterator[bytes]], lane: AdmissionLane = heavy_lane,
+                 time_budget: float = HEAVY_TIME_BUDGET, **kwargs):
+        self.lane = lane
+        self.time_budget = time_budget
+        self.deadline: Optional[QueryDeadline] = None
+        super().__init__(self._chunks(generate), **kwargs)
+
+    async def __call__(self, scope, receive, send):
+        try:
+            started = await self.lane._acquire()
+        except HTTPException as e:
+            await JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)(scope, receive, send)
+            return
+
+        self.deadline = QueryDeadline(self.time_budget)
+        try:
+            await super().__call__(scope, receive, send)
+        except BaseException:
+            if self.deadline.expired:
+                self.lane.timed_out += 1
+                logger.warning(f"{self.lane.name}: 実行時間の上限（{self.time_budget:g}秒）を超えたため送信を中断しました")
+            else:
+                # 送信の失敗・キャンセル（クライアント切断）
+                self.deadline.cancel()
+                self.lane.cancelled += 1
+                logger.info(f"{self.lane.name}: クライアント切断のため送信を中断しました")
+            raise
+        finally:
+            # 途中で終わった場合もジェネレーターを閉じてから実行枠を返す（キャンセル中でも実行する）
+            with anyio.CancelScope(shield=True):
+                await self.body_iterator.aclose()
+            self.lane._release(started)
+
+    async def _chunks(self, generate) -> AsyncIterator[bytes]:
+        iterator = None
+        try:
+            iterator = await self.lane.in_worker(self.deadline, generate)
+            while True:
+                chunk = await self.lane.in_worker(self.deadline, next, iterator, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            if iterator is not None:
+                # セッションを閉じる（ジェネレーターの finally）もワーカースレッドで
+                await self.lane.in_worker(self.deadline, iterator.close)
@@ -0,0 +1,214 @@
+"""
+日次集計パイプライン
+
+1段目: デバイスごとに営業日分の履歴を1回だけ読み込み、1時間ごとの状態別分数を計算
+2段目: 1段目の結果をメモリ上で任意のグループ（全体・設置場所別・任意のグループ）に畳み込む
+
+集計の実行時間はデバイス数に比例し、グループ数には依存しない。
+"""
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func, and_
+
+from .models import DeviceHistory
+from .utils import get_status_from_lights
+
+# 集計で扱う状態キー（get_status_from_lights の "none" は "idle" として扱う）
+STATE_KEYS = ("running", "stop_yellow", "stop_red", "idle")
+
+
+def state_key(red: bool, yellow: bool, green: bool) -> str:
+    """ライト状態から集計用の状態キーを取得"""
+    status, _ = get_status_from_lights(red, yellow, green)
+    return "idle" if status == "none" else status
+
+
+@dataclass
+class DeviceTrace:
+    """1デバイス・1期間分の状態遷移（naive UTC）"""
+    device_addr: str
+    prev_state: Optional[str] = None                                  # 期間開始前の最後の状態
+    records: List[Tuple[datetime, str]] = field(default_factory=list)  # 期間内の (時刻, 状態)
+    timestamps: List[datetime] = field(default_factory=list)          # bisect用
+
+    def add(self, timestamp: datetime, state: str):
+        self.records.append((timestamp, state))
+        self.timestamps.append(timestamp)
+
+    def state_before(self, index: int) -> Optional[str]:
+        """records[index] より前の最後の状態（期間開始前を含む）"""
+        return self.records[index - 1][1] if index > 0 else self.prev_state
+
+
+def load_traces(db, device_addrs: list, start_utc: datetime, end_utc: datetime,
+                with_prev_state: bool = True) -> Dict[str, DeviceTrace]:
+    """指定期間の状態遷移を全デバイス分まとめて読み込む（クエリ2本、直前状態が不要なら1本）"""
+    traces = {addr: DeviceTrace(addr) for addr in device_addrs}
+    if not device_addrs:
+        return traces
+    if with_prev_state:
+        _load_prev_states(db, traces, start_utc)
+
+    # 期間内の状態遷移
+    rows = db.query(
+        DeviceHistory.device_addr, DeviceHistory.timestamp,
+        DeviceHistory.red, DeviceHistory.yellow, DeviceHistory.green
+    ).filter(
+        DeviceHistory.device_addr.in_(device_addrs),
+        DeviceHistory.timestamp >= start_utc,
+        DeviceHistory.timestamp < end_utc
+    ).order_by(DeviceHistory.device_addr, DeviceHistory.timestamp, DeviceHistory.id).all()
+
+    for addr, timestamp, red, yellow, green in rows:
+        traces[addr].add(timestamp, state_key(red, yellow, green))
+
+    return traces
+
+
+def _load_prev_states(db, traces: Dict[str, DeviceTrace], start_utc: datetime):
+    """期間開始前の最後の状態をトレースに設定"""
+    device_addrs = list(traces)
+
+    # 期間開始前の最後の状態（デバイスごと）
+    last_before = db.query(
+        DeviceHistory.device_addr,
+        func.max(DeviceHistory.timestamp).label("timestamp")
+    ).filter(
+        DeviceHistory.device_addr.in_(device_addrs),
+        DeviceHistory.timestamp < start_utc
+    ).group_by(DeviceHistory.device_addr).subquery()
+
+    prev_rows = db.query(
+        DeviceHistory.device_addr, DeviceHistory.red, DeviceHistory.yellow, DeviceHistory.green
+    ).join(
+        last_before,
+        and_(
+            DeviceHistory.device_addr == last_before.c.device_addr,
+            DeviceHistory.timestamp == last_before.c.timestamp
+        )
+    ).order_by(DeviceHistory.id).all()
+
+    for addr, red, yellow, green in prev_rows:
+        traces[addr].prev_state = state_key(red, yellow, green)
+
+
+def load_day_traces(db, device_addrs: list, bday) -> Dict[str, DeviceTrace]:
+    """営業日（6:00-翌6:00）分の状態遷移を読み込む"""
+    return load_traces(db, device_addrs, bday.span.start_utc, bday.span.end_utc)
+
+
+def _empty_minutes() -> Dict[str, float]:
+    return dict.fromkeys(STATE_KEYS, 0.0)
+
+
+def window_state_minutes(trace: DeviceTrace, start_utc: datetime, end_utc: datetime, period_end: datetime) -> Dict[str, float]:
+    """時間ウィンドウ内の状態別分数（period_end は現在時刻で打ち切った終了時刻）
+
+    開始時点の状態は直前の状態、なければウィンドウ内の最初の状態とする。
+    どちらもなければ休止中とする。
+    """
+    minutes = _empty_minutes()
+    lo = bisect_left(trace.timestamps, start_utc)
+    hi = bisect_left(trace.timestamps, end_utc)
+    in_window = trace.records[lo:hi]
+    prev_state = trace.state_before(lo)
+
+    if not in_window and prev_state is None:
+        # データがない場合は休止中とする
+        minutes["idle"] += (period_end - start_utc).total_seconds() / 60
+        return minutes
+
+    start_state = prev_state if prev_state is not None else in_window[0][1]
+    points = [(start_utc, start_state)] + in_window
+    for i, (timestamp, state) in enumerate(points):
+        next_ts = points[i + 1][0] if i < len(points) - 1 else period_end
+        minutes[state] += max(0, (next_ts - timestamp).total_seconds() / 60)
+    return minutes
+
+
+def hourly_state_minutes(trace: DeviceTrace, bday, now_utc: datetime) -> List[Dict[str, float]]:
+    """1段目: 1デバイスの1時間ごとの状態別分数（現在時刻以降の時間帯は含まない）"""
+    result = []
+    for hour in bday.hours:
+        if hour.start_utc > now_utc:
+            break
+        result.append(window_state_minutes(trace, hour.start_utc, hour.end_utc, hour.clipped_end_utc(now_utc)))
+    return result
+
+
+def recorded_state_minutes(trace: DeviceTrace, end_utc: datetime) -> Dict[str, float]:
+    """期間内の記録だけから end_utc までの状態別分数を計算（最初の記録より前の時間は数えない、現在稼働率用）"""
+    minutes = _empty_minutes()
+    records = trace.records[:bisect_left(trace.timestamps, end_utc)]
+    for i, (timestamp, state) in enumerate(records):
+        next_ts = records[i + 1][0] if i < len(records) - 1 else end_utc
+        minutes[state] += max(0, (next_ts - timestamp).total_seconds() / 60)
+    return minutes
+
+
+def window_green_minutes(trace: DeviceTrace, window_start_utc: datetime, window_end_utc: datetime) -> float:
+    """時間ウィンドウ内の稼働（緑）分数（ウィンドウはトレースの期間内であること）"""
+    lo = bisect_left(trace.timestamps, window_start_utc)
+    hi = bisect_left(trace.timestamps, window_end_utc)
+    in_window = trace.records[lo:hi]
+    prev_state = trace.state_before(lo)
+
+    points = []
+    if prev_state is not None:
+        points.append((window_start_utc, prev_state))
+    elif in_window:
+        points.append((window_start_utc, "idle"))
+    points.extend(in_window)
+
+    green_minutes = 0.0
+    for i, (timestamp, state) in enumerate(points):
+        next_ts = points[i + 1][0] if i < len(points) - 1 else window_end_utc
+        if state == "running":
+            green_minutes += max(0, (next_ts - timestamp).total_seconds() / 60)
+    return green_minutes
+
+
+def fold_hourly_minutes(per_device: Dict[str, List[Dict[str, float]]], device_addrs: list) -> List[Dict[str, float]]:
+    """2段目: 指定デバイス群の時間帯別分数を合算"""
+    totals: List[Dict[str, float]] = []
+    for addr in device_addrs:
+        for i, minutes in enumerate(per_device.get(addr, [])):
+            if i >= len(totals):
+                totals.append(_empty_minutes())
+            for key in STATE_KEYS:
+                totals[i][key] += minutes[key]
+    return totals
+
+
+def fold_groups(per_device: Dict[str, List[Dict[str, float]]], groups: Dict[str, list]) -> Dict[str, List[Dict[str, float]]]:
+    """2段目: 任意のグループ（グループ名→デバイス一覧）ごとに時間帯別分数を合算"""
+    return {name: fold_hourly_minutes(per_device, addrs) for name, addrs in groups.items()}
+
+
+def running_percent(minutes: Dict[str, float]) -> float:
+    """状態別分数から稼働率（%）を計算"""
+    total_minutes = sum(minutes[key] for key in STATE_KEYS)
+    if total_minutes > 0:
+        return round(minutes["running"] / total_minutes * 100, 1)
+    return 0
+
+
+def green_apples_for_percent(percent: float) -> int:
+    """1時間の稼働率からGreenApple獲得数を計算"""
+    if percent >= 50:
+        return 5
+    elif percent >= 40:
+        return 3
+    elif percent >= 35:
+        return 2
+    elif percent > 30:
+        return 1
+    return 0
+
+
+def count_daily_apples(hourly_totals: List[Dict[str, float]]) -> int:
+    """時間帯別の合算分数から1日分のGREEN APPLE収穫量を計算"""
+    return sum(green_apples_for_percent(running_percent(minutes)) for minutes in hourly_totals)
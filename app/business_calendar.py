@@ -0,0 +1,192 @@
+"""
+営業日カレンダー - 営業日・シフト・定時/残業ウィンドウのUTC境界を事前計算してキャッシュ
+
+営業日は BUSINESS_DAY_START（既定6:00）から翌日の同時刻まで。
+DBのタイムスタンプは naive UTC なので、各境界は naive UTC でも保持する。
+"""
+import os
+import re
+from dataclasses import dataclass
+from datetime import datetime, timedelta, time as dtime, date as ddate
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+import pytz
+from dotenv import load_dotenv
+
+# 環境変数を読み込み
+load_dotenv()
+
+
+_TIME_PATTERN = re.compile(r"^\s*(\d{1,2}):(\d{2})\s*$")
+
+
+def _parse_time(value: str, name: str = "時刻") -> dtime:
+    """'HH:MM' 形式の文字列を time に変換（形式が不正なら ValueError）"""
+    match = _TIME_PATTERN.match(value)
+    if not match or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+        raise ValueError(f"{name} は 'HH:MM' 形式（00:00〜23:59）で指定してください: {value!r}")
+    return dtime(int(match.group(1)), int(match.group(2)))
+
+
+def _parse_window(value: str, name: str = "時間ウィンドウ") -> Tuple[dtime, dtime]:
+    """'HH:MM-HH:MM' 形式の文字列を (開始, 終了) に変換（終了が開始以前なら翌日扱い、形式が不正なら ValueError）"""
+    parts = value.split("-")
+    if len(parts) != 2:
+        raise ValueError(f"{name} は 'HH:MM-HH:MM' 形式で指定してください: {value!r}")
+    return _parse_time(parts[0], name), _parse_time(parts[1], name)
+
+
+# カレンダー設定（環境変数から取得、デフォルトは現行の運用ルール）
+BUSINESS_TIMEZONE = os.getenv("BUSINESS_TIMEZONE", "Asia/Tokyo")
+BUSINESS_DAY_START = _parse_time(os.getenv("BUSINESS_DAY_START", "06:00"), "BUSINESS_DAY_START")     # 営業日の区切り
+NIGHT_SHIFT_START = _parse_time(os.getenv("NIGHT_SHIFT_START", "18:00"), "NIGHT_SHIFT_START")        # 日勤→夜勤の切替
+REGULAR_WINDOW = _parse_window(os.getenv("REGULAR_WINDOW", "08:00-02:00"), "REGULAR_WINDOW")         # 定時内
+OVERTIME_WINDOW = _parse_window(os.getenv("OVERTIME_WINDOW", "08:00-05:00"), "OVERTIME_WINDOW")      # 含残業
+
+utc = pytz.UTC
+
+
+@dataclass(frozen=True)
+class Window:
+    """時間ウィンドウ（JST aware と naive UTC の両方を保持）"""
+    start_jst: datetime
+    end_jst: datetime
+    start_utc: datetime
+    end_utc: datetime
+
+    @property
+    def minutes(self) -> float:
+        """ウィンドウ長（分）"""
+        return (self.end_utc - self.start_utc).total_seconds() / 60
+
+    def clipped_end_utc(self, now_utc: datetime) -> datetime:
+        """現在時刻を超えないウィンドウ終了時刻（naive UTC）"""
+        return min(self.end_utc, now_utc)
+
+
+@dataclass(frozen=True)
+class BusinessDay:
+    """1営業日分の事前計算済み境界"""
+    date: ddate
+    span: Window                # 営業日全体（6:00-翌6:00）
+    day_shift: Window           # 日勤（6:00-18:00）
+    night_shift: Window         # 夜勤（18:00-翌6:00）
+    regular: Window             # 定時内（8:00-翌2:00）
+    overtime: Window            # 含残業（8:00-翌5:00）
+    hours: Tuple[Window, ...]   # 1時間ごとのウィンドウ（24本）
+
+    @property
+    def shifts(self) -> Tuple[Tuple[str, Window], ...]:
+        """(シフト名, ウィンドウ) の組"""
+        return (("day", self.day_shift), ("night", self.night_shift))
+
+
+class BusinessCalendar:
+    """営業日カレンダー（境界計算をキャッシュ）"""
+
+    def __init__(
+        self,
+        timezone: str = BUSINESS_TIMEZONE,
+        day_start: dtime = BUSINESS_DAY_START,
+        night_shift_start: dtime = NIGHT_SHIFT_START,
+        regular_window: Tuple[dtime, dtime] = REGULAR_WINDOW,
+        overtime_window: Tuple[dtime, dtime] = OVERTIME_WINDOW,
+    ):
+        self.tz = pytz.timezone(timezone)
+        self.day_start = day_start
+        self.night_shift_start = night_shift_start
+        self.regular_window = regular_window
+        self.overtime_window = overtime_window
+
+    # ---------- 変換 ----------
+
+    def _localize(self, target_date: ddate, t: dtime) -> datetime:
+        """営業日内の壁時計時刻をaware datetimeに変換（営業日開始より前の時刻は翌日扱い）"""
+        d = target_date if t >= self.day_start else target_date + timedelta(days=1)
+        return self.tz.localize(datetime.combine(d, t))
+
+    def _window(self, start_jst: datetime, end_jst: datetime) -> Window:
+        return Window(start_jst, end_jst, self.to_utc(start_jst), self.to_utc(end_jst))
+
+    def _configured_window(self, target_date: ddate, window: Tuple[dtime, dtime]) -> Window:
+        """設定された 'HH:MM-HH:MM' のウィンドウ（終了が開始以前なら開始の翌日）"""
+        start_jst = self._localize(target_date, window[0])
+        end_jst = self.tz.localize(datetime.combine(start_jst.date(), window[1]))
+        if end_jst <= start_jst:
+            end_jst = self.tz.localize(datetime.combine(start_jst.date() + timedelta(days=1), window[1]))
+        return self._window(start_jst, end_jst)
+
+    @staticmethod
+    def to_utc(dt: datetime) -> datetime:
+        """aware datetime を naive UTC に変換（DB比較用）"""
+        return dt.astimezone(utc).replace(tzinfo=None)
+
+    def to_local(self, ts_utc: datetime) -> datetime:
+        """naive UTC を naive JST に変換（オフセットは1時間単位でキャッシュ）"""
+        return ts_utc + self._offset_for_hour(ts_utc.replace(minute=0, second=0, microsecond=0))
+
+    @lru_cache(maxsize=4096)
+    def _offset_for_hour(self, hour_utc: datetime) -> timedelta:
+        return utc.localize(hour_utc).astimezone(self.tz).utcoffset()
+
+    # ---------- 営業日 ----------
+
+    def now(self) -> datetime:
+        """現在時刻（JST aware）"""
+        return datetime.now(self.tz)
+
+    def business_date(self, at: Optional[datetime] = None) -> ddate:
+        """指定時刻（省略時は現在）が属する営業日（6:00より前なら前日）"""
+        at = (at or self.now()).astimezone(self.tz)
+        if at.time() < self.day_start:
+            return at.date() - timedelta(days=1)
+        return at.date()
+
+    def business_date_of_utc(self, ts_utc: datetime) -> ddate:
+        """naive UTC のタイムスタンプが属する営業日"""
+        local = self.to_local(ts_utc)
+        if local.time() < self.day_start:
+            return local.date() - timedelta(days=1)
+        return local.date()
+
+    @lru_cache(maxsize=1024)
+    def day(self, target_date: ddate) -> BusinessDay:
+        """営業日の境界を計算（キャッシュ済み）"""
+        start = self._localize(target_date, self.day_start)
+        end = self.tz.localize(datetime.combine(target_date + timedelta(days=1), self.day_start))
+        night = self._localize(target_date, self.night_shift_start)
+
+        hours = []
+        current = start
+        while current < end:
+            next_hour = self.tz.normalize(current + timedelta(hours=1))
+            hours.append(self._window(current, min(next_hour, end)))
+            current = next_hour
+
+        return BusinessDay(
+            date=target_date,
+            span=self._window(start, end),
+            day_shift=self._window(start, night),
+            night_shift=self._window(night, end),
+            regular=self._configured_window(target_date, self.regular_window),
+            overtime=self._configured_window(target_date, self.overtime_window),
+            hours=tuple(hours),
+        )
+
+    def days(self, start_date: ddate, end_date: ddate) -> List[BusinessDay]:
+        """期間内（両端含む）の営業日一覧"""
+        result = []
+        d = start_date
+        while d <= end_date:
+            result.append(self.day(d))
+            d += timedelta(days=1)
+        return result
+
+    def today(self) -> BusinessDay:
+        """現在の営業日"""
+        return self.day(self.business_date())
+
+
+# アプリ全体で共有するカレンダー
+business_calendar = BusinessCalendar()
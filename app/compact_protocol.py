@@ -0,0 +1,118 @@
+"""
+WebSocketの省データ形式（サイネージPCなど回線の細い端末向け、接続時に選択）
+
+JSON の devices_update / devices_heartbeat は、デバイスの表示名・設置場所やISO形式の時刻を毎回含む。
+接続時にサブプロトコル COMPACT_SUBPROTOCOL を指定したクライアントには、これらを固定長のバイナリで送る。
+
+- デバイスは小さい整数のハンドルで表す。ハンドルと device_addr・表示名・設置場所の対応は
+  devices_dictionary（JSON）で接続時に全件、新しいデバイス・表示名や設置場所の変更時にその分だけ送る
+- バイナリフレーム（リトルエンディアン）: ヘッダー <BIH>（種別・seq・件数）+ 1件7バイトの <HBI>
+    種別1 devices_update:    ハンドル, 状態（下位2ビット: ステータスコード 00〜03、ビット2: is_active）, 時刻（UNIX秒）
+    種別2 devices_heartbeat: ハンドル, バッテリー残量（0〜100、不明は255）, 時刻（UNIX秒）
+- 表せない内容（未知のステータスコード・表示文字列など）を含むメッセージは、そのまま JSON で送る
+- devices_update は変わった項目だけを含むため、デバイスごとの最新の状態を合成してから符号化する
+"""
+import struct
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+COMPACT_SUBPROTOCOL = "lighttower.compact.v1"
+
+FRAME_TYPES = {"devices_update": 1, "devices_heartbeat": 2}
+
+HEADER = struct.Struct("<BIH")
+ENTRY = struct.Struct("<HBI")
+
+# ステータスコードと表示文字列（mqtt_client で統一済みの値）
+STATUS_TEXTS = {"00": "Not Working", "01": "Running", "02": "Stop", "03": "Stop"}
+STATUS_CODES = {code: i for i, code in enumerate(sorted(STATUS_TEXTS))}
+STATE_ACTIVE = 0x04
+BATTERY_UNKNOWN = 255
+
+
+def _unix_seconds(timestamp: Optional[str]) -> Optional[int]:
+    """配信メッセージの時刻（UTC、ISO形式）をUNIX秒に"""
+    if not timestamp:
+        return None
+    try:
+        return int(datetime.fromisoformat(timestamp).replace(tzinfo=timezone.utc).timestamp())
+    except ValueError:
+        return None
+
+
+class CompactEncoder:
+    """ハンドルの割り当てと devices_update / devices_heartbeat の符号化"""
+
+    def __init__(self):
+        self.handles: Dict[str, int] = {}
+        self._labels: Dict[str, tuple] = {}     # device_addr → (表示名, 設置場所)
+        self._states: Dict[str, dict] = {}      # device_addr → 最新の状態（devices_update を合成）
+
+    def dictionary(self) -> dict:
+        """全デバイスのハンドル（接続時に送る）"""
+        return self._dictionary_message(list(self.handles))
+
+    def announce(self, entries: List[dict]) -> Optional[dict]:
+        """新しいデバイスと表示名・設置場所が変わったデバイスのハンドル（なければ None）"""
+        changed = []
+        for entry in entries:
+            device_addr = entry["device_addr"]
+            labels = self._labels.get(device_addr) or (device_addr, None)
+            new_labels = (entry.get("device_name", labels[0]), entry.get("location", labels[1]))
+            if device_addr in self.handles and new_labels == labels:
+                continue
+            self.handles.setdefault(device_addr, len(self.handles) + 1)
+            self._labels[device_addr] = new_labels
+            changed.append(device_addr)
+        return self._dictionary_message(changed) if changed else None
+
+    def _dictionary_message(self, device_addrs: List[str]) -> dict:
+        return {
+            "type": "devices_dictionary",
+            "devices": [[self.handles[addr], addr, *self._labels[addr]] for addr in device_addrs],
+        }
+
+    def encode_entries(self, message: dict) -> Optional[List[bytes]]:
+        """1件ずつ符号化（対象外のメッセージ・表せない内容を含む場合は None）"""
+        message_type = message["type"]
+        if message_type == "devices_update":
+            # 表せない内容があっても、以降の差分のために状態は合成しておく
+            for entry in message["devices"]:
+                self._states.setdefault(entry["device_addr"], {}).update(entry)
+            encode = self._update_entry
+        elif message_type == "devices_heartbeat":
+            encode = self._heartbeat_entry
+        else:
+            return None
+
+        encoded = []
+        for entry in message["devices"]:
+            data = encode(entry)
+            if data is None:
+                return None
+            encoded.append(data)
+        return encoded
+
+    def _update_entry(self, entry: dict) -> Optional[bytes]:
+        device_addr = entry["device_addr"]
+        state = self._states[device_addr]
+        code = STATUS_CODES.get(state.get("status_code"))
+        timestamp = _unix_seconds(entry.get("timestamp"))
+        if code is None or timestamp is None or STATUS_TEXTS[state["status_code"]] != state.get("status_text"):
+            return None
+        flags = code | (STATE_ACTIVE if state.get("is_active") else 0)
+        return ENTRY.pack(self.handles[device_addr], flags, timestamp)
+
+    def _heartbeat_entry(self, entry: dict) -> Optional[bytes]:
+        handle = self.handles.get(entry["device_addr"])
+        timestamp = _unix_seconds(entry.get("timestamp"))
+        if handle is None or timestamp is None:
+            return None
+        battery = entry.get("battery")
+        battery = round(battery) if isinstance(battery, (int, float)) and 0 <= battery <= 100 else BATTERY_UNKNOWN
+        return ENTRY.pack(handle, battery, timestamp)
+
+
+def compact_frame(message_type: str, seq: int, entries: List[bytes]) -> bytes:
+    """バイナリフレーム（ヘッダー + 符号化済みの各件）"""
+    return HEADER.pack(FRAME_TYPES[message_type], seq, len(entries)) + b"".join(entries)
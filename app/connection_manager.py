@@ -0,0 +1,448 @@
+"""
+WebSocketクライアントへの配信（クライアントごとの送信キュー）
+
+これまでは broadcast() が全クライアントに順番に send_json() を await していたため、
+通信の遅い（無線が不安定な）ブラウザが1台あると、その送信が終わるまで他のクライアントへの配信も
+MQTT受信の処理（broadcast() を await している）も待たされていた。
+
+- クライアントごとに上限付きの送信キュー（WS_SEND_QUEUE_SIZE 件）と送信タスクを持つ
+  broadcast() はキューに積むだけで、送信を待たない
+- メッセージの直列化は配信1回につき1回（全クライアントで同じ文字列を送る）
+- キューが溢れたクライアント、1回の送信が WS_SEND_TIMEOUT 秒を超えたクライアントは切断する
+  （取りこぼしたまま表示を続けさせない。ブラウザは再接続時にデバイス一覧を取り直す）
+- 送信に失敗したソケットは一覧から外す
+- クライアントごとの送信待ち件数・遅れ（秒）は stats() で確認できる
+
+購読（クライアントから {"type": "subscribe", "locations": [...], "devices": [...], "types": [...]} を送る）:
+- 各項目は省略・null ですべて。購読を送っていないクライアントには従来どおり全て配信する
+- デバイスごとのメッセージ（devices_update など）は、購読している設置場所・デバイスの分だけに絞って送る
+- 設置場所ごとの集計（overall_status など）は、購読している設置場所の分だけ送る
+  （locations を指定しない場合は全体（location=None）の分のみ）
+- 設置場所・デバイスから購読者への索引を持ち、配信1回の処理は関係するクライアント数に比例する
+  （同じ購読条件のクライアントには同じ文字列を送るため、直列化は購読条件の種類ごとに1回）
+
+再接続（/ws?stream=...&seq=...）:
+- 配信するメッセージには通し番号（seq）を付け、直近 WS_REPLAY_BUFFER 件をメモリに残す
+  集計のように最新の1通で足りるメッセージ（latest_only）は種類・設置場所ごとに最新の1通だけ残す
+- 接続直後に {"type": "hello", "stream": ..., "seq": ..., "resumed": ...} を送る
+  stream はサーバーの起動ごとに変わる（再起動後は送り直せない）
+- 再接続したクライアントが最後に受け取った seq を送ると、その後の配信だけを送り直す
+  送り直せない場合（サーバー再起動・バッファから外れた）は全デバイスの状態などのスナップショットを先に送る
+- 送り直し・スナップショットは購読条件で絞り込まない（購読はこの後に送られてくるため）
+
+接続時にサブプロトコル COMPACT_SUBPROTOCOL を指定したクライアントには、devices_update / devices_heartbeat を
+バイナリで送る（compact_protocol.py）。
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, FrozenSet, Iterable, List, Optional, Sequence, Set, Tuple, Union
+
+from fastapi import WebSocket
+
+from .compact_protocol import COMPACT_SUBPROTOCOL, CompactEncoder, compact_frame
+from .responses import json_bytes
+
+logger = logging.getLogger(__name__)
+
+# 送信設定（環境変数から取得）
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))    # クライアントごとの送信待ちの上限
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))         # 1回の送信の上限（秒）
+WS_REPLAY_BUFFER = int(os.getenv("WS_REPLAY_BUFFER", "2000"))       # 再接続時に送り直せる配信の件数
+
+# 送信が追いつかないクライアントを切断する時のクローズコード（Try Again Later）
+CLOSE_TOO_SLOW = 1013
+
+# 1回の購読で指定できる件数（設置場所・デバイス・メッセージ種別それぞれ）
+MAX_SUBSCRIPTION_ITEMS = 1000
+
+# broadcast() の location 省略時（設置場所によらず全員に配信）
+ANY_LOCATION = object()
+
+
+def encode_message(message: dict) -> str:
+    """配信メッセージを1回だけ直列化（全クライアントで共有）"""
+    return json_bytes(message).decode("utf-8")
+
+
+@dataclass(frozen=True)
+class Subscription:
+    """購読条件（None はすべて）"""
+    types: Optional[FrozenSet[str]] = None
+    locations: Optional[FrozenSet[str]] = None
+    devices: Optional[FrozenSet[str]] = None
+
+    @classmethod
+    def from_message(cls, message: dict) -> "Subscription":
+        """subscribe メッセージから作成（形式が不正なら ValueError）"""
+        def items(key) -> Optional[FrozenSet[str]]:
+            value = message.get(key)
+            if value is None:
+                return None
+            if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+                raise ValueError(f"{key} は文字列のリストで指定してください")
+            if len(value) > MAX_SUBSCRIPTION_ITEMS:
+                raise ValueError(f"{key} は{MAX_SUBSCRIPTION_ITEMS}件までです")
+            return frozenset(value)
+
+        return cls(types=items("types"), locations=items("locations"), devices=items("devices"))
+
+    @property
+    def all_devices(self) -> bool:
+        return self.locations is None and self.devices is None
+
+    def wants_type(self, message_type: str) -> bool:
+        return self.types is None or message_type in self.types
+
+    def wants_device(self, device_addr: str, location: Optional[str]) -> bool:
+        return (
+            self.all_devices
+            or (self.locations is not None and location in self.locations)
+            or (self.devices is not None and device_addr in self.devices)
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            key: sorted(value) if value is not None else None
+            for key, value in (("types", self.types), ("locations", self.locations), ("devices", self.devices))
+        }
+
+
+class ClientConnection:
+    """1クライアント分の送信キューと送信タスク"""
+
+    def __init__(self, websocket: WebSocket, max_queue: int = WS_SEND_QUEUE_SIZE, compact: bool = False):
+        self.websocket = websocket
+        self.max_queue = max_queue
+        self.compact = compact      # devices_update / devices_heartbeat をバイナリで受け取る
+        self.connected_at = datetime.utcnow()
+        self.sent = 0
+        self.closed = False
+        self.close_reason: Optional[str] = None
+        self.subscription: Optional[Subscription] = None    # None: 購読なし（全て受け取る）
+        self._pending: deque = deque()    # (積んだ時刻, 送信する文字列またはバイナリ)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def client(self) -> str:
+        client = self.websocket.client
+        return f"{client.host}:{client.port}" if client else "-"
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def send(self, frame: Union[str, bytes]) -> bool:
+        """送信キューに積む（溢れたら False）"""
+        if self.closed:
+            return False
+        if len(self._pending) >= self.max_queue:
+            return False
+        self._pending.append((time.monotonic(), frame))
+        self._wakeup.set()
+        return True
+
+    def send_message(self, message: dict) -> bool:
+        return self.send(encode_message(message))
+
+    def send_recorded(self, message: dict, compact: Optional[List[bytes]]) -> bool:
+        """送り直し用に残した配信を送る（バイナリに符号化できていればバイナリで）"""
+        if self.compact and compact is not None:
+            return self.send(compact_frame(message["type"], message["seq"], compact))
+        return self.send_message(message)
+
+    def wants_type(self, message_type: str) -> bool:
+        if message_type == "devices_dictionary":
+            return self.compact
+        return self.subscription is None or self.subscription.wants_type(message_type)
+
+    async def _run(self):
+        """キューの先頭から順に送信（失敗・タイムアウトしたら終了）"""
+        while not self.closed:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            _, frame = self._pending[0]
+            send = self.websocket.send_bytes if isinstance(frame, bytes) else self.websocket.send_text
+            try:
+                await asyncio.wait_for(send(frame), timeout=WS_SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                await self.close(f"送信が{WS_SEND_TIMEOUT:g}秒以内に終わりませんでした")
+                return
+            except Exception as e:
+                self.stop(f"送信エラー: {e}")
+                return
+            self._pending.popleft()
+            self.sent += 1
+
+    def stop(self, reason: Optional[str] = None):
+        """送信を止める（切断後の後始末）"""
+        self.closed = True
+        if reason and self.close_reason is None:
+            self.close_reason = reason
+        self._pending.clear()
+        self._wakeup.set()
+        if self._task is not None and not self._task.done() and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    async def close(self, reason: str):
+        """送信を止めてソケットを閉じる（送信が追いつかないクライアント）"""
+        self.stop(reason)
+        try:
+            await self.websocket.close(code=CLOSE_TOO_SLOW, reason="too slow")
+        except Exception:
+            pass  # 既に切断済み
+
+    def stats(self) -> dict:
+        return {
+            "client": self.client,
+            "connected_at": self.connected_at.isoformat(),
+            "queued": len(self._pending),
+            "lag_seconds": round(time.monotonic() - self._pending[0][0], 3) if self._pending else 0.0,
+            "sent": self.sent,
+            "subscription": self.subscription.to_dict() if self.subscription else None,
+            "compact": self.compact,
+        }
+
+
+class ConnectionManager:
+    """WebSocket接続の管理と配信（購読条件の索引つき）"""
+
+    def __init__(self):
+        self.clients: Dict[WebSocket, ClientConnection] = {}
+        self.dropped = 0    # 送信が追いつかず切断したクライアント数（累計）
+        # 購読の索引
+        self._everything: Set[ClientConnection] = set()             # 購読なし（全て）
+        self._all_devices: Set[ClientConnection] = set()            # 全デバイス・全体の集計
+        self._by_location: Dict[str, Set[ClientConnection]] = {}
+        self._by_device: Dict[str, Set[ClientConnection]] = {}
+        # 再接続時の送り直し用
+        self.stream = uuid.uuid4().hex[:12]     # 起動ごとに変わる
+        self.seq = 0
+        self._replay: deque = deque(maxlen=WS_REPLAY_BUFFER)    # (seq, メッセージ, バイナリ用に符号化した各件)
+        self._replay_evicted_seq = 0                            # バッファから押し出された最新の seq
+        self._latest: Dict[tuple, Tuple[int, dict]] = {}        # latest_only のメッセージ（種類・設置場所ごと）
+        self.resumed = 0
+        self.snapshots = 0
+        self.encoder = CompactEncoder()
+
+    def __len__(self) -> int:
+        return len(self.clients)
+
+    async def connect(self, websocket: WebSocket, resume: Optional[Tuple[str, int]] = None,
+                      snapshot: Optional[Callable[[], Awaitable[List[dict]]]] = None) -> ClientConnection:
+        """接続を受け付けて配信を開始
+
+        resume: 再接続したクライアントが最後に受け取った (stream, seq)。その後の配信を送り直す。
+        送り直せない場合は snapshot() のメッセージを先に送る。
+        """
+        compact = COMPACT_SUBPROTOCOL in websocket.scope.get("subprotocols", [])
+        await websocket.accept(subprotocol=COMPACT_SUBPROTOCOL if compact else None)
+        client = ClientConnection(websocket, compact=compact)
+        client.start()
+
+        since = self.seq
+        missed: List[tuple] = []
+        resumed = resume is not None and self._can_resume(*resume)
+        if resumed:
+            since = resume[1]
+            missed = self._missed(since)
+            # 送信キューに収まらないほど遅れていればスナップショットを送る
+            resumed = len(missed) < client.max_queue // 2
+        client.send_message({"type": "hello", "stream": self.stream, "seq": since, "resumed": resumed})
+        if resume is not None:
+            if resumed:
+                self.resumed += 1
+            else:
+                self.snapshots += 1
+                since = self.seq
+                for message in (await snapshot()) if snapshot is not None else []:
+                    client.send_message(message)
+                missed = self._missed(since)    # スナップショット作成中の配信
+
+        # 送り直しと配信先への登録の間に await を挟まない（取りこぼし・順序の入れ替わりを防ぐ）
+        if client.compact:
+            client.send_message(self.encoder.dictionary())
+        for message, compact_entries in missed:
+            if client.wants_type(message["type"]):
+                client.send_recorded(message, compact_entries)
+        self.clients[websocket] = client
+        self._everything.add(client)
+        logger.info(f"WebSocket接続: {len(self.clients)}台のクライアント（{'再開' if resumed else '新規'}）")
+        return client
+
+    def _can_resume(self, stream: str, seq: int) -> bool:
+        return stream == self.stream and self._replay_evicted_seq <= seq <= self.seq
+
+    def _missed(self, since: int) -> List[tuple]:
+        """since より後の配信（seq順の (メッセージ, バイナリ用に符号化した各件)）"""
+        missed = [entry for entry in self._replay if entry[0] > since]
+        missed += [(seq, message, None) for seq, message in self._latest.values() if seq > since]
+        missed.sort(key=lambda entry: entry[0])
+        return [(message, compact) for _, message, compact in missed]
+
+    def _record(self, message: dict, key: Optional[tuple]) -> Tuple[dict, Optional[List[bytes]]]:
+        """通し番号を付けて送り直し用に残す（key があれば同じ key の古いものは残さない）
+
+        devices_update / devices_heartbeat はバイナリ用の符号化も返す（符号化できなければ None）。
+        """
+        self.seq += 1
+        message = {**message, "seq": self.seq}
+        compact = None
+        if key is not None:
+            self._latest[key] = (self.seq, message)
+        else:
+            compact = self.encoder.encode_entries(message)
+            if len(self._replay) == self._replay.maxlen:
+                self._replay_evicted_seq = self._replay[0][0]
+            self._replay.append((self.seq, message, compact))
+        return message, compact
+
+    def disconnect(self, websocket: WebSocket):
+        client = self.clients.pop(websocket, None)
+        if client is None:
+            return
+        self._unindex(client)
+        client.stop("切断")
+        logger.info(f"WebSocket切断: {len(self.clients)}台のクライアント")
+
+    def subscribe(self, client: ClientConnection, subscription: Subscription):
+        """購読条件を差し替える"""
+        self._unindex(client)
+        client.subscription = subscription
+        if subscription.all_devices:
+            self._all_devices.add(client)
+        for location in subscription.locations or ():
+            self._by_location.setdefault(location, set()).add(client)
+        for device_addr in subscription.devices or ():
+            self._by_device.setdefault(device_addr, set()).add(client)
+
+    def _unindex(self, client: ClientConnection):
+        self._everything.discard(client)
+        self._all_devices.discard(client)
+        subscription = client.subscription
+        if subscription is None:
+            return
+        for index, keys in ((self._by_location, subscription.locations), (self._by_device, subscription.devices)):
+            for key in keys or ():
+                subscribers = index.get(key)
+                if subscribers is not None:
+                    subscribers.discard(client)
+                    if not subscribers:
+                        del index[key]
+
+    def _deliver(self, client: ClientConnection, frame: Union[str, bytes]):
+        """送信キューに積む（送信に失敗したソケットは外し、溢れたクライアントは切断）"""
+        websocket = client.websocket
+        if client.closed:
+            # 送信に失敗した・タイムアウトしたソケット
+            logger.error(f"WebSocket送信エラー: {client.client} {client.close_reason}")
+            self.disconnect(websocket)
+        elif not client.send(frame):
+            self.dropped += 1
+            logger.warning(
+                f"WebSocket送信待ちが上限（{client.max_queue}件）に達したため切断: {client.client}"
+            )
+            self.clients.pop(websocket, None)
+            self._unindex(client)
+            asyncio.ensure_future(client.close("送信待ちが上限に達しました"))
+
+    async def broadcast(self, message: dict, location=ANY_LOCATION, latest_only: bool = False):
+        """メッセージを配信（キューに積むだけで送信は待たない）
+
+        location を指定すると設置場所ごとの集計として、その設置場所（None は全体）を購読しているクライアントだけに送る。
+        latest_only=True は再接続時に種類・設置場所ごとの最新の1通だけ送り直せばよいメッセージ。
+        """
+        key = (message["type"], location) if latest_only else None
+        message, _ = self._record(message, key)
+        if location is ANY_LOCATION:
+            recipients: Iterable[ClientConnection] = list(self.clients.values())
+        else:
+            scoped = self._by_location.get(location, ()) if location is not None else self._all_devices
+            recipients = [*self._everything, *scoped]
+        frame = None
+        for client in recipients:
+            if not client.wants_type(message["type"]):
+                continue
+            if frame is None:
+                frame = encode_message(message)
+            self._deliver(client, frame)
+
+    async def broadcast_devices(self, message: dict, device_locations: Dict[str, Optional[str]],
+                                path: Sequence[str] = ("devices",), latest_only: bool = False):
+        """デバイスごとの項目のリスト（message の path の位置）を、購読しているデバイスの分だけに絞って配信
+
+        device_locations: device_addr → 設置場所
+        """
+        if message["type"] == "devices_update":
+            # 省データ形式のクライアントに新しいデバイスのハンドルを先に知らせる
+            dictionary = self.encoder.announce(_get_path(message, path))
+            if dictionary is not None:
+                await self.broadcast(dictionary)
+        message, compact = self._record(message, (message["type"],) if latest_only else None)
+        entries = _get_path(message, path)
+        recipients: Set[ClientConnection] = set(self._everything) | self._all_devices
+        for location in {device_locations.get(entry["device_addr"]) for entry in entries}:
+            recipients |= self._by_location.get(location, set())
+        for entry in entries:
+            recipients |= self._by_device.get(entry["device_addr"], set())
+
+        # (送る項目（entries の位置）, バイナリか) → 直列化済みのフレーム
+        frames: Dict[tuple, Union[str, bytes]] = {}
+        for client in recipients:
+            if not client.wants_type(message["type"]):
+                continue
+            subscription = client.subscription
+            if subscription is None or subscription.all_devices:
+                selected = None
+            else:
+                selected = tuple(
+                    i for i, entry in enumerate(entries)
+                    if subscription.wants_device(entry["device_addr"], device_locations.get(entry["device_addr"]))
+                )
+                if not selected:
+                    continue
+            binary = client.compact and compact is not None
+            if (selected, binary) not in frames:
+                if binary:
+                    frames[selected, binary] = compact_frame(
+                        message["type"], message["seq"], compact if selected is None else [compact[i] for i in selected]
+                    )
+                else:
+                    frames[selected, binary] = encode_message(
+                        message if selected is None else _with_path(message, path, [entries[i] for i in selected])
+                    )
+            self._deliver(client, frames[selected, binary])
+
+    def stats(self) -> dict:
+        clients: List[dict] = [client.stats() for client in self.clients.values()]
+        return {
+            "clients": len(clients),
+            "dropped": self.dropped,
+            "max_lag_seconds": max((c["lag_seconds"] for c in clients), default=0.0),
+            "seq": self.seq,
+            "replay_buffer": len(self._replay),
+            "resumed": self.resumed,
+            "snapshots": self.snapshots,
+            "connections": clients,
+        }
+
+
+def _get_path(message: dict, path: Sequence[str]):
+    value = message
+    for key in path:
+        value = value[key]
+    return value
+
+
+def _with_path(message: dict, path: Sequence[str], value) -> dict:
+    """path の位置だけを value に置き換えたコピー"""
+    if not path:
+        return value
+    return {**message, path[0]: _with_path(message[path[0]], path[1:], value)}
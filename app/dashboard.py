@@ -0,0 +1,503 @@
+"""
+ダッシュボード用の集計（共有スナップショット）
+
+登録情報・現在ステータス・営業日の状態遷移を1回だけ読み込み、
+デバイス一覧・全体ステータス・時間帯別推移・現在稼働率・タイムライン・日次推移を
+同じスナップショットから計算する。
+個別のAPIと初期表示用の一括API（/api/dashboard/bootstrap）の両方がこのモジュールを使う。
+"""
+import os
+from bisect import bisect_left
+from dataclasses import dataclass
+from datetime import datetime, timedelta, date as ddate
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from .aggregation import (
+    STATE_KEYS, DeviceTrace, state_key, load_traces, load_day_traces, hourly_state_minutes, recorded_state_minutes,
+    window_green_minutes, fold_hourly_minutes, running_percent, green_apples_for_percent, count_daily_apples,
+)
+from .business_calendar import business_calendar
+from .device_config import get_all_devices_from_db, get_device_info
+from .device_registry import RegisteredDevice, device_registry
+from .models import DeviceStatus, DailyOperationRate, DailyGreenAppleCount
+
+# 集計用の状態キー → タイムライン表示用の (ステータス, 色)
+STATE_DISPLAY = {
+    "running": ("running", "green"),
+    "stop_yellow": ("stop_yellow", "yellow"),
+    "stop_red": ("stop_red", "red"),
+    "idle": ("none", "gray"),
+}
+
+# 確定済み営業日のタイムラインを事前計算するズームレベル（min_segment_minutes、0はまとめなし）
+# フロントエンド（templates/index.html の TIMELINE_ZOOM_LEVELS）と同じ値にすること
+TIMELINE_ZOOM_LEVELS = tuple(
+    int(v) for v in os.getenv("TIMELINE_ZOOM_LEVELS", "0,1,2,5,10").split(",") if v.strip()
+)
+
+
+class DashboardSnapshot:
+    """1リクエスト分の共有スナップショット（状態遷移は必要になった時に1回だけ読み込む）"""
+
+    def __init__(self, db, target_date: Optional[ddate] = None, now_utc: Optional[datetime] = None,
+                 extra_addrs: Iterable[str] = ()):
+        self.db = db
+        self.now_utc = now_utc or datetime.utcnow()
+        self.now_jst = business_calendar.to_local(self.now_utc)  # naive JST
+        self.today = business_calendar.business_date_of_utc(self.now_utc)
+        self.bday = business_calendar.day(target_date or self.today)
+        self.registrations: List[RegisteredDevice] = device_registry.snapshot(db).registrations()
+        registered = set(self.device_addrs())
+        self.extra_addrs = [addr for addr in extra_addrs if addr not in registered]  # 未登録デバイス
+        self._traces: Optional[Dict[str, DeviceTrace]] = None
+        self._hourly: Optional[Dict[str, List[Dict[str, float]]]] = None
+
+    def device_addrs(self, location: Optional[str] = None, enabled_only: bool = False) -> List[str]:
+        """登録デバイスのアドレス一覧（設置場所・有効フラグで絞り込み）"""
+        return [
+            reg.device_addr for reg in self.registrations
+            if (not location or reg.location == location) and (not enabled_only or reg.is_enabled)
+        ]
+
+    @property
+    def traces(self) -> Dict[str, DeviceTrace]:
+        """対象営業日の状態遷移（全登録デバイス分、直前状態を含む）"""
+        if self._traces is None:
+            self._traces = load_day_traces(self.db, self.device_addrs() + self.extra_addrs, self.bday)
+        return self._traces
+
+    @property
+    def hourly(self) -> Dict[str, List[Dict[str, float]]]:
+        """デバイスごとの1時間ごとの状態別分数"""
+        if self._hourly is None:
+            self._hourly = {
+                addr: hourly_state_minutes(trace, self.bday, self.now_utc)
+                for addr, trace in self.traces.items()
+            }
+        return self._hourly
+
+    def trace(self, device_addr: str) -> DeviceTrace:
+        return self.traces.get(device_addr) or DeviceTrace(device_addr)
+
+
+# ---------- デバイス一覧 ----------
+
+def device_list(db) -> list:
+    """全デバイスの現在のステータス（設備情報含む、indexでソート）"""
+    registered = get_all_devices_from_db(db)
+    result = []
+    for d in db.query(DeviceStatus).all():
+        device_info = registered.get(d.device_addr) or get_device_info(d.device_addr)
+        result.append({
+            "device_id": d.device_id,
+            "device_addr": d.device_addr,
+            "device_name": device_info["name"],
+            "location": device_info["location"],
+            "description": device_info["description"],
+            "index": device_info["index"],
+            "gateway_id": d.gateway_id,
+            "battery": d.battery,
+            "red": d.red,
+            "yellow": d.yellow,
+            "green": d.green,
+            "status_code": d.status_code,
+            "status_text": d.status_text,
+            "last_update": d.last_update.isoformat() if d.last_update else None,
+            "is_active": d.is_active
+        })
+
+    # indexでソート（設備1号機→7号機の順）
+    result.sort(key=lambda x: x["index"])
+    return result
+
+
+# ---------- 全体ステータス ----------
+
+def _percents(minutes: Dict[str, float]) -> Dict[str, float]:
+    """状態別分数を割合（%）に変換"""
+    total_minutes = sum(minutes[key] for key in STATE_KEYS)
+    if total_minutes <= 0:
+        return dict.fromkeys(STATE_KEYS, 0)
+    return {key: round(minutes[key] / total_minutes * 100, 1) for key in STATE_KEYS}
+
+
+def overall_current_status(snapshot: DashboardSnapshot, device_addrs: list) -> dict:
+    """6:00〜現在の全体ステータス時間割合（円グラフ用）"""
+    if not device_addrs:
+        return {"running": 0, "stop_yellow": 0, "stop_red": 0, "idle": 0, "total_devices": 0}
+
+    totals = dict.fromkeys(STATE_KEYS, 0.0)
+    for addr in device_addrs:
+        for key, minutes in recorded_state_minutes(snapshot.trace(addr), snapshot.now_utc).items():
+            totals[key] += minutes
+    total_minutes = sum(totals.values())
+
+    result = _percents(totals)
+    result.update({
+        "total_devices": len(device_addrs),
+        "total_hours": round(total_minutes / 60, 1)
+    })
+    return result
+
+
+def overall_hourly_status(snapshot: DashboardSnapshot, device_addrs: list) -> dict:
+    """1時間ごとの全体ステータス割合とGreenApple獲得数（積上げ棒グラフ用）"""
+    if not device_addrs:
+        return {"hours": [], "data": []}
+
+    hourly_totals = fold_hourly_minutes(snapshot.hourly, device_addrs)
+    hourly_data = []
+    total_green_apples = 0
+    for hour, minutes in zip(snapshot.bday.hours, hourly_totals):
+        percents = _percents(minutes)
+        green_apples = green_apples_for_percent(running_percent(minutes))
+        total_green_apples += green_apples
+        hourly_data.append({
+            "hour": hour.start_jst.strftime('%H:%M'),
+            "running": percents["running"],
+            "stop_yellow": percents["stop_yellow"],
+            "stop_red": percents["stop_red"],
+            "idle": percents["idle"],
+            "green_apples": green_apples
+        })
+
+    return {
+        "date": snapshot.bday.date.strftime('%Y-%m-%d'),
+        "total_devices": len(device_addrs),
+        "total_green_apples": total_green_apples,
+        "data": hourly_data
+    }
+
+
+def hourly_green_apples(snapshot: DashboardSnapshot, device_addrs: list) -> list:
+    """時間帯別のGreenApple獲得数（全デバイスの合算分数から）"""
+    if not device_addrs:
+        return []
+    hourly_totals = fold_hourly_minutes(snapshot.hourly, device_addrs)
+    result = []
+    for hour, minutes in zip(snapshot.bday.hours, hourly_totals):
+        percent = running_percent(minutes)
+        result.append({
+            "hour": hour.start_jst.strftime('%H:00'),
+            "running_percent": percent,
+            "apples": green_apples_for_percent(percent)
+        })
+    return result
+
+
+def device_hourly_operation_rate(trace: DeviceTrace, bday, now_utc: datetime) -> list:
+    """1デバイスの時間帯別ステータス割合（積上げ棒グラフ用）"""
+    return [
+        {"hour": hour.start_jst.strftime('%H:00'), **_percents(minutes)}
+        for hour, minutes in zip(bday.hours, hourly_state_minutes(trace, bday, now_utc))
+    ]
+
+
+# ---------- 現在の稼働率 ----------
+
+def current_operation_rate(device_addr: str, trace: DeviceTrace, now_utc: datetime) -> dict:
+    """6:00 JSTから現在時刻までの稼働率（緑ライトのみ稼働としてカウント）"""
+    span = business_calendar.day(business_calendar.business_date_of_utc(now_utc)).span
+
+    # 総時間（分）
+    total_minutes = (now_utc - span.start_utc).total_seconds() / 60
+
+    if not trace.records:
+        # データがない場合は全て未稼働
+        minutes = {"running": 0, "stop_yellow": 0, "stop_red": 0, "idle": total_minutes}
+    else:
+        # 最初の記録から現在時刻までを前の記録のステータスで集計
+        minutes = recorded_state_minutes(trace, now_utc)
+
+    # 稼働率計算（緑ライトのみ）
+    operation_rate = (minutes["running"] / total_minutes * 100) if total_minutes > 0 else 0.0
+
+    return {
+        "device_addr": device_addr,
+        "start_time": span.start_jst.strftime('%Y-%m-%d %H:%M:%S'),
+        "end_time": business_calendar.to_local(now_utc).strftime('%Y-%m-%d %H:%M:%S'),
+        "operation_rate": round(operation_rate, 1),
+        "operation_minutes": int(minutes["running"]),
+        "stop_yellow_minutes": int(minutes["stop_yellow"]),
+        "stop_red_minutes": int(minutes["stop_red"]),
+        "none_minutes": int(minutes["idle"]),
+        "total_minutes": int(total_minutes)
+    }
+
+
+def load_current_traces(db, device_addrs: list, now_utc: datetime) -> Dict[str, DeviceTrace]:
+    """今日の6:00 JST〜現在の履歴を読み込む（現在時刻ちょうどの記録も含める、直前状態は使わない）"""
+    span = business_calendar.day(business_calendar.business_date_of_utc(now_utc)).span
+    return load_traces(db, device_addrs, span.start_utc, now_utc + timedelta(microseconds=1), with_prev_state=False)
+
+
+def current_operation_rates(device_addrs: list, traces: Dict[str, DeviceTrace], now_utc: datetime) -> dict:
+    """全デバイスの現在の稼働率（traces は当日6:00以降の状態遷移）"""
+    span = business_calendar.day(business_calendar.business_date_of_utc(now_utc)).span
+    return {
+        "start_time": span.start_jst.strftime('%Y-%m-%d %H:%M:%S'),
+        "end_time": business_calendar.to_local(now_utc).strftime('%Y-%m-%d %H:%M:%S'),
+        "devices": [
+            current_operation_rate(addr, traces.get(addr) or DeviceTrace(addr), now_utc)
+            for addr in device_addrs
+        ]
+    }
+
+
+# ---------- タイムライン ----------
+
+@dataclass(frozen=True)
+class _Span:
+    """タイムラインの1区間（naive JST）"""
+    status: str
+    color: str
+    start: datetime
+    end: datetime
+    breakdown: Optional[Dict[str, float]] = None   # "mixed" の場合のステータス別分数
+
+    @property
+    def minutes(self) -> float:
+        return (self.end - self.start).total_seconds() / 60
+
+
+def _segment(span: _Span) -> dict:
+    segment = {
+        "status": span.status,
+        "color": span.color,
+        "start": span.start.isoformat(),
+        "end": span.end.isoformat(),
+        "duration_minutes": int(span.minutes)
+    }
+    if span.breakdown is not None:
+        segment["breakdown"] = span.breakdown
+    return segment
+
+
+def _merge_run(run: List[_Span]) -> _Span:
+    """連続する短い区間を1区間にまとめる（複数のステータスを含む場合は "mixed"、色は最も長いステータス）"""
+    breakdown: Dict[str, float] = {}
+    colors = {}
+    for span in run:
+        breakdown[span.status] = breakdown.get(span.status, 0.0) + span.minutes
+        colors[span.status] = span.color
+    if len(breakdown) == 1:
+        return _Span(run[0].status, run[0].color, run[0].start, run[-1].end)
+    dominant = max(breakdown, key=breakdown.get)
+    return _Span("mixed", colors[dominant], run[0].start, run[-1].end,
+                 {status: round(minutes, 1) for status, minutes in breakdown.items()})
+
+
+def merge_short_spans(spans: List[_Span], min_minutes: float) -> List[_Span]:
+    """min_minutes 未満の区間を、連続する範囲ごとにまとめる（まとめた範囲が min_minutes に達したら区切る）"""
+    if not min_minutes or min_minutes <= 0:
+        return spans
+
+    merged = []
+    run: List[_Span] = []
+    for span in spans:
+        if span.minutes >= min_minutes:
+            if run:
+                merged.append(_merge_run(run))
+                run = []
+            merged.append(span)
+            continue
+        run.append(span)
+        if (span.end - run[0].start).total_seconds() / 60 >= min_minutes:
+            merged.append(_merge_run(run))
+            run = []
+    if run:
+        merged.append(_merge_run(run))
+
+    # まとめた結果、同じステータスが隣り合った区間は結合
+    result: List[_Span] = []
+    for span in merged:
+        if result and span.status != "mixed" and result[-1].status == span.status:
+            result[-1] = _Span(span.status, span.color, result[-1].start, span.end)
+        else:
+            result.append(span)
+    return result
+
+
+def timeline_segments(trace: DeviceTrace, window, now_jst: datetime, min_segment_minutes: float = 0) -> list:
+    """1シフト分のタイムラインセグメント（ステータスが変わるたびに区切る）
+
+    min_segment_minutes を指定すると、それより短いセグメントをまとめる（描画幅1px未満の区間など）。
+    """
+    start_time = window.start_jst.replace(tzinfo=None)
+    end_time = window.end_jst.replace(tzinfo=None)
+
+    # end_timeが未来の場合、現在時刻までに制限
+    actual_end_time = min(end_time, now_jst)
+
+    lo = bisect_left(trace.timestamps, window.start_utc)
+    hi = bisect_left(trace.timestamps, window.end_utc)
+    records = trace.records[lo:hi]
+
+    if not records:
+        # データがない場合は全体をグレーに
+        return [_segment(_Span("none", "gray", start_time, actual_end_time))]
+
+    spans = []
+    current_state = records[0][1]
+    segment_start = start_time
+    for timestamp, state in records[1:]:
+        if state != current_state:
+            # ステータス変化 - 前のセグメントを保存
+            record_time = business_calendar.to_local(timestamp)
+            spans.append(_Span(*STATE_DISPLAY[current_state], segment_start, record_time))
+            segment_start = record_time
+            current_state = state
+
+    # 最後のセグメント（現在時刻まで）
+    spans.append(_Span(*STATE_DISPLAY[current_state], segment_start, actual_end_time))
+    segments = [_segment(span) for span in merge_short_spans(spans, min_segment_minutes)]
+
+    # 現在時刻以降（未来）を白で表示
+    if actual_end_time < end_time:
+        segments.append(_segment(_Span("future", "white", actual_end_time, end_time)))
+
+    return segments
+
+
+def device_timeline(device_addr: str, trace: DeviceTrace, bday, now_jst: datetime,
+                    min_segment_minutes: float = 0) -> dict:
+    """デバイスの稼働状況タイムライン（日勤/夜勤別）"""
+    return {
+        "device_addr": device_addr,
+        "date": bday.date.isoformat(),
+        "day_shift": {
+            "start": bday.day_shift.start_jst.isoformat(),
+            "end": bday.day_shift.end_jst.isoformat(),
+            "segments": timeline_segments(trace, bday.day_shift, now_jst, min_segment_minutes)
+        },
+        "night_shift": {
+            "start": bday.night_shift.start_jst.isoformat(),
+            "end": bday.night_shift.end_jst.isoformat(),
+            "segments": timeline_segments(trace, bday.night_shift, now_jst, min_segment_minutes)
+        }
+    }
+
+
+def iter_range_timelines(rows: Iterable[tuple], device_addrs: List[str], bdays: list, now_jst: datetime,
+                         min_segment_minutes: float = 0) -> Iterator[dict]:
+    """複数デバイス×複数営業日のタイムラインを1回の走査で順に生成
+
+    rows は期間全体の (device_addr, timestamp, red, yellow, green) を device_addr, timestamp 順に並べたもの。
+    デバイスごとに期間分の状態遷移をまとめ、デバイスが切り替わった時点でそのデバイスの全営業日分を出力する。
+    出力はアドレス順（状態遷移のないデバイスも全体グレーで出力）。
+    """
+    pending = sorted(set(device_addrs))
+    trace: Optional[DeviceTrace] = None
+
+    def flush(addr: str, device_trace: DeviceTrace):
+        for bday in bdays:
+            yield device_timeline(addr, device_trace, bday, now_jst, min_segment_minutes)
+
+    position = 0
+    for addr, timestamp, red, yellow, green in rows:
+        if trace is None or addr != trace.device_addr:
+            if trace is not None:
+                yield from flush(trace.device_addr, trace)
+            # 状態遷移のないデバイスを先に出力
+            while position < len(pending) and pending[position] < addr:
+                yield from flush(pending[position], DeviceTrace(pending[position]))
+                position += 1
+            if position < len(pending) and pending[position] == addr:
+                position += 1
+            trace = DeviceTrace(addr)
+        trace.add(timestamp, state_key(red, yellow, green))
+
+    if trace is not None:
+        yield from flush(trace.device_addr, trace)
+    for addr in pending[position:]:
+        yield from flush(addr, DeviceTrace(addr))
+
+
+# ---------- 日次推移 ----------
+
+def daily_operation_rates(snapshot: DashboardSnapshot, device_addrs: list, date_list: List[ddate]) -> list:
+    """日ごとの全体稼働率（定時内/含残業、過去日は集計テーブル・当日はスナップショットから計算）"""
+    today_business = snapshot.today
+
+    # 過去日は集計テーブルから期間分をまとめて取得
+    past_dates = [d for d in date_list if d < today_business]
+    rows_by_date = {}
+    if past_dates:
+        for row in snapshot.db.query(DailyOperationRate).filter(
+            DailyOperationRate.target_date >= min(past_dates),
+            DailyOperationRate.target_date <= max(past_dates),
+            DailyOperationRate.device_addr.in_(device_addrs)
+        ).all():
+            rows_by_date.setdefault(row.target_date, []).append(row)
+
+    daily_rates = []
+    for target_date in date_list:
+        rate_r = rate_o = 0
+        if target_date == today_business:
+            # 当日はリアルタイム計算（現在時刻がウィンドウ内ならそこまで、まだ8:00前なら0）
+            bday = business_calendar.day(target_date)
+            now_utc = snapshot.now_utc
+            regular_end_utc = bday.regular.clipped_end_utc(now_utc)
+            overtime_end_utc = bday.overtime.clipped_end_utc(now_utc)
+
+            if now_utc > bday.regular.start_utc:
+                total_run_r = 0
+                total_run_o = 0
+                for addr in device_addrs:
+                    trace = snapshot.trace(addr)
+                    total_run_r += window_green_minutes(trace, bday.regular.start_utc, regular_end_utc)
+                    total_run_o += window_green_minutes(trace, bday.overtime.start_utc, overtime_end_utc)
+
+                # 経過分数を分母にする（当日はまだウィンドウが完了していない）
+                elapsed_r = max(1, (regular_end_utc - bday.regular.start_utc).total_seconds() / 60) * len(device_addrs)
+                elapsed_o = max(1, (overtime_end_utc - bday.overtime.start_utc).total_seconds() / 60) * len(device_addrs)
+                rate_r = round(total_run_r / elapsed_r * 100, 1)
+                rate_o = round(total_run_o / elapsed_o * 100, 1)
+        elif target_date < today_business:
+            # 過去日は集計テーブルから取得
+            rows = rows_by_date.get(target_date, [])
+            if rows:
+                sum_run_r = sum(r.running_minutes_regular for r in rows)
+                sum_win_r = sum(r.window_minutes_regular for r in rows)
+                sum_run_o = sum(r.running_minutes_overtime for r in rows)
+                sum_win_o = sum(r.window_minutes_overtime for r in rows)
+                rate_r = round(sum_run_r / sum_win_r * 100, 1) if sum_win_r > 0 else 0
+                rate_o = round(sum_run_o / sum_win_o * 100, 1) if sum_win_o > 0 else 0
+
+        daily_rates.append({
+            "date": target_date.strftime('%m/%d'),
+            "rate_regular": rate_r,
+            "rate_overtime": rate_o
+        })
+    return daily_rates
+
+
+def daily_green_apples(snapshot: DashboardSnapshot, device_addrs: list, location: Optional[str], date_list: List[ddate]) -> list:
+    """日次GREEN APPLE収穫量（過去日は集計テーブル・当日はスナップショットから計算）"""
+    today_business = snapshot.today
+
+    # 過去日は集計テーブルから期間分をまとめて取得（locationキーは集計テーブルに合わせる）
+    past_dates = [d for d in date_list if d < today_business]
+    apples_by_date = {}
+    if past_dates:
+        apples_by_date = {
+            row.target_date: row.apple_count
+            for row in snapshot.db.query(DailyGreenAppleCount).filter(
+                DailyGreenAppleCount.target_date >= min(past_dates),
+                DailyGreenAppleCount.target_date <= max(past_dates),
+                DailyGreenAppleCount.location == (location or "")
+            ).all()
+        }
+
+    daily_apples = []
+    for target_date in date_list:
+        if target_date == today_business:
+            apples = count_daily_apples(fold_hourly_minutes(snapshot.hourly, device_addrs))
+        else:
+            apples = apples_by_date.get(target_date, 0)
+        daily_apples.append({
+            "date": target_date.strftime('%m/%d'),
+            "full_date": target_date.strftime('%Y-%m-%d'),
+            "apples": apples
+        })
+    return daily_apples
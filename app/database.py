@@ -1,7 +1,17 @@
 """
 データベース設定
 """
-from sqlalchemy import create_engine
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import date, datetime
+from typing import Callable, List, Optional, Union
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -14,6 +24,210 @@ engine = create_engine(
     connect_args={"check_same_thread": False}
 )
 
+
+# ========== SQLの打ち切り（時間予算・クライアント切断） ==========
+# 重い集計APIは実行期限（QueryDeadline）を設定して実行する。期限切れ・キャンセル後は
+# - 実行中のSQL文: SQLiteの進捗ハンドラーで中断（sqlite3.OperationalError: interrupted）
+# - 次のSQL文: 実行前に QueryInterrupted を送出
+# で打ち切り、ループで多数のSQLを発行する処理も含めてすぐに止める。
+
+PROGRESS_HANDLER_INTERVAL = 10000   # SQLiteの仮想マシン命令この回数ごとに期限を確認
+
+
+class QueryInterrupted(Exception):
+    """実行期限切れ・キャンセルによるSQLの打ち切り"""
+
+
+class QueryDeadline:
+    """SQLの実行期限（cancel() で期限前でも打ち切る）"""
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        self.cancelled = False
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() > self.expires_at
+
+    def cancel(self):
+        self.cancelled = True
+
+    def should_abort(self) -> bool:
+        return self.cancelled or self.expired
+
+
+_query_deadline: ContextVar[Optional[QueryDeadline]] = ContextVar("query_deadline", default=None)
+
+
+def set_query_deadline(deadline: QueryDeadline):
+    """以降のSQLに実行期限を設定（戻り値は ContextVar のトークン）"""
+    return _query_deadline.set(deadline)
+
+
+def reset_query_deadline(token):
+    _query_deadline.reset(token)
+
+
+def _progress_handler() -> int:
+    """0以外を返すと実行中のSQL文を中断"""
+    deadline = _query_deadline.get()
+    return 1 if deadline is not None and deadline.should_abort() else 0
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragma(dbapi_connection, connection_record):
+    """WALモード: 読み取り（エクスポート等の長いスナップショット読み取りを含む）が書き込みをブロックしない"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+    dbapi_connection.set_progress_handler(_progress_handler, PROGRESS_HANDLER_INTERVAL)
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _check_query_deadline(conn, cursor, statement, parameters, context, executemany):
+    deadline = _query_deadline.get()
+    if deadline is not None and deadline.should_abort():
+        raise QueryInterrupted("キャンセルされました" if deadline.cancelled else f"実行期限（{deadline.seconds:g}秒）を超えました")
+
+
+# ========== 遅いSQLの記録 ==========
+# しきい値を超えたSQL文を、バインド値・呼び出し元（API / ジョブ）・実行計画（EXPLAIN QUERY PLAN）と一緒に
+# 直近 SLOW_QUERY_LOG_SIZE 件だけメモリに残す（/api/admin/slow-queries で確認）。
+# 実行計画は同じ形のSQL文につき1回だけ取得する。
+
+logger = logging.getLogger(__name__)
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))              # 0以下で無効
+SLOW_QUERY_LOG_SIZE = int(os.getenv("SLOW_QUERY_LOG_SIZE", "200"))
+SLOW_QUERY_MAX_PLANS = 500                                             # 実行計画を保持するSQL文の形の上限
+
+# 呼び出し元（文字列、またはリクエストのように後からルートが決まる場合は文字列を返す関数）
+_query_source: ContextVar[Union[str, Callable[[], str], None]] = ContextVar("query_source", default=None)
+
+# IN (?, ?, ...) の個数違いは同じ形として扱う
+_IN_LIST = re.compile(r"\(\?(?:, \?)+\)")
+
+
+def set_query_source(source: Union[str, Callable[[], str]]):
+    """以降のSQLの呼び出し元を設定（ジョブ・タスクの先頭で呼ぶ。戻り値は ContextVar のトークン）"""
+    return _query_source.set(source)
+
+
+def reset_query_source(token):
+    _query_source.reset(token)
+
+
+def current_query_source() -> Optional[str]:
+    source = _query_source.get()
+    return source() if callable(source) else source
+
+
+def _statement_shape(statement: str) -> str:
+    return _IN_LIST.sub("(?...)", " ".join(statement.split()))
+
+
+def _param_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return repr(value)
+
+
+def _full_scans(plan: List[str]) -> List[str]:
+    """インデックスを使わずに全件走査しているテーブル（"SCAN device_history" / 古いSQLiteでは "SCAN TABLE ..."）"""
+    tables = []
+    for detail in plan:
+        words = detail.split()
+        if len(words) < 2 or words[0] != "SCAN" or "INDEX" in words or words[1] in ("CONSTANT", "SUBQUERY"):
+            continue
+        tables.append(words[2] if words[1] == "TABLE" and len(words) > 2 else words[1])
+    return tables
+
+
+class SlowQueryLog:
+    """遅いSQL文の記録（直近 size 件のリングバッファ）"""
+
+    def __init__(self, size: int):
+        self._entries = deque(maxlen=size)
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    def plan(self, dbapi_connection, shape: str, statement: str, parameters) -> List[str]:
+        """EXPLAIN QUERY PLAN の結果（形ごとに1回だけ実行）"""
+        plan = self._plans.get(shape)
+        if plan is not None:
+            return plan
+        try:
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+                plan = [row[3] for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+        except Exception as e:
+            plan = [f"（実行計画を取得できませんでした: {e}）"]
+        with self._lock:
+            if len(self._plans) < SLOW_QUERY_MAX_PLANS:
+                self._plans[shape] = plan
+        return plan
+
+    def record(self, entry: dict):
+        with self._lock:
+            self._entries.append(entry)
+
+    def entries(self) -> List[dict]:
+        """新しい順"""
+        with self._lock:
+            return list(reversed(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._plans.clear()
+
+
+slow_query_log = SlowQueryLog(SLOW_QUERY_LOG_SIZE)
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _slow_query_start(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def _slow_query_end(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["slow_query_start"].pop()) * 1000
+    if SLOW_QUERY_MS <= 0 or elapsed_ms < SLOW_QUERY_MS:
+        return
+
+    # executemany は先頭のバインド値で実行計画を取る
+    params = parameters[0] if executemany and parameters else parameters
+    shape = _statement_shape(statement)
+    plan = slow_query_log.plan(conn.connection.dbapi_connection, shape, statement, params)
+    source = current_query_source()
+    slow_query_log.record({
+        "recorded_at": datetime.utcnow(),
+        "duration_ms": round(elapsed_ms, 1),
+        "source": source,
+        "statement": shape,
+        "parameters": [_param_value(v) for v in (params or ())],
+        "executemany": len(parameters) if executemany else None,
+        "plan": plan,
+        "full_scans": _full_scans(plan),
+    })
+    logger.warning(f"遅いSQL {elapsed_ms:.0f}ms [{source or '-'}] {shape[:200]}")
+
+
+@event.listens_for(engine, "handle_error")
+def _slow_query_error(exception_context):
+    """エラー（打ち切りを含む）で after_cursor_execute が呼ばれない場合の後始末"""
+    conn = exception_context.connection
+    if conn is not None and conn.info.get("slow_query_start"):
+        conn.info["slow_query_start"].pop()
+
+
 # セッションローカル
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
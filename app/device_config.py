@@ -68,45 +68,14 @@ def get_all_devices() -> dict:
 
 
 def get_all_devices_from_db(db):
-    """DBから全デバイス情報を取得"""
-    from .models import DeviceRegistration
+    """有効なデバイス情報を取得（登録情報キャッシュから、表示順）"""
+    from .device_registry import device_registry
 
-    devices = db.query(DeviceRegistration).filter(
-        DeviceRegistration.is_enabled == True
-    ).order_by(DeviceRegistration.index).all()
-
-    result = {}
-    for device in devices:
-        result[device.device_addr] = {
-            "name": device.name,
-            "location": device.location,
-            "description": device.description,
-            "index": device.index
-        }
-    return result
+    return device_registry.snapshot(db).enabled_info()
 
 
 def get_device_info_from_db(db, mac_addr: str) -> dict:
-    """DBから個別デバイス情報を取得"""
-    from .models import DeviceRegistration
-
-    device = db.query(DeviceRegistration).filter(
-        DeviceRegistration.device_addr == mac_addr,
-        DeviceRegistration.is_enabled == True
-    ).first()
-
-    if device:
-        return {
-            "name": device.name,
-            "location": device.location,
-            "description": device.description,
-            "index": device.index
-        }
+    """個別デバイス情報を取得（登録情報キャッシュから、未登録ならハードコードされた設定）"""
+    from .device_registry import device_registry
 
-    # フォールバック: ハードコードされた設定を確認
-    return REGISTERED_DEVICES.get(mac_addr, {
-        "name": mac_addr,
-        "location": "不明",
-        "description": "未登録デバイス",
-        "index": 999
-    })
+    return device_registry.snapshot(db).info(mac_addr)
@@ -0,0 +1,130 @@
+"""
+デバイス登録情報のメモリキャッシュ（バージョン付き）
+
+登録情報（名前・設置場所・説明・表示順・有効フラグ）は月に数回しか変わらないが、
+MQTT受信ごと・API呼び出しごとに参照される。初回に1回だけDBから読み込み、
+登録・編集・削除APIのコミット後に invalidate() で破棄する。
+
+- スナップショットは不変オブジェクトで、差し替えは参照の置き換え1回（読み取り側はロック不要）
+- 読み込み中に invalidate() された場合、読み込んだ古い内容はキャッシュしない（バージョンで判定）
+"""
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from .device_config import REGISTERED_DEVICES
+from .models import DeviceRegistration
+
+# 未登録デバイスの表示用情報
+UNREGISTERED_INFO = {
+    "location": "不明",
+    "description": "未登録デバイス",
+    "index": 999
+}
+
+
+@dataclass(frozen=True)
+class RegisteredDevice:
+    """1デバイス分の登録情報（DeviceRegistration と同じ属性名）"""
+    id: int
+    device_addr: str
+    name: str
+    location: str
+    description: str
+    index: int
+    is_enabled: bool
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+
+    def info(self) -> dict:
+        """get_device_info_from_db() と同じ形式"""
+        return {
+            "name": self.name,
+            "location": self.location,
+            "description": self.description,
+            "index": self.index
+        }
+
+
+@dataclass(frozen=True)
+class RegistrySnapshot:
+    """ある時点の登録情報一式（登録順）"""
+    version: int
+    devices: Tuple[RegisteredDevice, ...]
+
+    def __post_init__(self):
+        object.__setattr__(self, "_by_addr", {d.device_addr: d for d in self.devices})
+
+    def get(self, device_addr: str) -> Optional[RegisteredDevice]:
+        return self._by_addr.get(device_addr)
+
+    def registrations(self, location: Optional[str] = None, enabled_only: bool = False,
+                      by_index: bool = False) -> List[RegisteredDevice]:
+        """登録デバイス一覧（設置場所・有効フラグで絞り込み、by_index=True で表示順）"""
+        result = [
+            d for d in self.devices
+            if (not location or d.location == location) and (not enabled_only or d.is_enabled)
+        ]
+        if by_index:
+            result.sort(key=lambda d: d.index)
+        return result
+
+    def device_addrs(self, location: Optional[str] = None, enabled_only: bool = False) -> List[str]:
+        return [d.device_addr for d in self.registrations(location, enabled_only)]
+
+    def enabled_info(self) -> Dict[str, dict]:
+        """有効なデバイスの情報（表示順、get_all_devices_from_db() と同じ形式）"""
+        return {d.device_addr: d.info() for d in self.registrations(enabled_only=True, by_index=True)}
+
+    def info(self, device_addr: str) -> dict:
+        """デバイス情報（無効・未登録ならハードコード設定、なければ未登録扱い）"""
+        device = self.get(device_addr)
+        if device and device.is_enabled:
+            return device.info()
+        return REGISTERED_DEVICES.get(device_addr, {"name": device_addr, **UNREGISTERED_INFO})
+
+
+class DeviceRegistry:
+    """登録情報キャッシュ（初回参照時にDBから読み込み、変更時に invalidate()）"""
+
+    def __init__(self):
+        self._snapshot: Optional[RegistrySnapshot] = None
+        self._version = 0
+        self._load_lock = threading.Lock()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def snapshot(self, db) -> RegistrySnapshot:
+        """現在の登録情報（キャッシュがなければ db から読み込む）"""
+        snapshot = self._snapshot
+        if snapshot is not None:
+            return snapshot
+
+        with self._load_lock:
+            snapshot = self._snapshot
+            if snapshot is not None:
+                return snapshot
+            version = self._version
+            snapshot = RegistrySnapshot(version, tuple(
+                RegisteredDevice(
+                    id=reg.id, device_addr=reg.device_addr, name=reg.name, location=reg.location,
+                    description=reg.description, index=reg.index, is_enabled=reg.is_enabled,
+                    created_at=reg.created_at, updated_at=reg.updated_at,
+                )
+                for reg in db.query(DeviceRegistration).order_by(DeviceRegistration.id).all()
+            ))
+            if version == self._version:
+                self._snapshot = snapshot
+            return snapshot
+
+    def invalidate(self):
+        """登録情報の変更後（コミット後）に呼ぶ"""
+        self._version += 1
+        self._snapshot = None
+
+
+# アプリ全体で共有するキャッシュ
+device_registry = DeviceRegistry()
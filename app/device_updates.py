@@ -0,0 +1,104 @@
+"""
+デバイス状態の配信をまとめる（WebSocketのフレーム数を減らす）
+
+これまではMQTTメッセージを受信するたびに（状態が変わっていなくても）device_update を1通配信し、
+6:00のリセットではデバイスごとに1通ずつ配信していた。ブラウザは1通ごとにカードを描画し直すため、
+デバイスが多い現場ではフレーム数とブラウザの負荷がデバイス数に比例して増えていた。
+
+- 状態の更新は WS_COALESCE_MS の間ためて、デバイスごとに最新の1件だけを devices_update 1通で配信する
+- 各デバイスは前回配信した状態から変わった項目だけを送る（初回は全項目）
+  変わった項目がないデバイスは送らない（ライトが同じままの受信は配信しない）
+- バッテリー残量と最終受信時刻は変化が多いため、WS_HEARTBEAT_SECONDS ごとの
+  devices_heartbeat でまとめて送る（前回から変わったデバイスのみ）
+- どちらも購読している設置場所・デバイスの分だけが各クライアントに届く（ConnectionManager.broadcast_devices）
+
+メッセージ:
+- devices_update:    {"type": "devices_update", "devices": [{"device_addr": ..., 変わった項目..., "timestamp": ...}]}
+- devices_heartbeat: {"type": "devices_heartbeat", "devices": [{"device_addr": ..., "battery": ..., "timestamp": ...}]}
+"""
+import asyncio
+import os
+from typing import Dict, List, Optional
+
+from .connection_manager import ConnectionManager
+
+# 配信設定（環境変数から取得）
+WS_COALESCE_MS = int(os.getenv("WS_COALESCE_MS", "200"))                       # 状態の更新をためる時間
+WS_HEARTBEAT_SECONDS = float(os.getenv("WS_HEARTBEAT_SECONDS", "30"))          # バッテリー・最終受信時刻の配信間隔
+
+# devices_heartbeat で送る項目（devices_update では変化を見ない）
+HEARTBEAT_FIELDS = ("battery", "timestamp")
+
+
+class DeviceUpdateCoalescer:
+    """デバイス状態の更新をまとめて配信"""
+
+    def __init__(self, manager: ConnectionManager, window_seconds: float = WS_COALESCE_MS / 1000):
+        self._manager = manager
+        self.window_seconds = window_seconds
+        self._pending: Dict[str, dict] = {}          # 配信待ち（デバイスごとに最新の1件）
+        self._sent: Dict[str, dict] = {}             # 前回配信した状態
+        self._locations: Dict[str, Optional[str]] = {}  # デバイスの設置場所（購読の絞り込み用）
+        self._seen: Dict[str, tuple] = {}            # 最新のバッテリー・最終受信時刻
+        self._heartbeat_sent: Dict[str, tuple] = {}  # 前回のハートビートで送った値
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self.frames = 0
+        self.updates = 0
+
+    def update(self, device: dict):
+        """デバイスの状態を受け取る（device_addr と各項目、配信は WS_COALESCE_MS 後にまとめて）"""
+        device_addr = device["device_addr"]
+        self.updates += 1
+        self._pending[device_addr] = device
+        self._locations[device_addr] = device.get("location")
+        self._seen[device_addr] = tuple(device.get(field) for field in HEARTBEAT_FIELDS)
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.window_seconds, self._fire)
+
+    def _fire(self):
+        self._flush_handle = None
+        asyncio.ensure_future(self.flush())
+
+    def changes(self) -> List[dict]:
+        """配信待ちのうち、前回配信から変わった項目（配信済みとして記録する）"""
+        pending, self._pending = self._pending, {}
+        entries = []
+        for device_addr, device in pending.items():
+            sent = self._sent.get(device_addr)
+            if sent is None:
+                entry = dict(device)
+            else:
+                entry = {
+                    key: value for key, value in device.items()
+                    if key not in HEARTBEAT_FIELDS and sent.get(key) != value
+                }
+                if not entry:
+                    continue
+                entry["device_addr"] = device_addr
+                entry["timestamp"] = device.get("timestamp")
+            self._sent[device_addr] = device
+            entries.append(entry)
+        return entries
+
+    async def flush(self):
+        """配信待ちの更新を1通にまとめて配信"""
+        entries = self.changes()
+        if entries:
+            self.frames += 1
+            await self._manager.broadcast_devices({"type": "devices_update", "devices": entries}, self._locations)
+
+    async def heartbeat(self):
+        """バッテリー残量・最終受信時刻を前回から変わったデバイスの分だけ配信"""
+        entries = []
+        for device_addr, values in self._seen.items():
+            if self._heartbeat_sent.get(device_addr) == values:
+                continue
+            self._heartbeat_sent[device_addr] = values
+            entries.append({"device_addr": device_addr, **dict(zip(HEARTBEAT_FIELDS, values))})
+        if entries:
+            self.frames += 1
+            await self._manager.broadcast_devices({"type": "devices_heartbeat", "devices": entries}, self._locations)
+
+    def stats(self) -> dict:
+        return {"updates": self.updates, "frames": self.frames}
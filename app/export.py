@@ -0,0 +1,310 @@
+"""
+データエクスポート（履歴・日次稼働率・時間帯別集計を CSV / Parquet でストリーミング出力）
+
+分析用にDBファイルを直接開くと稼働中のDBをロックしてしまうため、APIとCLI（scripts/export_data.py）から出力する。
+
+- 読み取りは1つのトランザクション内で行い、開始時点のスナップショットを読む（WALモードなので受信処理はブロックしない）
+- 行は EXPORT_CHUNK_ROWS 行ずつ読み出して書き出すため、期間の長さによらずメモリ使用量は一定
+- Parquet は pyarrow がインストールされている場合のみ
+"""
+import csv
+import io
+import os
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime, date as ddate
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+from sqlalchemy.orm import Session
+
+from .aggregation import STATE_KEYS, load_day_traces, hourly_state_minutes, running_percent
+from .business_calendar import business_calendar
+from .database import engine
+from .models import DeviceHistory, DeviceRegistration, DailyOperationRate
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # オプション: pip install pyarrow
+    pyarrow = None
+
+# エクスポート設定（環境変数から取得）
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))     # 一度に読み出し・書き出す行数
+EXPORT_MAX_DAYS = int(os.getenv("EXPORT_MAX_DAYS", "366"))         # APIで指定できる最大日数
+
+EXPORT_FORMATS = ("csv", "parquet")
+
+MEDIA_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+class ExportError(ValueError):
+    """エクスポート条件が不正（APIでは400）"""
+
+
+@dataclass(frozen=True)
+class ExportFilter:
+    """エクスポート条件（営業日の範囲・デバイス/設置場所）"""
+    start_date: ddate
+    end_date: ddate
+    device_addrs: Tuple[str, ...] = ()   # 空なら全デバイス
+    location: Optional[str] = None
+
+
+@contextmanager
+def snapshot_session():
+    """1つの読み取りトランザクション内のセッション（全クエリが開始時点の同じスナップショットを読む）
+
+    pysqlite はSELECTだけでは BEGIN を発行しないため、明示的に開始する。
+    SQLiteのスナップショットは最初の読み取りで確定するので、開始直後に1回読み取っておく。
+    """
+    with engine.connect() as conn:
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        conn.exec_driver_sql("BEGIN")
+        conn.exec_driver_sql("SELECT COUNT(*) FROM sqlite_master").scalar()
+        db = Session(bind=conn, autoflush=False)
+        try:
+            yield db
+        finally:
+            db.close()
+            conn.exec_driver_sql("ROLLBACK")
+
+
+# ---------- データセット ----------
+# 各データセットは (列名, 型) の一覧と、行（タプル）を返すジェネレーターの組
+
+def _registrations(db) -> dict:
+    return {reg.device_addr: reg for reg in db.query(DeviceRegistration).all()}
+
+
+def _target_addrs(registrations: dict, f: ExportFilter) -> Optional[List[str]]:
+    """条件に合うデバイス一覧（絞り込みなしならNone）"""
+    if not f.device_addrs and not f.location:
+        return None
+    addrs = list(f.device_addrs) if f.device_addrs else list(registrations)
+    if f.location:
+        addrs = [addr for addr in addrs if addr in registrations and registrations[addr].location == f.location]
+    return addrs
+
+
+def _device_info(registrations: dict, addr: str) -> Tuple[str, str]:
+    reg = registrations.get(addr)
+    return (reg.name, reg.location or "") if reg else ("", "")
+
+
+HISTORY_COLUMNS = [
+    ("id", "int"), ("timestamp", "timestamp"), ("business_date", "date"),
+    ("device_addr", "string"), ("device_id", "int"), ("device_name", "string"), ("location", "string"),
+    ("battery", "float"), ("red", "bool"), ("yellow", "bool"), ("green", "bool"),
+    ("status_code", "string"), ("status_text", "string"),
+]
+
+
+def history_rows(db, f: ExportFilter) -> Iterator[tuple]:
+    """受信履歴（時刻はJST、古い順）"""
+    registrations = _registrations(db)
+    addrs = _target_addrs(registrations, f)
+    query = db.query(
+        DeviceHistory.id, DeviceHistory.timestamp, DeviceHistory.device_addr, DeviceHistory.device_id,
+        DeviceHistory.battery, DeviceHistory.red, DeviceHistory.yellow, DeviceHistory.green,
+        DeviceHistory.status_code, DeviceHistory.status_text
+    ).filter(
+        DeviceHistory.timestamp >= business_calendar.day(f.start_date).span.start_utc,
+        DeviceHistory.timestamp < business_calendar.day(f.end_date).span.end_utc
+    )
+    if addrs is not None:
+        query = query.filter(DeviceHistory.device_addr.in_(addrs))
+
+    for row_id, timestamp, addr, device_id, battery, red, yellow, green, code, text in query.order_by(
+        DeviceHistory.timestamp, DeviceHistory.id
+    ).yield_per(EXPORT_CHUNK_ROWS):
+        name, location = _device_info(registrations, addr)
+        yield (
+            row_id, business_calendar.to_local(timestamp), business_calendar.business_date_of_utc(timestamp),
+            addr, device_id, name, location, battery, red, yellow, green, code, text,
+        )
+
+
+DAILY_OPERATION_RATE_COLUMNS = [
+    ("target_date", "date"), ("device_addr", "string"), ("device_name", "string"), ("location", "string"),
+    ("running_minutes_regular", "float"), ("window_minutes_regular", "float"), ("operation_rate_regular", "float"),
+    ("running_minutes_overtime", "float"), ("window_minutes_overtime", "float"), ("operation_rate_overtime", "float"),
+]
+
+
+def _rate(running: float, window: float) -> float:
+    return round(running / window * 100, 1) if window else 0.0
+
+
+def daily_operation_rate_rows(db, f: ExportFilter) -> Iterator[tuple]:
+    """日次稼働率（確定済みの日のみ、daily_operation_rate テーブル）"""
+    registrations = _registrations(db)
+    addrs = _target_addrs(registrations, f)
+    query = db.query(DailyOperationRate).filter(
+        DailyOperationRate.target_date >= f.start_date,
+        DailyOperationRate.target_date <= f.end_date
+    )
+    if addrs is not None:
+        query = query.filter(DailyOperationRate.device_addr.in_(addrs))
+
+    for row in query.order_by(DailyOperationRate.target_date, DailyOperationRate.device_addr).yield_per(EXPORT_CHUNK_ROWS):
+        name, location = _device_info(registrations, row.device_addr)
+        yield (
+            row.target_date, row.device_addr, name, location,
+            row.running_minutes_regular, row.window_minutes_regular,
+            _rate(row.running_minutes_regular, row.window_minutes_regular),
+            row.running_minutes_overtime, row.window_minutes_overtime,
+            _rate(row.running_minutes_overtime, row.window_minutes_overtime),
+        )
+
+
+HOURLY_COLUMNS = [
+    ("business_date", "date"), ("hour_start", "timestamp"), ("device_addr", "string"),
+    ("device_name", "string"), ("location", "string"),
+] + [(f"{key}_minutes", "float") for key in STATE_KEYS] + [("operation_rate", "float")]
+
+
+def hourly_rows(db, f: ExportFilter) -> Iterator[tuple]:
+    """1時間ごとの状態別分数（営業日ごとに履歴から計算、当日は現在時刻まで）"""
+    registrations = _registrations(db)
+    addrs = _target_addrs(registrations, f)
+    if addrs is None:
+        addrs = list(registrations)
+    now_utc = datetime.utcnow()
+
+    for bday in business_calendar.days(f.start_date, f.end_date):
+        if bday.span.start_utc > now_utc:
+            break
+        traces = load_day_traces(db, addrs, bday)
+        for addr in addrs:
+            name, location = _device_info(registrations, addr)
+            for hour, minutes in zip(bday.hours, hourly_state_minutes(traces[addr], bday, now_utc)):
+                yield (
+                    bday.date, hour.start_jst.replace(tzinfo=None), addr, name, location,
+                    *(round(minutes[key], 2) for key in STATE_KEYS), running_percent(minutes),
+                )
+
+
+DATASETS = {
+    "history": (HISTORY_COLUMNS, history_rows),
+    "daily-operation-rate": (DAILY_OPERATION_RATE_COLUMNS, daily_operation_rate_rows),
+    "hourly": (HOURLY_COLUMNS, hourly_rows),
+}
+
+
+def validate(dataset: str, fmt: str, f: ExportFilter, max_days: Optional[int] = None):
+    """エクスポート条件を検証（不正なら ExportError）"""
+    if dataset not in DATASETS:
+        raise ExportError(f"不明なデータセットです: {dataset}（{', '.join(DATASETS)}）")
+    if fmt not in EXPORT_FORMATS:
+        raise ExportError(f"不明な形式です: {fmt}（{', '.join(EXPORT_FORMATS)}）")
+    if fmt == "parquet" and pyarrow is None:
+        raise ExportError("Parquet出力には pyarrow が必要です（pip install pyarrow）")
+    if f.start_date > f.end_date:
+        raise ExportError("開始日は終了日以前を指定してください")
+    if max_days and (f.end_date - f.start_date).days + 1 > max_days:
+        raise ExportError(f"期間は{max_days}日以内で指定してください")
+
+
+# ---------- 書き出し ----------
+
+def _chunks(rows: Iterator[tuple], size: int) -> Iterator[List[tuple]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _csv_value(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def iter_csv(columns: Sequence[Tuple[str, str]], rows: Iterator[tuple]) -> Iterator[bytes]:
+    """CSVをチャンク単位で出力（Excelで文字化けしないようBOM付きUTF-8）"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow([name for name, _ in columns])
+    yield ("\ufeff" + buffer.getvalue()).encode("utf-8")
+
+    for chunk in _chunks(rows, EXPORT_CHUNK_ROWS):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([[_csv_value(v) for v in row] for row in chunk])
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkSink:
+    """ParquetWriter の書き込み先（書かれたバイト列を取り出してストリーミングする）"""
+
+    def __init__(self):
+        self._parts: List[bytes] = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def _arrow_schema(columns: Sequence[Tuple[str, str]]):
+    types = {
+        "int": pyarrow.int64(), "float": pyarrow.float64(), "bool": pyarrow.bool_(),
+        "string": pyarrow.string(), "date": pyarrow.date32(), "timestamp": pyarrow.timestamp("us"),
+    }
+    return pyarrow.schema([(name, types[kind]) for name, kind in columns])
+
+
+def iter_parquet(columns: Sequence[Tuple[str, str]], rows: Iterator[tuple]) -> Iterator[bytes]:
+    """Parquetを行グループ（EXPORT_CHUNK_ROWS 行）単位で出力"""
+    schema = _arrow_schema(columns)
+    sink = _ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    try:
+        for chunk in _chunks(rows, EXPORT_CHUNK_ROWS):
+            arrays = [pyarrow.array(values, type=field.type) for values, field in zip(zip(*chunk), schema)]
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+WRITERS = {"csv": iter_csv, "parquet": iter_parquet}
+
+
+def iter_export(dataset: str, fmt: str, f: ExportFilter,
+                session_factory: Callable = snapshot_session) -> Iterator[bytes]:
+    """データセットを指定形式のバイト列チャンクとして出力（スナップショット読み取り）"""
+    columns, row_func = DATASETS[dataset]
+    with session_factory() as db:
+        yield from WRITERS[fmt](columns, row_func(db, f))
+
+
+def export_filename(dataset: str, fmt: str, f: ExportFilter) -> str:
+    return f"{dataset}_{f.start_date:%Y%m%d}-{f.end_date:%Y%m%d}.{fmt}"
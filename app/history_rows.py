@@ -0,0 +1,166 @@
+"""
+履歴データの行取得（キーセットページング / NDJSONストリーミング）
+
+履歴は (timestamp, id) の順で一意に並ぶため、前ページ最後の行の (timestamp, id) をカーソルにして
+続きを取得する。OFFSETを使わないので、何ページ目でもインデックスから直接読み始められる。
+NDJSONストリーミングは yield_per で少しずつ読み出して1行ずつ送るため、件数によらずメモリ使用量は一定。
+"""
+import base64
+import os
+from datetime import datetime
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from fastapi.responses import StreamingResponse
+from sqlalchemy import and_, or_
+
+from .business_calendar import business_calendar
+from .database import SessionLocal
+from .models import DeviceHistory
+from .responses import json_bytes
+
+# ページング設定（環境変数から取得）
+DEFAULT_PAGE_SIZE = int(os.getenv("HISTORY_DEFAULT_PAGE_SIZE", "1000"))
+MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "10000"))
+STREAM_BATCH_SIZE = int(os.getenv("HISTORY_STREAM_BATCH_SIZE", "1000"))   # ストリーミング時に一度に読み出す行数
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# 履歴API（DeviceHistory.to_dict() と同じ形式）
+HISTORY_COLUMNS = (
+    DeviceHistory.id, DeviceHistory.device_id, DeviceHistory.device_addr, DeviceHistory.battery,
+    DeviceHistory.red, DeviceHistory.yellow, DeviceHistory.green,
+    DeviceHistory.status_code, DeviceHistory.status_text, DeviceHistory.timestamp,
+)
+
+# データ受信ログAPI（時刻はJST）
+DATA_LOG_COLUMNS = (
+    DeviceHistory.timestamp, DeviceHistory.status_code, DeviceHistory.status_text, DeviceHistory.battery,
+    DeviceHistory.red, DeviceHistory.yellow, DeviceHistory.green, DeviceHistory.device_id, DeviceHistory.id,
+)
+
+
+def history_row(row) -> dict:
+    """HISTORY_COLUMNS の1行を DeviceHistory.to_dict() と同じ形式に変換"""
+    return {
+        "id": row[0],
+        "device_id": row[1],
+        "device_addr": row[2],
+        "battery": row[3],
+        "red": row[4],
+        "yellow": row[5],
+        "green": row[6],
+        "status_code": row[7],
+        "status_text": row[8],
+        "timestamp": row[9].isoformat() if row[9] else None
+    }
+
+
+def data_log_row(row) -> dict:
+    """DATA_LOG_COLUMNS の1行をデータ受信ログ形式に変換（UTC -> JST）"""
+    return {
+        "timestamp": business_calendar.to_local(row[0]).strftime('%Y-%m-%d %H:%M:%S'),
+        "status_code": row[1],
+        "status_text": row[2],
+        "battery": row[3],
+        "red": row[4],
+        "yellow": row[5],
+        "green": row[6],
+        "device_id": row[7]
+    }
+
+
+def ensure_history_indexes(engine):
+    """既存DBに device_history の複合インデックスを追加（create_all は既存テーブルには作らないため）"""
+    for index in DeviceHistory.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+
+# ---------- カーソル ----------
+
+def encode_cursor(timestamp: datetime, row_id: int) -> str:
+    """(timestamp, id) を不透明なカーソル文字列に変換"""
+    raw = f"{timestamp.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Tuple[datetime, int]]:
+    """カーソル文字列を (timestamp, id) に戻す（不正な場合は ValueError）"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, row_id = raw.split("|")
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"カーソルが不正です: {cursor}") from e
+
+
+def keyset(query, position: Optional[Tuple[datetime, int]], descending: bool):
+    """(timestamp, id) 順に並べ、カーソルより後の行だけに絞り込む"""
+    if descending:
+        query = query.order_by(DeviceHistory.timestamp.desc(), DeviceHistory.id.desc())
+    else:
+        query = query.order_by(DeviceHistory.timestamp, DeviceHistory.id)
+    if position is None:
+        return query
+
+    timestamp, row_id = position
+    if descending:
+        # 先頭の条件はインデックスで範囲を絞るためのもの
+        return query.filter(
+            DeviceHistory.timestamp <= timestamp,
+            or_(DeviceHistory.timestamp < timestamp, and_(DeviceHistory.timestamp == timestamp, DeviceHistory.id < row_id))
+        )
+    return query.filter(
+        DeviceHistory.timestamp >= timestamp,
+        or_(DeviceHistory.timestamp > timestamp, and_(DeviceHistory.timestamp == timestamp, DeviceHistory.id > row_id))
+    )
+
+
+# ---------- ページ取得 / ストリーミング ----------
+
+def fetch_page(query, row_func: Callable, limit: int, position: Optional[Tuple[datetime, int]],
+               descending: bool) -> Tuple[List[dict], Optional[str]]:
+    """1ページ分の行と次ページのカーソル（最終ページならNone）
+
+    query は DeviceHistory.timestamp と DeviceHistory.id を列に含むこと。
+    """
+    rows = keyset(query, position, descending).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].timestamp, rows[-1].id)
+    return [row_func(row) for row in rows], next_cursor
+
+
+def iter_ndjson(query_factory: Callable, row_func: Callable, position: Optional[Tuple[datetime, int]],
+                descending: bool, limit: Optional[int] = None) -> Iterator[bytes]:
+    """行を1行1JSONで少しずつ返すジェネレーター
+
+    レスポンス送信中も読み続けるため、リクエストのセッションとは別にセッションを開く。
+    query_factory はセッションを受け取ってクエリを返す関数。
+    """
+    db = SessionLocal()
+    try:
+        query = keyset(query_factory(db), position, descending)
+        if limit is not None:
+            query = query.limit(limit)
+        chunk = []
+        for row in query.yield_per(STREAM_BATCH_SIZE):
+            chunk.append(json_bytes(row_func(row)))
+            if len(chunk) >= STREAM_BATCH_SIZE:
+                yield b"\n".join(chunk) + b"\n"
+                chunk = []
+        if chunk:
+            yield b"\n".join(chunk) + b"\n"
+    finally:
+        db.close()
+
+
+def ndjson_response(query_factory: Callable, row_func: Callable, position: Optional[Tuple[datetime, int]],
+                    descending: bool, limit: Optional[int] = None) -> StreamingResponse:
+    """NDJSON形式のストリーミングレスポンス"""
+    return StreamingResponse(
+        iter_ndjson(query_factory, row_func, position, descending, limit),
+        media_type=NDJSON_MEDIA_TYPE
+    )
@@ -0,0 +1,130 @@
+"""
+ダッシュボードの当日集計をWebSocketで配信（クライアントのポーリングの代わり）
+
+全体ステータス（円グラフ）・時間帯別推移・各デバイスの現在稼働率は、これまで各ブラウザが1分ごとに
+APIを呼んでいた。サーバーで LIVE_PUSH_SECONDS ごと、または状態が変わった時（LIVE_PUSH_DEBOUNCE_SECONDS 後に
+まとめて）1回だけ計算して /ws で配信する。ブラウザがN台でも計算は1回。
+
+メッセージ（data は各APIのレスポンスと同じ形式）:
+- overall_status: 全体と設置場所ごとに1通（location=None が全体）  … /api/overall/current-status
+- hourly_status:  全体と設置場所ごとに1通                          … /api/overall/hourly-status（当日）
+- current_rates:  全登録デバイス分を1通                            … /api/devices/current-operation-rate
+
+設置場所を購読しているクライアントには、その設置場所の集計とデバイスの分だけが届く（ConnectionManager）。
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .dashboard import (
+    DashboardSnapshot, overall_current_status, overall_hourly_status, current_operation_rates, load_current_traces,
+)
+from .connection_manager import ConnectionManager
+from .database import SessionLocal, set_query_source
+
+logger = logging.getLogger(__name__)
+
+# 配信設定（環境変数から取得）
+LIVE_PUSH_SECONDS = float(os.getenv("LIVE_PUSH_SECONDS", "60"))                     # 定期配信の間隔
+LIVE_PUSH_DEBOUNCE_SECONDS = float(os.getenv("LIVE_PUSH_DEBOUNCE_SECONDS", "5"))    # 状態変化から配信までの待ち（まとめる）
+
+
+def live_messages(db, snapshot: Optional[DashboardSnapshot] = None) -> List[dict]:
+    """配信するメッセージ一式（1つのスナップショットから計算）"""
+    snapshot = snapshot or DashboardSnapshot(db)
+    locations = [None] + sorted({reg.location for reg in snapshot.registrations if reg.location})
+
+    messages = []
+    for location in locations:
+        device_addrs = snapshot.device_addrs(location)
+        messages.append({
+            "type": "overall_status",
+            "location": location,
+            "data": overall_current_status(snapshot, device_addrs),
+        })
+        messages.append({
+            "type": "hourly_status",
+            "location": location,
+            "data": overall_hourly_status(snapshot, device_addrs),
+        })
+
+    device_addrs = snapshot.device_addrs()
+    messages.append({
+        "type": "current_rates",
+        "data": current_operation_rates(
+            device_addrs, load_current_traces(db, device_addrs, snapshot.now_utc), snapshot.now_utc
+        ),
+    })
+    return messages
+
+
+def _compute() -> Tuple[List[dict], Dict[str, str]]:
+    """メッセージ一式と、デバイスの設置場所（購読の絞り込み用）"""
+    db = SessionLocal()
+    try:
+        snapshot = DashboardSnapshot(db)
+        return live_messages(db, snapshot), {reg.device_addr: reg.location for reg in snapshot.registrations}
+    finally:
+        db.close()
+
+
+class LivePusher:
+    """当日集計の配信（定期 + 状態変化時、同時に複数回は計算しない）"""
+
+    def __init__(self, manager: ConnectionManager):
+        self._manager = manager
+        self._lock = asyncio.Lock()
+        self._pending: Optional[asyncio.TimerHandle] = None
+        self.latest: List[dict] = []     # 直近に配信したメッセージ（接続直後のクライアントに送る）
+        self.latest_at = 0.0
+        self.pushes = 0
+
+    async def push(self):
+        """計算して全クライアントに配信（接続がなければ何もしない）"""
+        set_query_source("job:push_live_dashboard")
+        if len(self._manager) == 0:
+            return
+        async with self._lock:
+            # DBの読み込み・集計はワーカースレッドで行い、MQTT受信を待たせない
+            try:
+                messages, device_locations = await asyncio.to_thread(_compute)
+            except Exception as e:
+                logger.error(f"ダッシュボード配信データの計算エラー: {e}")
+                return
+            self.latest = messages
+            self.latest_at = time.monotonic()
+            self.pushes += 1
+            for message in messages:
+                if message["type"] == "current_rates":
+                    await self._manager.broadcast_devices(
+                        message, device_locations, path=("data", "devices"), latest_only=True
+                    )
+                else:
+                    await self._manager.broadcast(message, location=message["location"], latest_only=True)
+
+    def initial_messages(self) -> List[dict]:
+        """接続直後のクライアントに送るメッセージ（古ければ送らずに配信を予約）"""
+        if self.ensure_fresh():
+            return self.latest
+        return []
+
+    def ensure_fresh(self) -> bool:
+        """直近の配信が LIVE_PUSH_SECONDS 以内なら True、古ければ配信を予約して False
+        （接続がない間は計算しないため、再接続したクライアントには古いままになっている）"""
+        if self.latest and time.monotonic() - self.latest_at < LIVE_PUSH_SECONDS:
+            return True
+        self.notify_change()
+        return False
+
+    def notify_change(self):
+        """状態が変わった時に呼ぶ（LIVE_PUSH_DEBOUNCE_SECONDS の間の変化は1回の配信にまとめる）"""
+        if self._pending is not None:
+            return
+        loop = asyncio.get_running_loop()
+        self._pending = loop.call_later(LIVE_PUSH_DEBOUNCE_SECONDS, self._fire)
+
+    def _fire(self):
+        self._pending = None
+        asyncio.ensure_future(self.push())
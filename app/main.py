@@ -4,7 +4,7 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Depends, HTTPException, Query
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, Response
 from fastapi import Request
 from sqlalchemy.orm import Session
 from typing import List, Optional
@@ -12,17 +12,50 @@ import logging
 import json
 import asyncio
 import re
-import pytz
-from datetime import datetime, timedelta, time as dtime, date as ddate
+from datetime import datetime, timedelta, date as ddate
 import calendar
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 
-from .database import engine, get_db, Base
-from .models import DeviceStatus, DeviceHistory, DeviceRegistration, DailyOperationRate, DailyGreenAppleCount
+from .database import engine, get_db, Base, SessionLocal, set_query_source, slow_query_log, SLOW_QUERY_MS
+from .models import (
+    DeviceStatus, DeviceHistory, DeviceRegistration, DailyOperationRate, DailyGreenAppleCount,
+    PeriodOperationRate, PeriodLocationSummary, StopEvent, ShiftSummary,
+)
 from .mqtt_client import MQTTClient
 from .device_config import REGISTERED_DEVICES, get_device_name, get_device_info, get_all_devices_from_db, get_device_info_from_db
 from .utils import validate_mac_address, get_status_from_lights
+from .business_calendar import business_calendar, BUSINESS_DAY_START
+from .aggregation import (
+    load_traces, load_day_traces, hourly_state_minutes, window_green_minutes, fold_groups, count_daily_apples,
+)
+from .rollups import PERIOD_TYPES, rollup_day, period_label, recent_period_starts
+from .stop_events import record_transition, query_stops, summarize_stops, stop_to_dict
+from .shifts import SHIFT_NAMES, update_shift_summaries, shift_to_dict, merge_rows
+from .dashboard import (
+    DashboardSnapshot, device_list, overall_current_status, overall_hourly_status,
+    current_operation_rate, current_operation_rates, load_current_traces, device_timeline, daily_operation_rates,
+    daily_green_apples, hourly_green_apples, device_hourly_operation_rate, TIMELINE_ZOOM_LEVELS, iter_range_timelines,
+)
+from .responses import json_response, json_bytes
+from .history_rows import (
+    HISTORY_COLUMNS, DATA_LOG_COLUMNS, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, NDJSON_MEDIA_TYPE,
+    history_row, data_log_row, decode_cursor, keyset, fetch_page, ndjson_response, ensure_history_indexes,
+)
+from .export import (
+    ExportFilter, ExportError, EXPORT_MAX_DAYS, validate as validate_export, iter_export, export_filename,
+    MEDIA_TYPES as EXPORT_MEDIA_TYPES,
+)
+from .device_registry import device_registry
+from .admission import heavy_endpoint, heavy_lane, HeavyStreamingResponse, ClientDisconnected
+from .live_push import LivePusher, LIVE_PUSH_SECONDS
+from .connection_manager import ConnectionManager, Subscription
+from .device_updates import DeviceUpdateCoalescer, WS_HEARTBEAT_SECONDS
+from .query_accounting import QueryAccountingMiddleware, install_query_accounting
+from .response_cache import (
+    past_day_cached, live_cached, install_history_revision_triggers, cache_validator, warm_past_day,
+)
 
 # ロギング設定
 logging.basicConfig(
@@ -38,34 +71,26 @@ app = FastAPI(
     version="1.0.0"
 )
 
-# 静的ファイルとテンプレート
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
-
-# WebSocket接続マネージャー
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+# SQL計測（QUERY_ACCOUNTING=1 または X-Query-Accounting: 1 ヘッダーで Server-Timing / X-Query-Count を出力）
+install_query_accounting(engine)
+app.add_middleware(QueryAccountingMiddleware)
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        logger.info(f"WebSocket接続: {len(self.active_connections)}台のクライアント")
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-        logger.info(f"WebSocket切断: {len(self.active_connections)}台のクライアント")
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected_handler(request: Request, exc: ClientDisconnected):
+    """重い集計の実行中に切断したクライアントへの応答（実際には届かない）"""
+    return Response(status_code=499)
 
-    async def broadcast(self, message: dict):
-        """全クライアントにメッセージを配信"""
-        for connection in self.active_connections:
-            try:
-                await connection.send_json(message)
-            except Exception as e:
-                logger.error(f"メッセージ送信エラー: {e}")
 
+# 静的ファイルとテンプレート
+app.mount("/static", StaticFiles(directory="static"), name="static")
+templates = Jinja2Templates(directory="templates")
 
+# WebSocket接続マネージャー（クライアントごとの送信キュー）
 manager = ConnectionManager()
+live_pusher = LivePusher(manager)
+# デバイス状態の配信（WS_COALESCE_MS の間の更新を1通にまとめる）
+device_updates = DeviceUpdateCoalescer(manager)
 mqtt_client = None
 scheduler = None
 
@@ -78,14 +103,13 @@ async def reset_all_devices_to_idle():
     毎日6:00に全デバイスを休止状態（Not Working）にリセット
     次のMQTTデータ受信まで休止状態を維持
     """
+    set_query_source("job:reset_devices_daily")
     try:
         db = next(get_db())
-        jst = pytz.timezone('Asia/Tokyo')
-        utc = pytz.UTC
-        current_time_jst = datetime.now(jst)
+        current_time_jst = business_calendar.now()
 
-        # 今日の6:00 JSTを計算
-        today_6am_jst = jst.localize(datetime.combine(current_time_jst.date(), datetime.min.time())).replace(hour=6)
+        # 今日の6:00（営業日開始）をUTCで取得
+        today_6am_utc = business_calendar.day(current_time_jst.date()).span.start_utc
 
         logger.info(f"=== 6:00 デバイス休止処理開始 ({current_time_jst.strftime('%Y-%m-%d %H:%M:%S JST')}) ===")
 
@@ -120,7 +144,6 @@ async def reset_all_devices_to_idle():
             # ライト状態が変わった場合のみ履歴に記録
             if status_changed:
                 # 重複防止: 今日の6:00前後1分以内に同じ状態のデータが既に存在するかチェック
-                today_6am_utc = today_6am_jst.astimezone(utc).replace(tzinfo=None)
                 existing_reset = db.query(DeviceHistory).filter(
                     DeviceHistory.device_addr == device.device_addr,
                     DeviceHistory.timestamp >= today_6am_utc - timedelta(minutes=1),
@@ -144,6 +167,8 @@ async def reset_all_devices_to_idle():
                         timestamp=datetime.utcnow()
                     )
                     db.add(history_entry)
+                    # 継続中の停止イベントを終了
+                    record_transition(db, device.device_addr, False, False, False, history_entry.timestamp)
                     logger.info(f"  - {device_name} ({device.device_addr}): {old_status} → Not Working (履歴記録)")
                     reset_count += 1
                 else:
@@ -151,10 +176,9 @@ async def reset_all_devices_to_idle():
             else:
                 logger.info(f"  - {device_name} ({device.device_addr}): すでに Not Working (変更なし)")
 
-            # WebSocketで各デバイスの更新を配信
+            # WebSocketで各デバイスの更新を配信（全デバイス分を1通にまとめて送る）
             try:
-                await manager.broadcast({
-                    "type": "device_update",
+                device_updates.update({
                     "device_id": device.device_id,
                     "device_addr": device.device_addr,
                     "device_name": device_name,
@@ -173,6 +197,7 @@ async def reset_all_devices_to_idle():
 
         db.commit()
         logger.info(f"=== 休止処理完了: {reset_count}台のデバイスをリセットしました ===")
+        live_pusher.notify_change()
 
     except Exception as e:
         logger.error(f"デバイス休止処理エラー: {e}")
@@ -183,188 +208,39 @@ async def reset_all_devices_to_idle():
             db.close()
 
 
-def _calc_green_minutes(db, device_addr: str, window_start_utc: datetime, window_end_utc: datetime) -> float:
-    """指定時間ウィンドウ内のgreen=True（稼働中）の合計分数を計算"""
-    histories = db.query(DeviceHistory).filter(
-        DeviceHistory.device_addr == device_addr,
-        DeviceHistory.timestamp >= window_start_utc,
-        DeviceHistory.timestamp < window_end_utc
-    ).order_by(DeviceHistory.timestamp).all()
-
-    # ウィンドウ開始時点の状態を決定（直前のレコードから）
-    prev = db.query(DeviceHistory).filter(
-        DeviceHistory.device_addr == device_addr,
-        DeviceHistory.timestamp < window_start_utc
-    ).order_by(DeviceHistory.timestamp.desc()).first()
-
-    records = []
-    # ウィンドウ開始時点のレコードを追加
-    if prev:
-        records.append({'timestamp': window_start_utc, 'green': prev.green})
-    elif histories:
-        records.append({'timestamp': window_start_utc, 'green': False})
-
-    for h in histories:
-        records.append({'timestamp': h.timestamp, 'green': h.green})
-
-    if not records:
-        return 0.0
-
-    green_minutes = 0.0
-    for i, rec in enumerate(records):
-        if i < len(records) - 1:
-            next_ts = records[i + 1]['timestamp']
-        else:
-            next_ts = window_end_utc
-        duration = max(0, (next_ts - rec['timestamp']).total_seconds() / 60)
-        if rec['green']:
-            green_minutes += duration
-
-    return green_minutes
-
-
-def _calc_apples_for_day(db, device_addrs: list, day_start_jst, day_end_jst) -> int:
-    """1日分のGREEN APPLE収穫量を計算（全デバイス合算の時間帯別ロジック）"""
-    jst = pytz.timezone('Asia/Tokyo')
-    utc = pytz.UTC
-    now_jst = datetime.now(jst)
-    daily_apples = 0
-    current_hour = day_start_jst
-
-    while current_hour < day_end_jst and current_hour <= now_jst:
-        next_hour = current_hour + timedelta(hours=1)
-
-        total_running_minutes = 0
-        total_stop_yellow_minutes = 0
-        total_stop_red_minutes = 0
-        total_idle_minutes = 0
-
-        hour_start_utc = current_hour.astimezone(utc).replace(tzinfo=None)
-        hour_end_utc = next_hour.astimezone(utc).replace(tzinfo=None)
-
-        for device_addr in device_addrs:
-            histories = db.query(DeviceHistory).filter(
-                DeviceHistory.device_addr == device_addr,
-                DeviceHistory.timestamp >= hour_start_utc,
-                DeviceHistory.timestamp < hour_end_utc
-            ).order_by(DeviceHistory.timestamp).all()
-
-            prev_history = db.query(DeviceHistory).filter(
-                DeviceHistory.device_addr == device_addr,
-                DeviceHistory.timestamp < hour_start_utc
-            ).order_by(DeviceHistory.timestamp.desc()).first()
-
-            period_end = min(hour_end_utc, now_jst.astimezone(utc).replace(tzinfo=None))
-
-            if not histories and not prev_history:
-                duration_minutes = (period_end - hour_start_utc).total_seconds() / 60
-                total_idle_minutes += duration_minutes
-                continue
-
-            if prev_history:
-                start_status = {
-                    'timestamp': hour_start_utc,
-                    'green': prev_history.green,
-                    'yellow': prev_history.yellow,
-                    'red': prev_history.red
-                }
-            elif histories:
-                start_status = {
-                    'timestamp': hour_start_utc,
-                    'green': histories[0].green,
-                    'yellow': histories[0].yellow,
-                    'red': histories[0].red
-                }
-            else:
-                start_status = {
-                    'timestamp': hour_start_utc,
-                    'green': False, 'yellow': False, 'red': False
-                }
-
-            time_records = [start_status]
-            for h in histories:
-                time_records.append({
-                    'timestamp': h.timestamp,
-                    'green': h.green,
-                    'yellow': h.yellow,
-                    'red': h.red
-                })
-
-            for idx in range(len(time_records)):
-                rec = time_records[idx]
-                next_ts = time_records[idx + 1]['timestamp'] if idx < len(time_records) - 1 else period_end
-                duration_minutes = max(0, (next_ts - rec['timestamp']).total_seconds() / 60)
-
-                if rec['green']:
-                    total_running_minutes += duration_minutes
-                elif rec['yellow']:
-                    total_stop_yellow_minutes += duration_minutes
-                elif rec['red']:
-                    total_stop_red_minutes += duration_minutes
-                else:
-                    total_idle_minutes += duration_minutes
-
-        total_minutes = total_running_minutes + total_stop_yellow_minutes + total_stop_red_minutes + total_idle_minutes
-        if total_minutes > 0:
-            running_percent = round(total_running_minutes / total_minutes * 100, 1)
-        else:
-            running_percent = 0
-
-        green_apples = 0
-        if running_percent >= 50:
-            green_apples = 5
-        elif running_percent >= 40:
-            green_apples = 3
-        elif running_percent >= 35:
-            green_apples = 2
-        elif running_percent > 30:
-            green_apples = 1
-
-        daily_apples += green_apples
-        current_hour = next_hour
-
-    return daily_apples
-
-
 async def calculate_daily_aggregates():
     """
     毎日6:00 JSTに前日の集計データを計算してDBに保存
     - 稼働率: 定時内(8:00-翌2:00)と含残業(8:00-翌5:00)
     - GREEN APPLE: 24時間(6:00-翌6:00)の収穫量
     """
+    set_query_source("job:calculate_daily_aggregates")
     db = None
     try:
         db = next(get_db())
-        jst = pytz.timezone('Asia/Tokyo')
-        utc = pytz.UTC
 
-        now_jst = datetime.now(jst)
-        yesterday = (now_jst - timedelta(days=1)).date()
+        now_jst = business_calendar.now()
+        yesterday = business_calendar.business_date(now_jst) - timedelta(days=1)
 
         logger.info(f"=== 日次集計処理開始 ({now_jst.strftime('%Y-%m-%d %H:%M:%S JST')}) 対象日: {yesterday} ===")
 
-        # 時間ウィンドウ（JST）
-        regular_start = jst.localize(datetime.combine(yesterday, dtime(8, 0)))   # 8:00 JST
-        regular_end = regular_start + timedelta(hours=18)                         # 翌2:00 JST
-        overtime_start = regular_start                                             # 8:00 JST
-        overtime_end = overtime_start + timedelta(hours=21)                        # 翌5:00 JST
-        day_start = jst.localize(datetime.combine(yesterday, dtime(6, 0)))        # 6:00 JST
-        day_end = day_start + timedelta(hours=24)                                  # 翌6:00 JST
+        # 時間ウィンドウ（営業日カレンダーで事前計算済みのUTC境界）
+        bday = business_calendar.day(yesterday)
+        window_regular = bday.regular.minutes
+        window_overtime = bday.overtime.minutes
 
-        # UTCに変換（DBはnaive UTCで保存されている）
-        regular_start_utc = regular_start.astimezone(utc).replace(tzinfo=None)
-        regular_end_utc = regular_end.astimezone(utc).replace(tzinfo=None)
-        overtime_start_utc = overtime_start.astimezone(utc).replace(tzinfo=None)
-        overtime_end_utc = overtime_end.astimezone(utc).replace(tzinfo=None)
+        registrations = device_registry.snapshot(db).registrations(enabled_only=True)
+        all_addrs = [reg.device_addr for reg in registrations]
 
-        registrations = db.query(DeviceRegistration).filter(
-            DeviceRegistration.is_enabled == True
-        ).all()
+        # --- 1段目: 全デバイスの営業日分の履歴を1回だけ読み込む ---
+        now_utc = datetime.utcnow()
+        traces = load_day_traces(db, all_addrs, bday)
 
         # --- 稼働率の計算・保存 ---
         for reg in registrations:
-            green_min_regular = _calc_green_minutes(db, reg.device_addr, regular_start_utc, regular_end_utc)
-            green_min_overtime = _calc_green_minutes(db, reg.device_addr, overtime_start_utc, overtime_end_utc)
+            trace = traces[reg.device_addr]
+            green_min_regular = window_green_minutes(trace, bday.regular.start_utc, bday.regular.end_utc)
+            green_min_overtime = window_green_minutes(trace, bday.overtime.start_utc, bday.overtime.end_utc)
 
             existing = db.query(DailyOperationRate).filter(
                 DailyOperationRate.device_addr == reg.device_addr,
@@ -373,43 +249,49 @@ async def calculate_daily_aggregates():
 
             if existing:
                 existing.running_minutes_regular = green_min_regular
+                existing.window_minutes_regular = window_regular
                 existing.running_minutes_overtime = green_min_overtime
+                existing.window_minutes_overtime = window_overtime
             else:
                 db.add(DailyOperationRate(
                     device_addr=reg.device_addr,
                     target_date=yesterday,
                     running_minutes_regular=green_min_regular,
-                    window_minutes_regular=1080.0,
+                    window_minutes_regular=window_regular,
                     running_minutes_overtime=green_min_overtime,
-                    window_minutes_overtime=1260.0,
+                    window_minutes_overtime=window_overtime,
                 ))
 
-            rate_r = round(green_min_regular / 1080 * 100, 1) if 1080 > 0 else 0
-            rate_o = round(green_min_overtime / 1260 * 100, 1) if 1260 > 0 else 0
+            rate_r = round(green_min_regular / window_regular * 100, 1) if window_regular > 0 else 0
+            rate_o = round(green_min_overtime / window_overtime * 100, 1) if window_overtime > 0 else 0
             logger.info(f"  稼働率 {reg.name} ({reg.device_addr}): 定時内={rate_r}%, 含残業={rate_o}%")
 
         # --- GREEN APPLE収穫量の計算・保存 ---
-        # 設置場所ごと + 全体
-        location_groups = {}
+        # 1段目: デバイスごとの時間帯別分数
+        per_device = {
+            addr: hourly_state_minutes(trace, bday, now_utc) for addr, trace in traces.items()
+        }
+
+        # 2段目: 全体 + 設置場所別に畳み込む（""=全体、設置場所未設定のデバイスは全体にのみ含める）
+        groups = {"": all_addrs}
         for reg in registrations:
-            loc = reg.location or ""
-            if loc not in location_groups:
-                location_groups[loc] = []
-            location_groups[loc].append(reg.device_addr)
+            if reg.location:
+                groups.setdefault(reg.location, []).append(reg.device_addr)
 
-        # 全体
-        all_addrs = [reg.device_addr for reg in registrations]
-        total_apples = _calc_apples_for_day(db, all_addrs, day_start, day_end)
-        _upsert_daily_apple(db, yesterday, "", total_apples)
-        logger.info(f"  GREEN APPLE 全体: {total_apples}個")
+        for loc, hourly_totals in fold_groups(per_device, groups).items():
+            apples = count_daily_apples(hourly_totals)
+            _upsert_daily_apple(db, yesterday, loc, apples)
+            logger.info(f"  GREEN APPLE {loc or '全体'}: {apples}個")
 
-        # 設置場所別
-        for loc, addrs in location_groups.items():
-            loc_apples = _calc_apples_for_day(db, addrs, day_start, day_end)
-            _upsert_daily_apple(db, yesterday, loc, loc_apples)
-            logger.info(f"  GREEN APPLE {loc}: {loc_apples}個")
+        # --- 週/月/年ロールアップの更新（対象日を含む期間） ---
+        db.flush()
+        rollup_day(db, yesterday)
+        logger.info(f"  ロールアップ更新: {yesterday} を含む週/月/年")
 
         db.commit()
+
+        # --- 確定した営業日のタイムラインを代表的なズームレベルで事前計算 ---
+        _precompute_timelines(db, bday, traces)
         logger.info(f"=== 日次集計処理完了 ===")
 
     except Exception as e:
@@ -421,6 +303,27 @@ async def calculate_daily_aggregates():
             db.close()
 
 
+async def update_shift_rollups():
+    """
+    1分ごとにシフト別ロールアップを更新
+    - 直前のシフトが未確定なら確定（シフト終了時）
+    - 稼働中のシフトは最新の状態に更新
+    """
+    set_query_source("job:update_shift_rollups")
+    db = None
+    try:
+        db = next(get_db())
+        update_shift_summaries(db)
+        db.commit()
+    except Exception as e:
+        logger.error(f"シフト集計更新エラー: {e}")
+        if db:
+            db.rollback()
+    finally:
+        if db:
+            db.close()
+
+
 def _upsert_daily_apple(db, target_date, location: str, apple_count: int):
     """DailyGreenAppleCountをupsert"""
     existing = db.query(DailyGreenAppleCount).filter(
@@ -437,14 +340,33 @@ def _upsert_daily_apple(db, target_date, location: str, apple_count: int):
         ))
 
 
+def _precompute_timelines(db, bday, traces):
+    """確定済み営業日のタイムラインを TIMELINE_ZOOM_LEVELS ごとにレスポンスキャッシュへ格納"""
+    validator = cache_validator(db, bday.date)
+    now_jst = business_calendar.to_local(datetime.utcnow())
+    for addr, trace in traces.items():
+        for level in TIMELINE_ZOOM_LEVELS:
+            params = [("date", bday.date.isoformat())]
+            if level:
+                params.append(("min_segment_minutes", str(level)))
+            warm_past_day(
+                f"/api/devices/{addr}/timeline", params, validator,
+                device_timeline(addr, trace, bday, now_jst, level)
+            )
+    logger.info(f"  タイムライン事前計算: {len(traces)}台 × {len(TIMELINE_ZOOM_LEVELS)}レベル")
+
+
 # データベース初期化
 @app.on_event("startup")
 async def startup_event():
     """アプリケーション起動時の処理"""
+    set_query_source("startup")
     global mqtt_client, scheduler
 
     # データベーステーブルを作成
     Base.metadata.create_all(bind=engine)
+    install_history_revision_triggers(engine)
+    ensure_history_indexes(engine)
     logger.info("データベースを初期化しました")
 
     # 登録済みデバイスを初期化
@@ -461,23 +383,44 @@ async def startup_event():
         logger.warning("MQTT無しモードで起動します（既存DBデータのみ表示）")
 
     # スケジューラーを起動（毎日6:00 JSTに全デバイスをリセット）
-    scheduler = AsyncIOScheduler(timezone=pytz.timezone('Asia/Tokyo'))
+    scheduler = AsyncIOScheduler(timezone=business_calendar.tz)
     scheduler.add_job(
         reset_all_devices_to_idle,
-        CronTrigger(hour=6, minute=0),  # 毎日6:00 JST
+        CronTrigger(hour=BUSINESS_DAY_START.hour, minute=BUSINESS_DAY_START.minute),  # 毎日6:00 JST
         id='reset_devices_daily',
         name='毎日6:00にデバイスを休止状態にリセット',
         replace_existing=True
     )
     scheduler.add_job(
         calculate_daily_aggregates,
-        CronTrigger(hour=6, minute=0, second=15),  # 毎日6:00:15 JST（リセット直後）
+        CronTrigger(hour=BUSINESS_DAY_START.hour, minute=BUSINESS_DAY_START.minute, second=15),  # 毎日6:00:15 JST（リセット直後）
         id='calculate_daily_aggregates',
         name='毎日6:00に前日の集計データを計算',
         replace_existing=True
     )
+    scheduler.add_job(
+        update_shift_rollups,
+        IntervalTrigger(minutes=1),
+        id='update_shift_rollups',
+        name='1分ごとにシフト別集計を更新（シフト終了時に確定）',
+        replace_existing=True
+    )
+    scheduler.add_job(
+        live_pusher.push,
+        IntervalTrigger(seconds=LIVE_PUSH_SECONDS),
+        id='push_live_dashboard',
+        name='ダッシュボードの当日集計をWebSocketで配信',
+        replace_existing=True
+    )
+    scheduler.add_job(
+        device_updates.heartbeat,
+        IntervalTrigger(seconds=WS_HEARTBEAT_SECONDS),
+        id='device_heartbeat',
+        name='デバイスのバッテリー残量・最終受信時刻をWebSocketで配信',
+        replace_existing=True
+    )
     scheduler.start()
-    logger.info("スケジューラーを起動しました - 毎日6:00 JSTにリセット+日次集計")
+    logger.info("スケジューラーを起動しました - 毎日6:00 JSTにリセット+日次集計、1分ごとにシフト集計・ダッシュボード配信")
 
 
 def initialize_devices():
@@ -504,6 +447,7 @@ def initialize_devices():
                 logger.info(f"デバイス登録情報を追加: {info['name']} ({mac_addr})")
 
         db.commit()
+        device_registry.invalidate()
 
         # ステップ2: DeviceStatusテーブルを初期化
         all_devices = get_all_devices_from_db(db)
@@ -558,6 +502,7 @@ async def handle_mqtt_message(data: dict):
     - データベースに保存
     - WebSocketクライアントに配信
     """
+    set_query_source("mqtt")
     device_addr = data.get("device_addr", "Unknown")
 
     # デバイスごとのロックを取得または作成
@@ -580,16 +525,8 @@ async def handle_mqtt_message(data: dict):
             status_text = data.get("status_text", "Unknown")
 
             # その日の6:00のリセットデータが存在しない場合は追加
-            jst = pytz.timezone('Asia/Tokyo')
-            utc = pytz.UTC
-            now_jst = datetime.now(jst)
-            today_6am_jst = jst.localize(datetime.combine(now_jst.date(), datetime.min.time())).replace(hour=6)
-
-            # 6:00より前の場合は前日の6:00を対象とする
-            if now_jst.hour < 6:
-                today_6am_jst = today_6am_jst - timedelta(days=1)
-
-            today_6am_utc = today_6am_jst.astimezone(utc).replace(tzinfo=None)
+            # （6:00より前の場合は前日の6:00を対象とする）
+            today_6am_utc = business_calendar.today().span.start_utc
 
             # その日の6:00のデータが存在するかチェック
             existing_6am = db.query(DeviceHistory).filter(
@@ -611,6 +548,7 @@ async def handle_mqtt_message(data: dict):
                     timestamp=today_6am_utc
                 )
                 db.add(reset_history)
+                record_transition(db, device_addr, False, False, False, today_6am_utc)
                 db.commit()
                 logger.info(f"[6:00リセット追加] デバイス {device_addr}: その日の最初の信号受信時に6:00の休止状態を記録")
 
@@ -682,21 +620,25 @@ async def handle_mqtt_message(data: dict):
                             yellow=yellow,
                             green=green,
                             status_code=status_code,
-                            status_text=status_text
+                            status_text=status_text,
+                            timestamp=datetime.utcnow()
                         )
                         db.add(history)
+                        # 停止イベント（黄/赤の連続区間）を更新
+                        record_transition(db, device_addr, red, yellow, green, history.timestamp)
                         db.commit()
                         logger.info(f"[履歴追加] デバイス {device_addr} ({status_text}) R:{red} Y:{yellow} G:{green}")
+                        # グラフ・現在稼働率も配信し直す（短時間の変化はまとめて1回）
+                        live_pusher.notify_change()
                     except Exception as e:
                         logger.error(f"[履歴追加エラー] デバイス {device_addr}: {e}")
                         db.rollback()
             else:
                 logger.debug(f"[変更なし] デバイス {device_addr} ({status_text}) - 履歴には記録しません")
 
-            # WebSocketクライアントに配信（設備情報含む）
+            # WebSocketクライアントに配信（設備情報含む、WS_COALESCE_MS の間の受信はまとめて変わった項目だけ送る）
             device_info = get_device_info_from_db(db, device_addr)
-            await manager.broadcast({
-                "type": "device_update",
+            device_updates.update({
                 "device_id": device_id,
                 "device_addr": device_addr,
                 "device_name": device_info["name"],
@@ -731,64 +673,119 @@ async def root(request: Request):
 @app.get("/api/devices")
 async def get_devices(db: Session = Depends(get_db)):
     """全デバイスの現在のステータスを取得（設備情報含む）"""
-    devices = db.query(DeviceStatus).all()
+    return device_list(db)
 
-    result = []
-    for d in devices:
-        device_info = get_device_info_from_db(db, d.device_addr)
-        result.append({
-            "device_id": d.device_id,
-            "device_addr": d.device_addr,
-            "device_name": device_info["name"],
-            "location": device_info["location"],
-            "description": device_info["description"],
-            "index": device_info["index"],
-            "gateway_id": d.gateway_id,
-            "battery": d.battery,
-            "red": d.red,
-            "yellow": d.yellow,
-            "green": d.green,
-            "status_code": d.status_code,
-            "status_text": d.status_text,
-            "last_update": d.last_update.isoformat() if d.last_update else None,
-            "is_active": d.is_active
-        })
 
-    # indexでソート（設備1号機→7号機の順）
-    result.sort(key=lambda x: x["index"])
-    return result
+# API - デバイス履歴
+def _cursor_position(cursor: Optional[str]):
+    """カーソルパラメーターを (timestamp, id) に変換（不正なら400）"""
+    try:
+        return decode_cursor(cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _page_headers(next_cursor: Optional[str]) -> Optional[dict]:
+    return {"X-Next-Cursor": next_cursor} if next_cursor else None
 
 
-# API - デバイス履歴
 @app.get("/api/devices/{device_id}/history")
 async def get_device_history(
+    request: Request,
     device_id: int,
     hours: int = 24,
+    limit: Optional[int] = Query(default=None, ge=1, description="1ページの件数（指定時はページング、次ページのカーソルは X-Next-Cursor ヘッダー）"),
+    cursor: Optional[str] = Query(default=None, description="前ページの X-Next-Cursor"),
+    format: str = Query(default="json", pattern="^(json|ndjson)$", description="json / ndjson（ストリーミング）"),
     db: Session = Depends(get_db)
 ):
-    """指定デバイスの履歴を取得"""
+    """指定デバイスの履歴を取得（新しい順）"""
     since = datetime.utcnow() - timedelta(hours=hours)
-    history = db.query(DeviceHistory).filter(
-        DeviceHistory.device_id == device_id,
-        DeviceHistory.timestamp >= since
-    ).order_by(DeviceHistory.timestamp.desc()).all()
+    position = _cursor_position(cursor)
+
+    def history_query(session):
+        # ORMオブジェクトを作らず列だけ取得
+        return session.query(*HISTORY_COLUMNS).filter(
+            DeviceHistory.device_id == device_id,
+            DeviceHistory.timestamp >= since
+        )
 
-    return [h.to_dict() for h in history]
+    if format == "ndjson":
+        return ndjson_response(history_query, history_row, position, descending=True, limit=limit)
+
+    if limit is None and position is None:
+        # ページング指定なし: 従来どおり全件を返す
+        rows = keyset(history_query(db), None, descending=True).all()
+        return json_response(request, [history_row(row) for row in rows])
+
+    items, next_cursor = fetch_page(
+        history_query(db), history_row, min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE), position, descending=True
+    )
+    return json_response(request, items, headers=_page_headers(next_cursor))
 
 
 # WebSocketエンドポイント
+def _resume_position(websocket: WebSocket):
+    """再接続したクライアントが最後に受け取った配信（?stream=...&seq=...、なければ None）"""
+    stream = websocket.query_params.get("stream")
+    seq = websocket.query_params.get("seq")
+    if not stream or not seq or not seq.isdigit():
+        return None
+    return stream, int(seq)
+
+
+async def _websocket_snapshot() -> List[dict]:
+    """配信を送り直せなかったクライアントに送るスナップショット（全デバイスの状態と直近の当日集計）"""
+    def load_devices():
+        db = SessionLocal()
+        try:
+            return device_list(db)
+        finally:
+            db.close()
+
+    devices = await asyncio.to_thread(load_devices)
+    return [{"type": "devices_snapshot", "devices": devices}] + live_pusher.initial_messages()
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket接続エンドポイント - リアルタイムデータ配信"""
-    await manager.connect(websocket)
+    resume = _resume_position(websocket)
+    client = await manager.connect(websocket, resume=resume, snapshot=_websocket_snapshot)
     try:
+        # 送信は全て送信キュー経由（同じソケットに複数のタスクから同時に送らない）
+        if resume is None:
+            # 新規接続: 直近の当日集計（グラフ・現在稼働率）を送る（デバイス一覧は画面の初期表示で取得済み）
+            for message in live_pusher.initial_messages():
+                client.send_message(message)
+        else:
+            # 再接続: 切断中の配信は送り直し済み。接続がない間に集計が止まっていれば配信し直す
+            live_pusher.ensure_fresh()
         while True:
             # クライアントからのメッセージを待機（接続維持のため）
             data = await websocket.receive_text()
             # Pingメッセージに応答
             if data == "ping":
-                await websocket.send_text("pong")
+                client.send("pong")
+                continue
+            # 購読条件の変更（{"type": "subscribe", "locations": [...], "devices": [...], "types": [...]}）
+            try:
+                message = json.loads(data)
+            except ValueError:
+                message = None
+            if not isinstance(message, dict) or message.get("type") != "subscribe":
+                client.send_message({"type": "error", "detail": "未対応のメッセージです"})
+                continue
+            try:
+                subscription = Subscription.from_message(message)
+            except ValueError as e:
+                client.send_message({"type": "error", "detail": str(e)})
+                continue
+            manager.subscribe(client, subscription)
+            client.send_message({"type": "subscribed", **subscription.to_dict()})
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
 
 
@@ -799,17 +796,55 @@ async def health_check():
     return {
         "status": "ok",
         "mqtt_connected": mqtt_client.connected if mqtt_client else False,
-        "websocket_clients": len(manager.active_connections),
+        "websocket_clients": len(manager),
+        "websocket_max_lag_seconds": manager.stats()["max_lag_seconds"],
+        "heavy_requests": heavy_lane.stats(),
         "timestamp": datetime.utcnow().isoformat()
     }
 
 
+# ========== WebSocket配信の状況（管理用） ==========
+
+@app.get("/api/admin/websocket-clients")
+async def get_websocket_clients():
+    """接続中のクライアントごとの送信待ち件数と遅れ（秒）、デバイス状態の配信件数"""
+    return {**manager.stats(), "device_updates": device_updates.stats()}
+
+
+# ========== 遅いSQLの記録（管理用） ==========
+
+@app.get("/api/admin/slow-queries")
+async def get_slow_queries(
+    limit: int = Query(50, ge=1, le=1000, description="取得件数（新しい順）"),
+    table: Optional[str] = Query(None, description="このテーブルを全件走査したSQLのみ（例: device_history）")
+):
+    """しきい値（SLOW_QUERY_MS）を超えたSQL文と実行計画"""
+    entries = slow_query_log.entries()
+    if table:
+        entries = [e for e in entries if table in e["full_scans"]]
+    return {
+        "threshold_ms": SLOW_QUERY_MS,
+        "count": len(entries),
+        "queries": [
+            {**e, "recorded_at": business_calendar.to_local(e["recorded_at"]).strftime('%Y-%m-%d %H:%M:%S')}
+            for e in entries[:limit]
+        ]
+    }
+
+
+@app.delete("/api/admin/slow-queries")
+async def clear_slow_queries():
+    """記録と実行計画のキャッシュをクリア"""
+    slow_query_log.clear()
+    return {"message": "遅いSQLの記録をクリアしました"}
+
+
 # ========== デバイス管理API ==========
 
 @app.get("/api/devices/config")
 async def get_device_config(db: Session = Depends(get_db)):
     """デバイス管理用一覧取得"""
-    devices = db.query(DeviceRegistration).order_by(DeviceRegistration.index).all()
+    devices = device_registry.snapshot(db).registrations(by_index=True)
 
     result = []
     for device in devices:
@@ -884,6 +919,7 @@ async def register_device(
         db.add(new_status)
 
         db.commit()
+        device_registry.invalidate()
         logger.info(f"新規デバイス登録: {name} ({device_addr})")
 
         return {
@@ -924,6 +960,7 @@ async def update_device(
         device.updated_at = datetime.utcnow()
 
         db.commit()
+        device_registry.invalidate()
         logger.info(f"デバイス更新: {name} ({device_addr})")
 
         return {
@@ -965,6 +1002,7 @@ async def delete_device(
             status.is_active = False
 
         db.commit()
+        device_registry.invalidate()
         logger.info(f"デバイス削除: {device.name} ({device_addr})")
 
         return {
@@ -981,17 +1019,20 @@ async def delete_device(
 # ========== 稼働状況タイムライン API ==========
 
 @app.get("/api/devices/{device_addr}/timeline")
+@past_day_cached()
 async def get_device_timeline(
+    request: Request,
     device_addr: str,
     date: Optional[str] = None,
+    min_segment_minutes: Optional[float] = Query(default=None, ge=0, description="これより短いセグメントをまとめる（分）"),
+    width: Optional[int] = Query(default=None, ge=1, description="描画幅（px）、1px未満のセグメントをまとめる"),
     db: Session = Depends(get_db)
 ):
-    """デバイスの稼働状況タイムライン取得（日勤/夜勤別）"""
-    device_addr = device_addr.upper()
+    """デバイスの稼働状況タイムライン取得（日勤/夜勤別）
 
-    # タイムゾーン設定
-    jst = pytz.timezone('Asia/Tokyo')
-    utc = pytz.UTC
+    短いセグメントをまとめた区間は status="mixed"（色は最も長いステータス、breakdown にステータス別分数）。
+    """
+    device_addr = device_addr.upper()
 
     # 日付パース（省略時は今日、ただし6:00より前なら前日）
     if date:
@@ -1000,131 +1041,83 @@ async def get_device_timeline(
         except ValueError:
             raise HTTPException(status_code=400, detail="日付形式が不正です（YYYY-MM-DD）")
     else:
-        now_jst = datetime.now(jst)
-        target_date = now_jst.date()
-        # 現在時刻が6:00より前なら、前日の日付を使用
-        if now_jst.hour < 6:
-            target_date = target_date - timedelta(days=1)
-
-    # 日勤: 6:00-18:00（JST）
-    day_start_jst = jst.localize(datetime.combine(target_date, datetime.min.time()).replace(hour=6))
-    day_end_jst = jst.localize(datetime.combine(target_date, datetime.min.time()).replace(hour=18))
-
-    # 夜勤: 18:00-翌6:00（JST）
-    night_start_jst = day_end_jst
-    night_end_jst = jst.localize(
-        datetime.combine(target_date + timedelta(days=1), datetime.min.time()).replace(hour=6)
-    )
+        target_date = business_calendar.business_date()
 
-    # UTC変換
-    day_start_utc = day_start_jst.astimezone(utc).replace(tzinfo=None)
-    day_end_utc = day_end_jst.astimezone(utc).replace(tzinfo=None)
-    night_start_utc = night_start_jst.astimezone(utc).replace(tzinfo=None)
-    night_end_utc = night_end_jst.astimezone(utc).replace(tzinfo=None)
+    # 日勤: 6:00-18:00 / 夜勤: 18:00-翌6:00（JST、UTC境界は事前計算済み）
+    bday = business_calendar.day(target_date)
+    traces = load_traces(db, [device_addr], bday.span.start_utc, bday.span.end_utc, with_prev_state=False)
+    threshold = max(min_segment_minutes or 0, bday.day_shift.minutes / width if width else 0)
+    return device_timeline(device_addr, traces[device_addr], bday, business_calendar.to_local(datetime.utcnow()), threshold)
 
-    # 日勤データ取得
-    day_history = db.query(DeviceHistory).filter(
-        DeviceHistory.device_addr == device_addr,
-        DeviceHistory.timestamp >= day_start_utc,
-        DeviceHistory.timestamp < day_end_utc
-    ).order_by(DeviceHistory.timestamp).all()
 
-    # 夜勤データ取得
-    night_history = db.query(DeviceHistory).filter(
-        DeviceHistory.device_addr == device_addr,
-        DeviceHistory.timestamp >= night_start_utc,
-        DeviceHistory.timestamp < night_end_utc
-    ).order_by(DeviceHistory.timestamp).all()
+# 範囲タイムラインで指定できる最大日数・最大デバイス数
+RANGE_TIMELINE_MAX_DAYS = 31
+RANGE_TIMELINE_MAX_DEVICES = 100
 
-    # セグメント化関数
-    def create_segments(history_data, start_time, end_time):
-        # 現在時刻（JST）を取得
-        now_jst = datetime.now(jst).replace(tzinfo=None)
-
-        # end_timeが未来の場合、現在時刻までに制限
-        actual_end_time = min(end_time, now_jst)
-
-        segments = []
-        if not history_data:
-            # データがない場合は全体をグレーに
-            return [{
-                "status": "none",
-                "color": "gray",
-                "start": start_time.isoformat(),
-                "end": actual_end_time.isoformat(),
-                "duration_minutes": int((actual_end_time - start_time).total_seconds() / 60)
-            }]
-
-        current_status = None
-        current_color = None
-        segment_start = start_time
-
-        for record in history_data:
-            status, color = get_status_from_lights(record.red, record.yellow, record.green)
-            record_time = utc.localize(record.timestamp).astimezone(jst).replace(tzinfo=None)
-
-            # ステータス変化を検出
-            if current_status is None:
-                # 最初のレコード
-                current_status = status
-                current_color = color
-            elif status != current_status:
-                # ステータス変化 - 前のセグメントを保存
-                segments.append({
-                    "status": current_status,
-                    "color": current_color,
-                    "start": segment_start.isoformat(),
-                    "end": record_time.isoformat(),
-                    "duration_minutes": int((record_time - segment_start).total_seconds() / 60)
-                })
-                segment_start = record_time
-                current_status = status
-                current_color = color
-
-        # 最後のセグメント（現在時刻まで）
-        if current_status is not None:
-            segments.append({
-                "status": current_status,
-                "color": current_color,
-                "start": segment_start.isoformat(),
-                "end": actual_end_time.isoformat(),
-                "duration_minutes": int((actual_end_time - segment_start).total_seconds() / 60)
-            })
 
-        # 現在時刻以降（未来）を白で表示
-        if actual_end_time < end_time:
-            segments.append({
-                "status": "future",
-                "color": "white",
-                "start": actual_end_time.isoformat(),
-                "end": end_time.isoformat(),
-                "duration_minutes": int((end_time - actual_end_time).total_seconds() / 60)
-            })
+@app.get("/api/timelines")
+async def get_range_timelines(
+    start_date: str = Query(..., description="開始営業日（YYYY-MM-DD）"),
+    end_date: str = Query(..., description="終了営業日（YYYY-MM-DD、この日を含む）"),
+    device_addr: Optional[str] = Query(default=None, description="MACアドレス（カンマ区切りで複数指定可）"),
+    location: Optional[str] = Query(default=None, description="設置場所（device_addr 省略時、どちらも省略なら全有効デバイス）"),
+    min_segment_minutes: Optional[float] = Query(default=None, ge=0, description="これより短いセグメントをまとめる（分）"),
+    width: Optional[int] = Query(default=None, ge=1, description="描画幅（px）、1px未満のセグメントをまとめる"),
+    db: Session = Depends(get_db)
+):
+    """複数デバイス×複数営業日のタイムラインをNDJSONでストリーミング（1行 = 1デバイス・1営業日）
 
-        return segments
+    期間全体の状態遷移を1クエリで読み、デバイス・営業日・シフトに1回の走査で振り分ける。
+    重い集計APIの実行枠を送信が終わるまで使い、SQLには実行時間の上限を設定する（HeavyStreamingResponse）。
+    """
+    date_list = _date_range(start_date, end_date)
+    if len(date_list) > RANGE_TIMELINE_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"期間は{RANGE_TIMELINE_MAX_DAYS}日以内で指定してください")
 
-    day_segments = create_segments(day_history, day_start_jst.replace(tzinfo=None), day_end_jst.replace(tzinfo=None))
-    night_segments = create_segments(night_history, night_start_jst.replace(tzinfo=None), night_end_jst.replace(tzinfo=None))
+    registry = device_registry.snapshot(db)
+    if device_addr:
+        device_addrs = [a.strip().upper() for a in device_addr.split(",") if a.strip()]
+    else:
+        device_addrs = registry.device_addrs(location, enabled_only=True)
+    device_addrs = list(dict.fromkeys(device_addrs))
+    if len(device_addrs) > RANGE_TIMELINE_MAX_DEVICES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"デバイスは{RANGE_TIMELINE_MAX_DEVICES}台以内で指定してください（device_addr / location で絞り込んでください）"
+        )
 
-    return {
-        "device_addr": device_addr,
-        "date": target_date.isoformat(),
-        "day_shift": {
-            "start": day_start_jst.isoformat(),
-            "end": day_end_jst.isoformat(),
-            "segments": day_segments
-        },
-        "night_shift": {
-            "start": night_start_jst.isoformat(),
-            "end": night_end_jst.isoformat(),
-            "segments": night_segments
-        }
-    }
+    bdays = [business_calendar.day(d) for d in date_list]
+    threshold = max(min_segment_minutes or 0, bdays[0].day_shift.minutes / width if width else 0)
+    now_jst = business_calendar.to_local(datetime.utcnow())
+
+    def generate():
+        # レスポンス送信中も読み続けるため、リクエストのセッションとは別にセッションを開く
+        session = SessionLocal()
+        try:
+            rows = session.query(
+                DeviceHistory.device_addr, DeviceHistory.timestamp,
+                DeviceHistory.red, DeviceHistory.yellow, DeviceHistory.green
+            ).filter(
+                DeviceHistory.device_addr.in_(device_addrs),
+                DeviceHistory.timestamp >= bdays[0].span.start_utc,
+                DeviceHistory.timestamp < bdays[-1].span.end_utc
+            ).order_by(DeviceHistory.device_addr, DeviceHistory.timestamp, DeviceHistory.id).yield_per(5000)
+
+            for timeline in iter_range_timelines(rows, device_addrs, bdays, now_jst, threshold):
+                info = registry.info(timeline["device_addr"])
+                timeline["device_name"] = info["name"]
+                timeline["location"] = info["location"]
+                yield json_bytes(timeline) + b"\n"
+        finally:
+            session.close()
+
+    return HeavyStreamingResponse(generate, media_type=NDJSON_MEDIA_TYPE)
 
 
 # ========== 稼働率計算 API ==========
 
 @app.get("/api/devices/{device_addr}/operation-rate")
+@heavy_endpoint()
 async def get_operation_rate(
     device_addr: str,
     start_date: str,
@@ -1134,10 +1127,6 @@ async def get_operation_rate(
     """期間指定での稼働率計算（緑ライトのみ稼働としてカウント）"""
     device_addr = device_addr.upper()
 
-    # タイムゾーン設定
-    jst = pytz.timezone('Asia/Tokyo')
-    utc = pytz.UTC
-
     # 日付パース
     try:
         start_dt = datetime.strptime(start_date, '%Y-%m-%d').date()
@@ -1148,13 +1137,9 @@ async def get_operation_rate(
     if start_dt > end_dt:
         raise HTTPException(status_code=400, detail="開始日は終了日より前である必要があります")
 
-    # JSTで0時～翌0時までの範囲を設定
-    start_jst = jst.localize(datetime.combine(start_dt, datetime.min.time()))
-    end_jst = jst.localize(datetime.combine(end_dt + timedelta(days=1), datetime.min.time()))
-
-    # UTC変換
-    start_utc = start_jst.astimezone(utc).replace(tzinfo=None)
-    end_utc = end_jst.astimezone(utc).replace(tzinfo=None)
+    # JSTで0時～翌0時までの範囲を設定（UTC変換）
+    start_utc = business_calendar.to_utc(business_calendar.tz.localize(datetime.combine(start_dt, datetime.min.time())))
+    end_utc = business_calendar.to_utc(business_calendar.tz.localize(datetime.combine(end_dt + timedelta(days=1), datetime.min.time())))
 
     # 期間内のデータ取得
     history = db.query(DeviceHistory).filter(
@@ -1240,6 +1225,18 @@ async def get_operation_rate(
 
 # ========== 現在の稼働率（6:00から現在まで）API ==========
 
+@app.get("/api/devices/current-operation-rate")
+async def get_all_current_operation_rates(
+    location: Optional[str] = Query(default=None, description="絞り込む設置場所（省略時は全体）"),
+    db: Session = Depends(get_db)
+):
+    """全デバイスの6:00 JSTから現在時刻までの稼働率を一括取得（履歴の読み込みは1回だけ）"""
+    device_addrs = device_registry.snapshot(db).device_addrs(location)
+
+    now_utc = datetime.utcnow()
+    return current_operation_rates(device_addrs, load_current_traces(db, device_addrs, now_utc), now_utc)
+
+
 @app.get("/api/devices/{device_addr}/current-operation-rate")
 async def get_current_operation_rate(
     device_addr: str,
@@ -1248,437 +1245,168 @@ async def get_current_operation_rate(
     """6:00 JSTから現在時刻までの稼働率を計算（緑ライトのみ稼働としてカウント）"""
     device_addr = device_addr.upper()
 
-    # タイムゾーン設定
-    jst = pytz.timezone('Asia/Tokyo')
-    utc = pytz.UTC
-
-    # 現在時刻（JST）
-    now_jst = datetime.now(jst)
-
-    # 今日の6:00 JST
-    start_jst = jst.localize(datetime.combine(now_jst.date(), datetime.min.time())).replace(hour=6)
-
-    # もし現在時刻が6:00より前なら、昨日の6:00から計算
-    if now_jst.hour < 6:
-        start_jst = start_jst - timedelta(days=1)
-
-    # UTC変換
-    start_utc = start_jst.astimezone(utc).replace(tzinfo=None)
-    end_utc = now_jst.astimezone(utc).replace(tzinfo=None)
-
-    # 期間内のデータ取得
-    history = db.query(DeviceHistory).filter(
-        DeviceHistory.device_addr == device_addr,
-        DeviceHistory.timestamp >= start_utc,
-        DeviceHistory.timestamp <= end_utc
-    ).order_by(DeviceHistory.timestamp).all()
-
-    # 各ステータスの継続時間を計算
-    operation_minutes = 0  # 稼働（緑ライトのみ）
-    stop_yellow_minutes = 0  # 停止（黄）
-    stop_red_minutes = 0  # 停止（赤）
-    none_minutes = 0  # 未稼働
-
-    # 総時間（分）
-    total_minutes = (end_utc - start_utc).total_seconds() / 60
-
-    if not history:
-        # データがない場合は全て未稼働
-        return {
-            "device_addr": device_addr,
-            "start_time": start_jst.strftime('%Y-%m-%d %H:%M:%S'),
-            "end_time": now_jst.strftime('%Y-%m-%d %H:%M:%S'),
-            "operation_rate": 0.0,
-            "operation_minutes": 0,
-            "stop_yellow_minutes": 0,
-            "stop_red_minutes": 0,
-            "none_minutes": int(total_minutes),
-            "total_minutes": int(total_minutes)
-        }
-
-    # 前のレコードを保持して時間差分を計算
-    prev_record = None
-    prev_status = None
-
-    for record in history:
-        if prev_record is not None:
-            # 前のレコードから現在のレコードまでの時間差
-            time_diff = (record.timestamp - prev_record.timestamp).total_seconds() / 60
-
-            # 前のレコードのステータスで時間を集計
-            if prev_status == "running":
-                operation_minutes += time_diff
-            elif prev_status == "stop_yellow":
-                stop_yellow_minutes += time_diff
-            elif prev_status == "stop_red":
-                stop_red_minutes += time_diff
-            else:
-                none_minutes += time_diff
-
-        # 現在のステータスを判定
-        prev_status, _ = get_status_from_lights(record.red, record.yellow, record.green)
-        prev_record = record
-
-    # 最後のレコードから現在時刻までの時間
-    if prev_record is not None:
-        time_diff = (end_utc - prev_record.timestamp).total_seconds() / 60
-        if prev_status == "running":
-            operation_minutes += time_diff
-        elif prev_status == "stop_yellow":
-            stop_yellow_minutes += time_diff
-        elif prev_status == "stop_red":
-            stop_red_minutes += time_diff
-        else:
-            none_minutes += time_diff
-
-    # 稼働率計算（緑ライトのみ）
-    operation_rate = (operation_minutes / total_minutes * 100) if total_minutes > 0 else 0.0
-
-    return {
-        "device_addr": device_addr,
-        "start_time": start_jst.strftime('%Y-%m-%d %H:%M:%S'),
-        "end_time": now_jst.strftime('%Y-%m-%d %H:%M:%S'),
-        "operation_rate": round(operation_rate, 1),
-        "operation_minutes": int(operation_minutes),
-        "stop_yellow_minutes": int(stop_yellow_minutes),
-        "stop_red_minutes": int(stop_red_minutes),
-        "none_minutes": int(none_minutes),
-        "total_minutes": int(total_minutes)
-    }
+    now_utc = datetime.utcnow()
+    traces = load_current_traces(db, [device_addr], now_utc)
+    return current_operation_rate(device_addr, traces[device_addr], now_utc)
 
 
 # ========== データ受信ログAPI ==========
 
 @app.get("/api/devices/{device_addr}/data-logs")
 async def get_device_data_logs(
+    request: Request,
     device_addr: str,
-    limit: int = 100,
+    limit: Optional[int] = Query(default=None, ge=1, description="取得件数（省略時は100件、ndjsonでは全件）"),
+    cursor: Optional[str] = Query(default=None, description="前回レスポンスの next_cursor"),
+    format: str = Query(default="json", pattern="^(json|ndjson)$", description="json / ndjson（ストリーミング）"),
     db: Session = Depends(get_db)
 ):
-    """デバイスのデータ受信ログを取得"""
+    """デバイスのデータ受信ログを取得（新しい順）"""
     device_addr = device_addr.upper()
+    position = _cursor_position(cursor)
 
-    # 最新のログを取得
-    logs = db.query(DeviceHistory).filter(
-        DeviceHistory.device_addr == device_addr
-    ).order_by(DeviceHistory.timestamp.desc()).limit(limit).all()
+    def log_query(session):
+        return session.query(*DATA_LOG_COLUMNS).filter(DeviceHistory.device_addr == device_addr)
 
-    # タイムゾーン設定
-    jst = pytz.timezone('Asia/Tokyo')
-    utc = pytz.UTC
+    if format == "ndjson":
+        return ndjson_response(log_query, data_log_row, position, descending=True, limit=limit)
 
-    result = []
-    for log in logs:
-        # UTC -> JST変換
-        utc_time = utc.localize(log.timestamp)
-        jst_time = utc_time.astimezone(jst)
-
-        result.append({
-            "timestamp": jst_time.strftime('%Y-%m-%d %H:%M:%S'),
-            "status_code": log.status_code,
-            "status_text": log.status_text,
-            "battery": log.battery,
-            "red": log.red,
-            "yellow": log.yellow,
-            "green": log.green,
-            "device_id": log.device_id
-        })
+    # 最新のログから1ページ分を取得
+    result, next_cursor = fetch_page(
+        log_query(db), data_log_row, min(limit or 100, MAX_PAGE_SIZE), position, descending=True
+    )
 
-    return {
+    return json_response(request, {
         "device_addr": device_addr,
         "total_logs": len(result),
-        "logs": result
-    }
+        "logs": result,
+        "next_cursor": next_cursor
+    }, headers=_page_headers(next_cursor))
 
 
-# ========== 全体稼働率API ==========
+# ========== 履歴一括取得API（外部システム連携用） ==========
 
-@app.get("/api/overall/current-status")
-async def get_overall_current_status(
-    location: Optional[str] = Query(default=None, description="絞り込む設置場所（省略時は全体）"),
+@app.get("/api/history")
+async def get_all_history(
+    request: Request,
+    days: int = Query(default=1, ge=1, le=366, description="取得する日数（現在から遡る）"),
+    device_addr: Optional[str] = Query(default=None, description="絞り込むMACアドレス（省略時は全デバイス）"),
+    limit: Optional[int] = Query(default=None, ge=1, description="1ページの件数（json）/ 最大件数（ndjson）"),
+    cursor: Optional[str] = Query(default=None, description="前ページの next_cursor（この行の後から取得）"),
+    format: str = Query(default="ndjson", pattern="^(json|ndjson)$", description="ndjson（ストリーミング） / json（ページング）"),
     db: Session = Depends(get_db)
 ):
-    """全デバイスの現在のステータス時間割合を取得（円グラフ用）"""
-    jst = pytz.timezone('Asia/Tokyo')
-    utc = pytz.UTC
-
-    # デバイス一覧を取得（設置場所フィルタ対応）
-    registrations = db.query(DeviceRegistration).all()
-    if location:
-        device_addrs = [reg.device_addr for reg in registrations if reg.location == location]
-    else:
-        device_addrs = [reg.device_addr for reg in registrations]
-
-    if not device_addrs:
-        return {
-            "running": 0,
-            "stop_yellow": 0,
-            "stop_red": 0,
-            "idle": 0,
-            "total_devices": 0
-        }
-
-    # 6:00～現在までの時間範囲（現在時刻が6:00より前なら前日の6:00から）
-    now_jst = datetime.now(jst)
-    today_date = now_jst.date()
-
-    # 今日の6:00を計算
-    start_time = jst.localize(datetime.combine(today_date, datetime.min.time()) + timedelta(hours=6))
-
-    # 現在時刻が6:00より前なら、前日の6:00を基準にする
-    if now_jst.hour < 6:
-        start_time = start_time - timedelta(days=1)
-
-    end_time = now_jst
-
-    # 各ステータスの合計時間（分）
-    total_running_minutes = 0
-    total_stop_yellow_minutes = 0
-    total_stop_red_minutes = 0
-    total_idle_minutes = 0
+    """全デバイスの履歴を古い順に取得（MES等への一括連携用、メモリ使用量は件数によらず一定）"""
+    since = datetime.utcnow() - timedelta(days=days)
+    position = _cursor_position(cursor)
+    addr = device_addr.upper() if device_addr else None
+
+    def all_history_query(session):
+        query = session.query(*HISTORY_COLUMNS).filter(DeviceHistory.timestamp >= since)
+        if addr:
+            query = query.filter(DeviceHistory.device_addr == addr)
+        return query
+
+    if format == "ndjson":
+        return ndjson_response(all_history_query, history_row, position, descending=False, limit=limit)
+
+    items, next_cursor = fetch_page(
+        all_history_query(db), history_row, min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE), position, descending=False
+    )
+    return json_response(request, {"items": items, "next_cursor": next_cursor}, headers=_page_headers(next_cursor))
 
-    # 各デバイスの稼働時間を計算
-    for device_addr in device_addrs:
-        # この期間の履歴を取得
-        histories = db.query(DeviceHistory).filter(
-            DeviceHistory.device_addr == device_addr,
-            DeviceHistory.timestamp >= start_time.astimezone(utc).replace(tzinfo=None),
-            DeviceHistory.timestamp < end_time.astimezone(utc).replace(tzinfo=None)
-        ).order_by(DeviceHistory.timestamp).all()
 
-        if not histories:
-            continue
+# ========== データエクスポートAPI ==========
 
-        # 各履歴間の時間を計算
-        for j in range(len(histories)):
-            current = histories[j]
+@app.get("/api/export/{dataset}")
+async def export_dataset(
+    dataset: str,
+    start_date: str = Query(..., description="開始営業日（YYYY-MM-DD）"),
+    end_date: str = Query(..., description="終了営業日（YYYY-MM-DD、この日を含む）"),
+    device_addr: Optional[str] = Query(default=None, description="MACアドレス（カンマ区切りで複数指定可）"),
+    location: Optional[str] = Query(default=None, description="絞り込む設置場所"),
+    format: str = Query(default="csv", description="csv / parquet（pyarrowが必要）"),
+):
+    """履歴・日次稼働率・時間帯別集計をCSV/Parquetでストリーミング出力
 
-            if j < len(histories) - 1:
-                next_record = histories[j + 1]
-                duration_minutes = (next_record.timestamp - current.timestamp).total_seconds() / 60
-            else:
-                # 最後のレコードは現在時刻まで
-                end_point = end_time.astimezone(utc).replace(tzinfo=None)
-                duration_minutes = (end_point - current.timestamp).total_seconds() / 60
-
-            # 負の値を防ぐ
-            duration_minutes = max(0, duration_minutes)
-
-            # ステータスごとに集計
-            if current.green:
-                total_running_minutes += duration_minutes
-            elif current.yellow:
-                total_stop_yellow_minutes += duration_minutes
-            elif current.red:
-                total_stop_red_minutes += duration_minutes
-            else:
-                total_idle_minutes += duration_minutes
+    dataset: history / daily-operation-rate / hourly
+    """
+    try:
+        export_filter = ExportFilter(
+            start_date=datetime.strptime(start_date, '%Y-%m-%d').date(),
+            end_date=datetime.strptime(end_date, '%Y-%m-%d').date(),
+            device_addrs=tuple(a.strip().upper() for a in device_addr.split(",") if a.strip()) if device_addr else (),
+            location=location or None,
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="日付形式が不正です（YYYY-MM-DD）")
+    try:
+        validate_export(dataset, format, export_filter, max_days=EXPORT_MAX_DAYS)
+    except ExportError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    filename = export_filename(dataset, format, export_filter)
+    return StreamingResponse(
+        iter_export(dataset, format, export_filter),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
 
-    # 合計時間
-    total_minutes = total_running_minutes + total_stop_yellow_minutes + total_stop_red_minutes + total_idle_minutes
 
-    # 割合を計算（%）
-    if total_minutes > 0:
-        running_percent = round(total_running_minutes / total_minutes * 100, 1)
-        stop_yellow_percent = round(total_stop_yellow_minutes / total_minutes * 100, 1)
-        stop_red_percent = round(total_stop_red_minutes / total_minutes * 100, 1)
-        idle_percent = round(total_idle_minutes / total_minutes * 100, 1)
-    else:
-        running_percent = stop_yellow_percent = stop_red_percent = idle_percent = 0
+# ========== 全体稼働率API ==========
 
-    return {
-        "running": running_percent,
-        "stop_yellow": stop_yellow_percent,
-        "stop_red": stop_red_percent,
-        "idle": idle_percent,
-        "total_devices": len(device_addrs),
-        "total_hours": round(total_minutes / 60, 1)
-    }
+@app.get("/api/overall/current-status")
+@live_cached()
+async def get_overall_current_status(
+    request: Request,
+    location: Optional[str] = Query(default=None, description="絞り込む設置場所（省略時は全体）"),
+    db: Session = Depends(get_db)
+):
+    """全デバイスの現在のステータス時間割合を取得（円グラフ用）"""
+    snapshot = DashboardSnapshot(db)
+    return overall_current_status(snapshot, snapshot.device_addrs(location))
 
 
 @app.get("/api/overall/hourly-status")
+@live_cached(date_param="date")
+@past_day_cached()
 async def get_overall_hourly_status(
+    request: Request,
     date: str = Query(default=None, description="YYYY-MM-DD形式の日付（省略時は今日）"),
     location: Optional[str] = Query(default=None, description="絞り込む設置場所（省略時は全体）"),
     db: Session = Depends(get_db)
 ):
     """1時間ごとの全体ステータス割合を取得（積上げ棒グラフ用）"""
-    jst = pytz.timezone('Asia/Tokyo')
-    utc = pytz.UTC
-
-    # 日付処理
-    if date:
-        target_date = datetime.strptime(date, '%Y-%m-%d').date()
-    else:
-        now_jst = datetime.now(jst)
-        target_date = now_jst.date()
-        # 現在時刻が6:00より前なら、前日の日付を使用
-        if now_jst.hour < 6:
-            target_date = target_date - timedelta(days=1)
-
-    # 6:00～翌6:00の時間範囲を設定
-    start_time = jst.localize(datetime.combine(target_date, datetime.min.time()) + timedelta(hours=6))
-    end_time = start_time + timedelta(hours=24)
-
-    # デバイス一覧を取得（設置場所フィルタ対応）
-    registrations = db.query(DeviceRegistration).all()
-    if location:
-        device_addrs = [reg.device_addr for reg in registrations if reg.location == location]
-    else:
-        device_addrs = [reg.device_addr for reg in registrations]
-
-    if not device_addrs:
-        return {"hours": [], "data": []}
-
-    total_devices = len(device_addrs)
-
-    # 1時間ごとのデータを作成
-    hourly_data = []
-    total_green_apples = 0  # GreenApple合計
-    current_hour = start_time
-
-    while current_hour < end_time and current_hour <= datetime.now(jst):
-        next_hour = current_hour + timedelta(hours=1)
-
-        # この時間帯の各ステータスの合計時間（分）
-        total_running_minutes = 0
-        total_stop_yellow_minutes = 0
-        total_stop_red_minutes = 0
-        total_idle_minutes = 0
-
-        for device_addr in device_addrs:
-            # この時間帯の履歴を取得
-            histories = db.query(DeviceHistory).filter(
-                DeviceHistory.device_addr == device_addr,
-                DeviceHistory.timestamp >= current_hour.astimezone(utc).replace(tzinfo=None),
-                DeviceHistory.timestamp < next_hour.astimezone(utc).replace(tzinfo=None)
-            ).order_by(DeviceHistory.timestamp).all()
-
-            # 直前の状態も取得（時間帯開始時点の状態を知るため）
-            prev_history = db.query(DeviceHistory).filter(
-                DeviceHistory.device_addr == device_addr,
-                DeviceHistory.timestamp < current_hour.astimezone(utc).replace(tzinfo=None)
-            ).order_by(DeviceHistory.timestamp.desc()).first()
-
-            # 時間帯の終了時刻（現在時刻を超えない）
-            period_end = min(next_hour, datetime.now(jst)).astimezone(utc).replace(tzinfo=None)
-
-            if not histories and not prev_history:
-                # データがない場合は休止中とする
-                duration_minutes = (period_end - current_hour.astimezone(utc).replace(tzinfo=None)).total_seconds() / 60
-                total_idle_minutes += duration_minutes
-                continue
-
-            # 時間帯開始時点の状態を決定
-            if histories:
-                all_records = histories[:]
-            else:
-                all_records = []
-
-            # 時間帯開始時点の状態を追加
-            if prev_history:
-                # 直前の状態を時間帯開始時点に設定
-                start_status = {
-                    'timestamp': current_hour.astimezone(utc).replace(tzinfo=None),
-                    'green': prev_history.green,
-                    'yellow': prev_history.yellow,
-                    'red': prev_history.red
-                }
-            elif all_records:
-                # 履歴の最初のレコードを時間帯開始時点に設定
-                start_status = {
-                    'timestamp': current_hour.astimezone(utc).replace(tzinfo=None),
-                    'green': all_records[0].green,
-                    'yellow': all_records[0].yellow,
-                    'red': all_records[0].red
-                }
-            else:
-                # データがない場合
-                start_status = {
-                    'timestamp': current_hour.astimezone(utc).replace(tzinfo=None),
-                    'green': False,
-                    'yellow': False,
-                    'red': False
-                }
-
-            # 時間計算用のレコードリスト
-            time_records = [start_status]
-            for h in all_records:
-                time_records.append({
-                    'timestamp': h.timestamp,
-                    'green': h.green,
-                    'yellow': h.yellow,
-                    'red': h.red
-                })
-
-            # 各レコード間の時間を計算
-            for i in range(len(time_records)):
-                current_record = time_records[i]
-
-                if i < len(time_records) - 1:
-                    next_timestamp = time_records[i + 1]['timestamp']
-                else:
-                    next_timestamp = period_end
-
-                duration_minutes = (next_timestamp - current_record['timestamp']).total_seconds() / 60
-                duration_minutes = max(0, duration_minutes)
-
-                # ステータスごとに集計
-                if current_record['green']:
-                    total_running_minutes += duration_minutes
-                elif current_record['yellow']:
-                    total_stop_yellow_minutes += duration_minutes
-                elif current_record['red']:
-                    total_stop_red_minutes += duration_minutes
-                else:
-                    total_idle_minutes += duration_minutes
-
-        # 合計時間
-        total_minutes = total_running_minutes + total_stop_yellow_minutes + total_stop_red_minutes + total_idle_minutes
+    # 日付処理（省略時は今日、現在時刻が6:00より前なら前日）
+    target_date = datetime.strptime(date, '%Y-%m-%d').date() if date else None
 
-        # 割合を計算
-        if total_minutes > 0:
-            running_percent = round(total_running_minutes / total_minutes * 100, 1)
-            stop_yellow_percent = round(total_stop_yellow_minutes / total_minutes * 100, 1)
-            stop_red_percent = round(total_stop_red_minutes / total_minutes * 100, 1)
-            idle_percent = round(total_idle_minutes / total_minutes * 100, 1)
-        else:
-            running_percent = stop_yellow_percent = stop_red_percent = idle_percent = 0
-
-        # GreenApple獲得数を計算
-        green_apples = 0
-        if running_percent >= 50:
-            green_apples = 5
-        elif running_percent >= 40:
-            green_apples = 3
-        elif running_percent >= 35:
-            green_apples = 2
-        elif running_percent > 30:
-            green_apples = 1
-
-        total_green_apples += green_apples
-
-        hourly_data.append({
-            "hour": current_hour.strftime('%H:%M'),
-            "running": running_percent,
-            "stop_yellow": stop_yellow_percent,
-            "stop_red": stop_red_percent,
-            "idle": idle_percent,
-            "green_apples": green_apples
-        })
+    # 6:00～翌6:00の時間範囲（全デバイスの履歴を1回だけ読み込んで時間帯別に集計）
+    snapshot = DashboardSnapshot(db, target_date)
+    return overall_hourly_status(snapshot, snapshot.device_addrs(location))
 
-        current_hour = next_hour
 
-    return {
-        "date": target_date.strftime('%Y-%m-%d'),
-        "total_devices": total_devices,
-        "total_green_apples": total_green_apples,
-        "data": hourly_data
-    }
+def _date_range(start_date: str, end_date: str) -> List[ddate]:
+    """開始日〜終了日（両端含む）の日付一覧"""
+    try:
+        start_dt = datetime.strptime(start_date, '%Y-%m-%d').date()
+        end_dt = datetime.strptime(end_date, '%Y-%m-%d').date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="日付形式が不正です（YYYY-MM-DD）")
+    if start_dt > end_dt:
+        raise HTTPException(status_code=400, detail="開始日は終了日より前である必要があります")
+    date_list = []
+    current_date = start_dt
+    while current_date <= end_dt:
+        date_list.append(current_date)
+        current_date += timedelta(days=1)
+    return date_list
 
 
 @app.get("/api/overall/daily-operation-rate")
+@live_cached()
+@heavy_endpoint()
 async def get_overall_daily_operation_rate(
+    request: Request,
     year: int = Query(default=None, description="年（省略時は今年）"),
     month: int = Query(default=None, description="月（省略時は今月）"),
     days: int = Query(default=None, description="取得する日数（year/month指定時は無視）"),
@@ -1688,16 +1416,9 @@ async def get_overall_daily_operation_rate(
     db: Session = Depends(get_db)
 ):
     """日ごとの全体稼働率を取得（定時内/含残業の2系列、集計テーブルから取得）"""
-    jst = pytz.timezone('Asia/Tokyo')
-    utc = pytz.UTC
 
-    registrations = db.query(DeviceRegistration).filter(
-        DeviceRegistration.is_enabled == True
-    ).all()
-    if location:
-        device_addrs = [reg.device_addr for reg in registrations if reg.location == location]
-    else:
-        device_addrs = [reg.device_addr for reg in registrations]
+    snapshot = DashboardSnapshot(db)
+    device_addrs = snapshot.device_addrs(location, enabled_only=True)
 
     if not device_addrs:
         return {"total_devices": 0, "data": []}
@@ -1706,101 +1427,18 @@ async def get_overall_daily_operation_rate(
 
     # 対象期間を決定
     if start_date is not None and end_date is not None:
-        try:
-            start_dt = datetime.strptime(start_date, '%Y-%m-%d').date()
-            end_dt = datetime.strptime(end_date, '%Y-%m-%d').date()
-            if start_dt > end_dt:
-                raise HTTPException(status_code=400, detail="開始日は終了日より前である必要があります")
-            date_list = []
-            current_date = start_dt
-            while current_date <= end_dt:
-                date_list.append(current_date)
-                current_date += timedelta(days=1)
-        except ValueError:
-            raise HTTPException(status_code=400, detail="日付形式が不正です（YYYY-MM-DD）")
+        date_list = _date_range(start_date, end_date)
     elif year is not None and month is not None:
         days_in_month = calendar.monthrange(year, month)[1]
         date_list = [datetime(year, month, day).date() for day in range(1, days_in_month + 1)]
     else:
         if days is None:
             days = 7
-        date_list = [(datetime.now(jst) - timedelta(days=i)).date() for i in range(days - 1, -1, -1)]
-
-    # 今日の営業日（6:00以降なら今日、6:00前なら昨日）
-    now_jst = datetime.now(jst)
-    today_business = now_jst.date() if now_jst.hour >= 6 else (now_jst - timedelta(days=1)).date()
-
-    daily_rates = []
-    for target_date in date_list:
-        if target_date > today_business:
-            # 未来はデータなし
-            daily_rates.append({
-                "date": target_date.strftime('%m/%d'),
-                "rate_regular": 0,
-                "rate_overtime": 0
-            })
-            continue
-
-        if target_date == today_business:
-            # 当日はリアルタイム計算
-            regular_start = jst.localize(datetime.combine(target_date, dtime(8, 0)))
-            regular_end = regular_start + timedelta(hours=18)
-            overtime_end = regular_start + timedelta(hours=21)
-
-            # 現在時刻がウィンドウ内ならそこまで、まだ8:00前なら0
-            now_utc = datetime.utcnow()
-            regular_start_utc = regular_start.astimezone(utc).replace(tzinfo=None)
-            regular_end_utc = min(regular_end.astimezone(utc).replace(tzinfo=None), now_utc)
-            overtime_end_utc = min(overtime_end.astimezone(utc).replace(tzinfo=None), now_utc)
-
-            if now_utc <= regular_start_utc:
-                daily_rates.append({
-                    "date": target_date.strftime('%m/%d'),
-                    "rate_regular": 0,
-                    "rate_overtime": 0
-                })
-                continue
+        today = business_calendar.now().date()
+        date_list = [today - timedelta(days=i) for i in range(days - 1, -1, -1)]
 
-            total_run_r = 0
-            total_run_o = 0
-            for addr in device_addrs:
-                total_run_r += _calc_green_minutes(db, addr, regular_start_utc, regular_end_utc)
-                total_run_o += _calc_green_minutes(db, addr, regular_start_utc, overtime_end_utc)
-
-            # 経過分数を分母にする（当日はまだウィンドウが完了していない）
-            elapsed_r = max(1, (regular_end_utc - regular_start_utc).total_seconds() / 60) * total_devices
-            elapsed_o = max(1, (overtime_end_utc - regular_start_utc).total_seconds() / 60) * total_devices
-            rate_r = round(total_run_r / elapsed_r * 100, 1)
-            rate_o = round(total_run_o / elapsed_o * 100, 1)
-
-            daily_rates.append({
-                "date": target_date.strftime('%m/%d'),
-                "rate_regular": rate_r,
-                "rate_overtime": rate_o
-            })
-        else:
-            # 過去日は集計テーブルから取得
-            rows = db.query(DailyOperationRate).filter(
-                DailyOperationRate.target_date == target_date,
-                DailyOperationRate.device_addr.in_(device_addrs)
-            ).all()
-
-            if rows:
-                sum_run_r = sum(r.running_minutes_regular for r in rows)
-                sum_win_r = sum(r.window_minutes_regular for r in rows)
-                sum_run_o = sum(r.running_minutes_overtime for r in rows)
-                sum_win_o = sum(r.window_minutes_overtime for r in rows)
-                rate_r = round(sum_run_r / sum_win_r * 100, 1) if sum_win_r > 0 else 0
-                rate_o = round(sum_run_o / sum_win_o * 100, 1) if sum_win_o > 0 else 0
-            else:
-                rate_r = 0
-                rate_o = 0
-
-            daily_rates.append({
-                "date": target_date.strftime('%m/%d'),
-                "rate_regular": rate_r,
-                "rate_overtime": rate_o
-            })
+    # 過去日は集計テーブル、当日はスナップショットからリアルタイム計算
+    daily_rates = daily_operation_rates(snapshot, device_addrs, date_list)
 
     return {
         "total_devices": total_devices,
@@ -1809,7 +1447,10 @@ async def get_overall_daily_operation_rate(
 
 
 @app.get("/api/overall/daily-green-apples")
+@live_cached()
+@heavy_endpoint()
 async def get_daily_green_apples(
+    request: Request,
     year: int = Query(default=None, description="年（省略時は今年）"),
     month: int = Query(default=None, description="月（省略時は今月）"),
     start_date: str = Query(default=None, description="開始日（YYYY-MM-DD形式）"),
@@ -1818,39 +1459,18 @@ async def get_daily_green_apples(
     db: Session = Depends(get_db)
 ):
     """日次GREEN APPLE収穫量を取得（集計テーブルから取得、当日はリアルタイム計算）"""
-    jst = pytz.timezone('Asia/Tokyo')
-    utc = pytz.UTC
 
-    registrations = db.query(DeviceRegistration).filter(
-        DeviceRegistration.is_enabled == True
-    ).all()
-    if location:
-        device_addrs = [reg.device_addr for reg in registrations if reg.location == location]
-    else:
-        device_addrs = [reg.device_addr for reg in registrations]
+    snapshot = DashboardSnapshot(db)
+    device_addrs = snapshot.device_addrs(location, enabled_only=True)
 
     if not device_addrs:
         return {"data": []}
 
-    # locationキー（集計テーブルのlocation列に合わせる）
-    apple_location_key = location if location else ""
-
     # 対象期間を決定
     if start_date is not None and end_date is not None:
-        try:
-            start_dt = datetime.strptime(start_date, '%Y-%m-%d').date()
-            end_dt = datetime.strptime(end_date, '%Y-%m-%d').date()
-            if start_dt > end_dt:
-                raise HTTPException(status_code=400, detail="開始日は終了日より前である必要があります")
-            date_list = []
-            current_date = start_dt
-            while current_date <= end_dt:
-                date_list.append(current_date)
-                current_date += timedelta(days=1)
-        except ValueError:
-            raise HTTPException(status_code=400, detail="日付形式が不正です（YYYY-MM-DD）")
+        date_list = _date_range(start_date, end_date)
     else:
-        now_jst = datetime.now(jst)
+        now_jst = business_calendar.now()
         if year is None:
             year = now_jst.year
         if month is None:
@@ -1858,198 +1478,416 @@ async def get_daily_green_apples(
         days_in_month = calendar.monthrange(year, month)[1]
         date_list = [datetime(year, month, day).date() for day in range(1, days_in_month + 1)]
 
-    now_jst = datetime.now(jst)
-    today_business = now_jst.date() if now_jst.hour >= 6 else (now_jst - timedelta(days=1)).date()
+    # 過去日は集計テーブル、当日はスナップショットからリアルタイム計算
+    daily_apples = daily_green_apples(snapshot, device_addrs, location, date_list)
 
-    daily_apples = []
-    for target_date in date_list:
-        if target_date > today_business:
-            daily_apples.append({
-                "date": target_date.strftime('%m/%d'),
-                "full_date": target_date.strftime('%Y-%m-%d'),
-                "apples": 0
-            })
-            continue
-
-        if target_date == today_business:
-            # 当日はリアルタイム計算
-            day_start = jst.localize(datetime.combine(target_date, dtime(6, 0)))
-            day_end = day_start + timedelta(hours=24)
-            apples = _calc_apples_for_day(db, device_addrs, day_start, day_end)
-            daily_apples.append({
-                "date": target_date.strftime('%m/%d'),
-                "full_date": target_date.strftime('%Y-%m-%d'),
-                "apples": apples
-            })
-        else:
-            # 過去日は集計テーブルから取得
-            row = db.query(DailyGreenAppleCount).filter(
-                DailyGreenAppleCount.target_date == target_date,
-                DailyGreenAppleCount.location == apple_location_key
-            ).first()
-            daily_apples.append({
-                "date": target_date.strftime('%m/%d'),
-                "full_date": target_date.strftime('%Y-%m-%d'),
-                "apples": row.apple_count if row else 0
+    return {
+        "data": daily_apples
+    }
+
+
+def _period_rates(row) -> dict:
+    """ロールアップ行から稼働率を計算"""
+    if row is None:
+        return {"rate_regular": 0, "rate_overtime": 0, "days": 0}
+    return {
+        "rate_regular": round(row.running_minutes_regular / row.window_minutes_regular * 100, 1) if row.window_minutes_regular else 0,
+        "rate_overtime": round(row.running_minutes_overtime / row.window_minutes_overtime * 100, 1) if row.window_minutes_overtime else 0,
+        "days": row.days,
+    }
+
+
+@app.get("/api/overall/period-trend")
+@heavy_endpoint()
+async def get_period_trend(
+    period: str = Query(default="month", description="集計単位（week / month / year）"),
+    count: int = Query(default=24, ge=1, le=520, description="取得する期間数（現在の期間を含む）"),
+    group_by: str = Query(default="location", description="系列の単位（location / device）"),
+    location: Optional[str] = Query(default=None, description="絞り込む設置場所（省略時は全体）"),
+    db: Session = Depends(get_db)
+):
+    """週/月/年単位の長期推移を取得（ロールアップテーブルから1回の読み出し、締め済みの日のみ）"""
+    if period not in PERIOD_TYPES:
+        raise HTTPException(status_code=400, detail="periodは week / month / year のいずれかです")
+    if group_by not in ("location", "device"):
+        raise HTTPException(status_code=400, detail="group_byは location / device のいずれかです")
+
+    starts = recent_period_starts(period, count, business_calendar.business_date())
+
+    if group_by == "location":
+        query = db.query(PeriodLocationSummary).filter(
+            PeriodLocationSummary.period_type == period,
+            PeriodLocationSummary.period_start >= starts[0]
+        )
+        if location is not None:
+            query = query.filter(PeriodLocationSummary.location == location)
+        rows = query.order_by(PeriodLocationSummary.location, PeriodLocationSummary.period_start).all()
+
+        by_key = {}
+        for row in rows:
+            by_key.setdefault(row.location, {})[row.period_start] = row
+        if location is not None:
+            by_key.setdefault(location, {})
+
+        series = []
+        for key in sorted(by_key):  # ""（全体）が先頭
+            data = []
+            for start in starts:
+                row = by_key[key].get(start)
+                data.append({
+                    "period": period_label(period, start),
+                    "start": start.isoformat(),
+                    **_period_rates(row),
+                    "apples": row.apple_count if row else 0
+                })
+            series.append({"location": key, "data": data})
+    else:
+        registrations = device_registry.snapshot(db).registrations(location, enabled_only=True, by_index=True)
+        if not registrations:
+            return {"period": period, "group_by": group_by, "series": []}
+
+        rows = db.query(PeriodOperationRate).filter(
+            PeriodOperationRate.period_type == period,
+            PeriodOperationRate.device_addr.in_([reg.device_addr for reg in registrations]),
+            PeriodOperationRate.period_start >= starts[0]
+        ).order_by(PeriodOperationRate.device_addr, PeriodOperationRate.period_start).all()
+
+        by_key = {}
+        for row in rows:
+            by_key.setdefault(row.device_addr, {})[row.period_start] = row
+
+        series = []
+        for reg in registrations:
+            data = []
+            for start in starts:
+                data.append({
+                    "period": period_label(period, start),
+                    "start": start.isoformat(),
+                    **_period_rates(by_key.get(reg.device_addr, {}).get(start))
+                })
+            series.append({
+                "device_addr": reg.device_addr,
+                "device_name": reg.name,
+                "location": reg.location,
+                "data": data
             })
 
     return {
-        "data": daily_apples
+        "period": period,
+        "group_by": group_by,
+        "series": series
     }
 
 
-@app.get("/api/overall/hourly-green-apples")
-async def get_hourly_green_apples(
-    date: str = Query(..., description="YYYY-MM-DD形式の日付"),
+# ========== ダッシュボード初期表示 API ==========
+
+def _current_month_dates() -> List[ddate]:
+    """今月（JST）の1日〜末日"""
+    now_jst = business_calendar.now()
+    days_in_month = calendar.monthrange(now_jst.year, now_jst.month)[1]
+    return [ddate(now_jst.year, now_jst.month, day) for day in range(1, days_in_month + 1)]
+
+
+@app.get("/api/dashboard/bootstrap")
+async def get_dashboard_bootstrap(
+    request: Request,
+    location: Optional[str] = Query(default=None, description="絞り込む設置場所（省略時は全体）"),
+    operation_start_date: Optional[str] = Query(default=None, description="稼働率推移の開始日（省略時は今月1日）"),
+    operation_end_date: Optional[str] = Query(default=None, description="稼働率推移の終了日（省略時は今月末日）"),
+    apple_start_date: Optional[str] = Query(default=None, description="GreenApple収穫量の開始日（省略時は今月1日）"),
+    apple_end_date: Optional[str] = Query(default=None, description="GreenApple収穫量の終了日（省略時は今月末日）"),
     db: Session = Depends(get_db)
 ):
-    """特定の日の時間帯別GreenApple獲得数を取得"""
-    jst = pytz.timezone('Asia/Tokyo')
-    utc = pytz.UTC
+    """ダッシュボード初期表示用データを一括取得
 
-    # 登録されているデバイス一覧を取得
-    registrations = db.query(DeviceRegistration).all()
-    device_addrs = [reg.device_addr for reg in registrations]
+    デバイス一覧・全体ステータス・時間帯別推移・現在稼働率・タイムライン・日次推移を
+    1つのスナップショット（登録情報・現在ステータス・当日の状態遷移）から計算し、gzip圧縮して返す。
+    """
+    devices = device_list(db)
+    if location:
+        devices = [d for d in devices if d["location"] == location]
 
-    if not device_addrs:
-        return {"data": []}
+    snapshot = DashboardSnapshot(db, extra_addrs=[d["device_addr"] for d in devices])
+    device_addrs = snapshot.device_addrs(location)
+    enabled_addrs = snapshot.device_addrs(location, enabled_only=True)
 
-    # 日付処理
-    target_date = datetime.strptime(date, '%Y-%m-%d').date()
+    if operation_start_date and operation_end_date:
+        operation_dates = _date_range(operation_start_date, operation_end_date)
+    else:
+        operation_dates = _current_month_dates()
+    if apple_start_date and apple_end_date:
+        apple_dates = _date_range(apple_start_date, apple_end_date)
+    else:
+        apple_dates = _current_month_dates()
+
+    payload = {
+        "generated_at": snapshot.now_jst.isoformat(),
+        "business_date": snapshot.today.isoformat(),
+        "location": location,
+        "devices": devices,
+        "current_status": overall_current_status(snapshot, device_addrs),
+        "hourly_status": overall_hourly_status(snapshot, device_addrs),
+        "current_operation_rates": current_operation_rates(device_addrs, snapshot.traces, snapshot.now_utc),
+        "timelines": {
+            d["device_addr"]: device_timeline(d["device_addr"], snapshot.trace(d["device_addr"]), snapshot.bday, snapshot.now_jst)
+            for d in devices
+        },
+        "daily_operation_rate": {
+            "total_devices": len(enabled_addrs),
+            "data": daily_operation_rates(snapshot, enabled_addrs, operation_dates) if enabled_addrs else []
+        },
+        "daily_green_apples": {
+            "data": daily_green_apples(snapshot, enabled_addrs, location, apple_dates) if enabled_addrs else []
+        },
+    }
+    return json_response(request, payload)
 
-    # 6:00～翌6:00の時間範囲
-    start_time = jst.localize(datetime.combine(target_date, datetime.min.time()) + timedelta(hours=6))
-    end_time = start_time + timedelta(hours=24)
 
-    hourly_apples = []
-    current_hour = start_time
+# ========== シフト比較 API ==========
 
-    while current_hour < end_time and current_hour <= datetime.now(jst):
-        next_hour = current_hour + timedelta(hours=1)
+def _shift_groups(db, group_by: str, location: Optional[str]):
+    """シフト比較の系列（キー → 属性・デバイス一覧）"""
+    registrations = device_registry.snapshot(db).registrations(location, enabled_only=True, by_index=True)
 
-        # この時間帯の各ステータスの合計時間（分）
-        total_running_minutes = 0
-        total_stop_yellow_minutes = 0
-        total_stop_red_minutes = 0
-        total_idle_minutes = 0
+    if group_by == "device":
+        return {
+            reg.device_addr: ({"device_addr": reg.device_addr, "device_name": reg.name, "location": reg.location}, [reg.device_addr])
+            for reg in registrations
+        }
+    groups = {"": ({"location": ""}, [reg.device_addr for reg in registrations])} if not location else {}
+    for reg in registrations:
+        if reg.location:
+            groups.setdefault(reg.location, ({"location": reg.location}, []))[1].append(reg.device_addr)
+    return groups
 
-        for device_addr in device_addrs:
-            # この時間帯の履歴を取得
-            histories = db.query(DeviceHistory).filter(
-                DeviceHistory.device_addr == device_addr,
-                DeviceHistory.timestamp >= current_hour.astimezone(utc).replace(tzinfo=None),
-                DeviceHistory.timestamp < next_hour.astimezone(utc).replace(tzinfo=None)
-            ).order_by(DeviceHistory.timestamp).all()
 
-            # 直前の状態も取得
-            prev_history = db.query(DeviceHistory).filter(
-                DeviceHistory.device_addr == device_addr,
-                DeviceHistory.timestamp < current_hour.astimezone(utc).replace(tzinfo=None)
-            ).order_by(DeviceHistory.timestamp.desc()).first()
+@app.get("/api/shifts/compare")
+async def get_shift_comparison(
+    date: Optional[str] = Query(default=None, description="YYYY-MM-DD形式の営業日（省略時は今日）"),
+    group_by: str = Query(default="device", description="集計単位（device / location）"),
+    location: Optional[str] = Query(default=None, description="絞り込む設置場所（省略時は全体）"),
+    db: Session = Depends(get_db)
+):
+    """日勤と夜勤の比較（シフト別集計テーブルから取得）"""
+    if group_by not in ("device", "location"):
+        raise HTTPException(status_code=400, detail="group_byは device / location のいずれかです")
+    if date:
+        try:
+            target_date = datetime.strptime(date, '%Y-%m-%d').date()
+        except ValueError:
+            raise HTTPException(status_code=400, detail="日付形式が不正です（YYYY-MM-DD）")
+    else:
+        target_date = business_calendar.business_date()
+
+    groups = _shift_groups(db, group_by, location)
+    rows = db.query(ShiftSummary).filter(
+        ShiftSummary.business_date == target_date
+    ).all()
+    rows_by_key = {(row.device_addr, row.shift): row for row in rows}
+
+    data = []
+    for attrs, addrs in groups.values():
+        entry = dict(attrs)
+        for shift in SHIFT_NAMES:
+            entry[shift] = shift_to_dict(merge_rows(
+                rows_by_key[(addr, shift)] for addr in addrs if (addr, shift) in rows_by_key
+            ))
+        entry["operation_rate_diff"] = round(entry["day"]["operation_rate"] - entry["night"]["operation_rate"], 1)
+        data.append(entry)
+
+    return {
+        "date": target_date.isoformat(),
+        "group_by": group_by,
+        "data": data
+    }
+
+
+@app.get("/api/shifts/trend")
+@heavy_endpoint()
+async def get_shift_trend(
+    start_date: str = Query(..., description="開始日（YYYY-MM-DD形式）"),
+    end_date: str = Query(..., description="終了日（YYYY-MM-DD形式）"),
+    device_addr: Optional[str] = Query(default=None, description="絞り込むデバイス（MACアドレス）"),
+    location: Optional[str] = Query(default=None, description="絞り込む設置場所（省略時は全体）"),
+    shift: Optional[str] = Query(default=None, description="シフト（day / night、省略時は両方を時系列順）"),
+    db: Session = Depends(get_db)
+):
+    """シフトごとの推移（前シフト比つき、シフト別集計テーブルから取得）"""
+    try:
+        start_dt = datetime.strptime(start_date, '%Y-%m-%d').date()
+        end_dt = datetime.strptime(end_date, '%Y-%m-%d').date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="日付形式が不正です（YYYY-MM-DD）")
+    if start_dt > end_dt:
+        raise HTTPException(status_code=400, detail="開始日は終了日より前である必要があります")
+    if shift is not None and shift not in SHIFT_NAMES:
+        raise HTTPException(status_code=400, detail="shiftは day / night のいずれかです")
 
-            # 時間帯の終了時刻
-            period_end = min(next_hour, datetime.now(jst)).astimezone(utc).replace(tzinfo=None)
+    if device_addr:
+        device_addrs = [device_addr.upper()]
+    else:
+        _, device_addrs = _shift_groups(db, "location", location).get(location or "", (None, []))
 
-            if not histories and not prev_history:
-                duration_minutes = (period_end - current_hour.astimezone(utc).replace(tzinfo=None)).total_seconds() / 60
-                total_idle_minutes += duration_minutes
+    rows = db.query(ShiftSummary).filter(
+        ShiftSummary.business_date >= start_dt,
+        ShiftSummary.business_date <= end_dt,
+        ShiftSummary.device_addr.in_(device_addrs)
+    ).all()
+    rows_by_shift = {}
+    for row in rows:
+        rows_by_shift.setdefault((row.business_date, row.shift), []).append(row)
+
+    data = []
+    prev_rate = None
+    for bday in business_calendar.days(start_dt, end_dt):
+        for name in SHIFT_NAMES:
+            if shift and name != shift:
                 continue
+            entry = {
+                "date": bday.date.isoformat(),
+                "shift": name,
+                **shift_to_dict(merge_rows(rows_by_shift.get((bday.date, name), [])))
+            }
+            entry["operation_rate_diff"] = round(entry["operation_rate"] - prev_rate, 1) if prev_rate is not None else None
+            prev_rate = entry["operation_rate"]
+            data.append(entry)
 
-            # 時間帯開始時点の状態を決定
-            if histories:
-                all_records = histories[:]
-            else:
-                all_records = []
-
-            if prev_history:
-                start_status = {
-                    'timestamp': current_hour.astimezone(utc).replace(tzinfo=None),
-                    'green': prev_history.green,
-                    'yellow': prev_history.yellow,
-                    'red': prev_history.red
-                }
-            elif all_records:
-                start_status = {
-                    'timestamp': current_hour.astimezone(utc).replace(tzinfo=None),
-                    'green': all_records[0].green,
-                    'yellow': all_records[0].yellow,
-                    'red': all_records[0].red
-                }
-            else:
-                start_status = {
-                    'timestamp': current_hour.astimezone(utc).replace(tzinfo=None),
-                    'green': False,
-                    'yellow': False,
-                    'red': False
-                }
-
-            # 時間計算用のレコードリスト
-            time_records = [start_status]
-            for h in all_records:
-                time_records.append({
-                    'timestamp': h.timestamp,
-                    'green': h.green,
-                    'yellow': h.yellow,
-                    'red': h.red
-                })
+    return {
+        "start_date": start_dt.isoformat(),
+        "end_date": end_dt.isoformat(),
+        "device_count": len(device_addrs),
+        "data": data
+    }
 
-            # 各レコード間の時間を計算
-            for idx in range(len(time_records)):
-                current_record = time_records[idx]
 
-                if idx < len(time_records) - 1:
-                    next_timestamp = time_records[idx + 1]['timestamp']
-                else:
-                    next_timestamp = period_end
+# ========== 停止イベント分析 API ==========
 
-                duration_minutes = (next_timestamp - current_record['timestamp']).total_seconds() / 60
-                duration_minutes = max(0, duration_minutes)
+def _stop_query_range(start_date: Optional[str], end_date: Optional[str]):
+    """停止分析の対象期間（営業日、省略時は前日）をUTC範囲に変換"""
+    try:
+        default = (business_calendar.business_date() - timedelta(days=1)).isoformat()
+        start_dt = datetime.strptime(start_date or default, '%Y-%m-%d').date()
+        end_dt = datetime.strptime(end_date or start_date or default, '%Y-%m-%d').date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="日付形式が不正です（YYYY-MM-DD）")
+    if start_dt > end_dt:
+        raise HTTPException(status_code=400, detail="開始日は終了日より前である必要があります")
+    return start_dt, end_dt, business_calendar.day(start_dt).span.start_utc, business_calendar.day(end_dt).span.end_utc
 
-                if current_record['green']:
-                    total_running_minutes += duration_minutes
-                elif current_record['yellow']:
-                    total_stop_yellow_minutes += duration_minutes
-                elif current_record['red']:
-                    total_stop_red_minutes += duration_minutes
-                else:
-                    total_idle_minutes += duration_minutes
 
-        # 合計時間
-        total_minutes = total_running_minutes + total_stop_yellow_minutes + total_stop_red_minutes + total_idle_minutes
+@app.get("/api/stops/summary")
+@heavy_endpoint()
+async def get_stop_summary(
+    start_date: Optional[str] = Query(default=None, description="開始日（YYYY-MM-DD、省略時は前日）"),
+    end_date: Optional[str] = Query(default=None, description="終了日（YYYY-MM-DD、省略時は開始日）"),
+    group_by: str = Query(default="device", description="集計単位（device / location）"),
+    location: Optional[str] = Query(default=None, description="絞り込む設置場所（省略時は全体）"),
+    color: Optional[str] = Query(default=None, description="停止色（yellow / red、省略時は両方）"),
+    db: Session = Depends(get_db)
+):
+    """停止回数・MTTR・MTBFを取得（停止イベントテーブルから集計）"""
+    if group_by not in ("device", "location"):
+        raise HTTPException(status_code=400, detail="group_byは device / location のいずれかです")
+    start_dt, end_dt, start_utc, end_utc = _stop_query_range(start_date, end_date)
 
-        # 稼働率を計算
-        if total_minutes > 0:
-            running_percent = round(total_running_minutes / total_minutes * 100, 1)
-        else:
-            running_percent = 0
-
-        # GreenApple獲得数を計算
-        green_apples = 0
-        if running_percent >= 50:
-            green_apples = 5
-        elif running_percent >= 40:
-            green_apples = 3
-        elif running_percent >= 35:
-            green_apples = 2
-        elif running_percent > 30:
-            green_apples = 1
-
-        hourly_apples.append({
-            "hour": current_hour.strftime('%H:00'),
-            "running_percent": running_percent,
-            "apples": green_apples
-        })
+    registrations = device_registry.snapshot(db).registrations(location, enabled_only=True, by_index=True)
+
+    stops = query_stops(db, [reg.device_addr for reg in registrations], start_utc, end_utc, color).all()
+    stops_by_addr = {}
+    for stop in stops:
+        stops_by_addr.setdefault(stop.device_addr, []).append(stop)
+
+    groups = []
+    if group_by == "device":
+        for reg in registrations:
+            groups.append({
+                "device_addr": reg.device_addr,
+                "device_name": reg.name,
+                "location": reg.location,
+                **summarize_stops(stops_by_addr.get(reg.device_addr, []))
+            })
+    else:
+        by_location = {}
+        for reg in registrations:
+            by_location.setdefault(reg.location or "", []).extend(stops_by_addr.get(reg.device_addr, []))
+        for loc in sorted(by_location):
+            groups.append({"location": loc, **summarize_stops(by_location[loc])})
+
+    return {
+        "start_date": start_dt.isoformat(),
+        "end_date": end_dt.isoformat(),
+        "group_by": group_by,
+        "total": summarize_stops(stops),
+        "data": groups
+    }
+
+
+@app.get("/api/stops/longest")
+@heavy_endpoint()
+async def get_longest_stops(
+    start_date: Optional[str] = Query(default=None, description="開始日（YYYY-MM-DD、省略時は前日）"),
+    end_date: Optional[str] = Query(default=None, description="終了日（YYYY-MM-DD、省略時は開始日）"),
+    device_addr: Optional[str] = Query(default=None, description="絞り込むデバイス（MACアドレス）"),
+    location: Optional[str] = Query(default=None, description="絞り込む設置場所（省略時は全体）"),
+    color: Optional[str] = Query(default=None, description="停止色（yellow / red、省略時は両方）"),
+    limit: int = Query(default=10, ge=1, le=500, description="取得件数"),
+    db: Session = Depends(get_db)
+):
+    """停止時間の長い順に停止イベントを取得（終了済みの停止のみ）"""
+    start_dt, end_dt, start_utc, end_utc = _stop_query_range(start_date, end_date)
+
+    registrations = device_registry.snapshot(db).registrations()
+    names = {reg.device_addr: reg.name for reg in registrations}
+    if device_addr:
+        device_addrs = [device_addr.upper()]
+    elif location:
+        device_addrs = [reg.device_addr for reg in registrations if reg.location == location]
+    else:
+        device_addrs = [reg.device_addr for reg in registrations]
+
+    stops = query_stops(db, device_addrs, start_utc, end_utc, color).filter(
+        StopEvent.duration_minutes != None
+    ).order_by(StopEvent.duration_minutes.desc()).limit(limit).all()
+
+    return {
+        "start_date": start_dt.isoformat(),
+        "end_date": end_dt.isoformat(),
+        "data": [
+            {**stop_to_dict(stop), "device_name": names.get(stop.device_addr, stop.device_addr)}
+            for stop in stops
+        ]
+    }
 
-        current_hour = next_hour
+
+@app.get("/api/overall/hourly-green-apples")
+@past_day_cached()
+@heavy_endpoint()
+async def get_hourly_green_apples(
+    request: Request,
+    date: str = Query(..., description="YYYY-MM-DD形式の日付"),
+    db: Session = Depends(get_db)
+):
+    """特定の日の時間帯別GreenApple獲得数を取得"""
+    # 日付処理
+    target_date = datetime.strptime(date, '%Y-%m-%d').date()
+
+    # 6:00～翌6:00の時間範囲（全デバイスの履歴を1回だけ読み込んで時間帯別に集計）
+    snapshot = DashboardSnapshot(db, target_date)
+    device_addrs = snapshot.device_addrs()
+    if not device_addrs:
+        return {"data": []}
 
     return {
         "date": date,
-        "data": hourly_apples
+        "data": hourly_green_apples(snapshot, device_addrs)
     }
 
 
 @app.get("/api/devices/{device_addr}/hourly-operation-rate")
+@past_day_cached()
+@heavy_endpoint()
 async def get_device_hourly_operation_rate(
+    request: Request,
     device_addr: str,
     date: str = Query(..., description="YYYY-MM-DD形式の日付"),
     db: Session = Depends(get_db)
@@ -2057,131 +1895,16 @@ async def get_device_hourly_operation_rate(
     """設備の時間帯別稼働率を取得（積上げ棒グラフ用）"""
     device_addr = device_addr.upper()
 
-    jst = pytz.timezone('Asia/Tokyo')
-    utc = pytz.UTC
-
     # 日付処理
     try:
         target_date = datetime.strptime(date, '%Y-%m-%d').date()
     except ValueError:
         raise HTTPException(status_code=400, detail="日付形式が不正です（YYYY-MM-DD）")
 
-    # 6:00～翌6:00の時間範囲を設定
-    start_time = jst.localize(datetime.combine(target_date, datetime.min.time()) + timedelta(hours=6))
-    end_time = start_time + timedelta(hours=24)
-
-    hourly_data = []
-    current_hour = start_time
-
-    while current_hour < end_time and current_hour <= datetime.now(jst):
-        next_hour = current_hour + timedelta(hours=1)
-
-        # この時間帯の稼働データを取得
-        total_running_minutes = 0
-        total_stop_yellow_minutes = 0
-        total_stop_red_minutes = 0
-        total_idle_minutes = 0
-
-        # この時間帯の履歴を取得
-        histories = db.query(DeviceHistory).filter(
-            DeviceHistory.device_addr == device_addr,
-            DeviceHistory.timestamp >= current_hour.astimezone(utc).replace(tzinfo=None),
-            DeviceHistory.timestamp < next_hour.astimezone(utc).replace(tzinfo=None)
-        ).order_by(DeviceHistory.timestamp).all()
-
-        # 直前の状態も取得
-        prev_history = db.query(DeviceHistory).filter(
-            DeviceHistory.device_addr == device_addr,
-            DeviceHistory.timestamp < current_hour.astimezone(utc).replace(tzinfo=None)
-        ).order_by(DeviceHistory.timestamp.desc()).first()
-
-        # 時間帯の終了時刻
-        period_end = min(next_hour, datetime.now(jst)).astimezone(utc).replace(tzinfo=None)
-
-        if not histories and not prev_history:
-            duration_minutes = (period_end - current_hour.astimezone(utc).replace(tzinfo=None)).total_seconds() / 60
-            total_idle_minutes += duration_minutes
-        else:
-            # 時間帯開始時点の状態を決定
-            if histories:
-                all_records = histories[:]
-            else:
-                all_records = []
-
-            if prev_history:
-                start_status = {
-                    'timestamp': current_hour.astimezone(utc).replace(tzinfo=None),
-                    'green': prev_history.green,
-                    'yellow': prev_history.yellow,
-                    'red': prev_history.red
-                }
-            elif all_records:
-                start_status = {
-                    'timestamp': current_hour.astimezone(utc).replace(tzinfo=None),
-                    'green': all_records[0].green,
-                    'yellow': all_records[0].yellow,
-                    'red': all_records[0].red
-                }
-            else:
-                start_status = {
-                    'timestamp': current_hour.astimezone(utc).replace(tzinfo=None),
-                    'green': False,
-                    'yellow': False,
-                    'red': False
-                }
-
-            # 時間計算用のレコードリスト
-            time_records = [start_status]
-            for h in all_records:
-                time_records.append({
-                    'timestamp': h.timestamp,
-                    'green': h.green,
-                    'yellow': h.yellow,
-                    'red': h.red
-                })
-
-            # 各レコード間の時間を計算
-            for idx in range(len(time_records)):
-                current_record = time_records[idx]
-
-                if idx < len(time_records) - 1:
-                    next_timestamp = time_records[idx + 1]['timestamp']
-                else:
-                    next_timestamp = period_end
-
-                duration_minutes = (next_timestamp - current_record['timestamp']).total_seconds() / 60
-                duration_minutes = max(0, duration_minutes)
-
-                if current_record['green']:
-                    total_running_minutes += duration_minutes
-                elif current_record['yellow']:
-                    total_stop_yellow_minutes += duration_minutes
-                elif current_record['red']:
-                    total_stop_red_minutes += duration_minutes
-                else:
-                    total_idle_minutes += duration_minutes
-
-        # 合計時間
-        total_minutes = total_running_minutes + total_stop_yellow_minutes + total_stop_red_minutes + total_idle_minutes
-
-        # 割合を計算
-        if total_minutes > 0:
-            running_percent = round(total_running_minutes / total_minutes * 100, 1)
-            stop_yellow_percent = round(total_stop_yellow_minutes / total_minutes * 100, 1)
-            stop_red_percent = round(total_stop_red_minutes / total_minutes * 100, 1)
-            idle_percent = round(total_idle_minutes / total_minutes * 100, 1)
-        else:
-            running_percent = stop_yellow_percent = stop_red_percent = idle_percent = 0
-
-        hourly_data.append({
-            "hour": current_hour.strftime('%H:00'),
-            "running": running_percent,
-            "stop_yellow": stop_yellow_percent,
-            "stop_red": stop_red_percent,
-            "idle": idle_percent
-        })
-
-        current_hour = next_hour
+    # 6:00～翌6:00の時間範囲（営業日分の履歴を1回だけ読み込んで時間帯別に集計）
+    bday = business_calendar.day(target_date)
+    trace = load_day_traces(db, [device_addr], bday)[device_addr]
+    hourly_data = device_hourly_operation_rate(trace, bday, datetime.utcnow())
 
     return {
         "device_addr": device_addr,
@@ -1,7 +1,7 @@
 """
 データベースモデル定義
 """
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, Date, UniqueConstraint
+from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, Date, UniqueConstraint, Index
 from datetime import datetime
 from .database import Base
 
@@ -27,6 +27,11 @@ class DeviceStatus(Base):
 class DeviceHistory(Base):
     """デバイスの履歴データ"""
     __tablename__ = "device_history"
+    __table_args__ = (
+        # 履歴API・データ受信ログのキーセットページング用（id は rowid なので末尾に含まれる）
+        Index('ix_device_history_device_id_ts', 'device_id', 'timestamp'),
+        Index('ix_device_history_addr_ts', 'device_addr', 'timestamp'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     device_id = Column(Integer, index=True)  # デバイスID
@@ -99,3 +104,92 @@ class DailyGreenAppleCount(Base):
     location = Column(String, default="", index=True)  # ""=全体, それ以外=設置場所別
     apple_count = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class PeriodOperationRate(Base):
+    """期間別（ISO週/月/年）稼働率のロールアップ（日次集計から生成、日次締め時に更新）"""
+    __tablename__ = "period_operation_rate"
+    __table_args__ = (
+        UniqueConstraint('period_type', 'device_addr', 'period_start', name='uq_period_op_type_device_start'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    period_type = Column(String, nullable=False)            # "week" / "month" / "year"
+    period_start = Column(Date, nullable=False)             # 期間開始日（ISO週は月曜）
+    period_end = Column(Date, nullable=False)               # 期間終了日（両端含む）
+    device_addr = Column(String, nullable=False)
+    running_minutes_regular = Column(Float, default=0.0)
+    window_minutes_regular = Column(Float, default=0.0)
+    running_minutes_overtime = Column(Float, default=0.0)
+    window_minutes_overtime = Column(Float, default=0.0)
+    days = Column(Integer, default=0)                       # 集計済み日数
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class PeriodLocationSummary(Base):
+    """期間別（ISO週/月/年）の設置場所別稼働率・GREEN APPLE収穫量のロールアップ"""
+    __tablename__ = "period_location_summary"
+    __table_args__ = (
+        UniqueConstraint('period_type', 'location', 'period_start', name='uq_period_loc_type_location_start'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    period_type = Column(String, nullable=False)            # "week" / "month" / "year"
+    period_start = Column(Date, nullable=False)
+    period_end = Column(Date, nullable=False)
+    location = Column(String, default="", nullable=False)   # ""=全体, それ以外=設置場所別
+    running_minutes_regular = Column(Float, default=0.0)
+    window_minutes_regular = Column(Float, default=0.0)
+    running_minutes_overtime = Column(Float, default=0.0)
+    window_minutes_overtime = Column(Float, default=0.0)
+    apple_count = Column(Integer, default=0)
+    days = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class StopEvent(Base):
+    """停止イベント（黄/赤ライトの連続区間、状態遷移の受信時に記録）"""
+    __tablename__ = "stop_event"
+    __table_args__ = (
+        Index('ix_stop_event_device_start', 'device_addr', 'start_time'),
+        Index('ix_stop_event_start', 'start_time'),
+        Index('ix_stop_event_duration', 'duration_minutes'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    device_addr = Column(String, nullable=False)
+    color = Column(String, nullable=False)                  # "yellow" / "red"
+    start_time = Column(DateTime, nullable=False)           # 停止開始（UTC）
+    end_time = Column(DateTime, nullable=True)              # 停止終了（UTC、継続中はNULL）
+    duration_minutes = Column(Float, nullable=True)         # 停止時間（分、継続中はNULL）
+    business_date = Column(Date, nullable=False)            # 停止開始時点の営業日
+
+
+class ShiftSummary(Base):
+    """シフト別（日勤/夜勤）の状態別分数・停止回数（シフト終了時に確定、稼働中のシフトは定期更新）"""
+    __tablename__ = "shift_summary"
+    __table_args__ = (
+        UniqueConstraint('device_addr', 'business_date', 'shift', name='uq_shift_device_date_shift'),
+        Index('ix_shift_summary_date_shift', 'business_date', 'shift'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    device_addr = Column(String, nullable=False)
+    business_date = Column(Date, nullable=False)            # 営業日
+    shift = Column(String, nullable=False)                  # "day"（6:00-18:00） / "night"（18:00-翌6:00）
+    running_minutes = Column(Float, default=0.0)
+    stop_yellow_minutes = Column(Float, default=0.0)
+    stop_red_minutes = Column(Float, default=0.0)
+    idle_minutes = Column(Float, default=0.0)
+    yellow_stop_count = Column(Integer, default=0)          # シフト内に開始した黄停止の回数
+    red_stop_count = Column(Integer, default=0)             # シフト内に開始した赤停止の回数
+    is_closed = Column(Boolean, default=False)              # シフト終了済み（確定）
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class HistoryRevision(Base):
+    """営業日ごとの履歴変更リビジョン（device_historyのトリガーで更新、レスポンスキャッシュの検証用）"""
+    __tablename__ = "history_revision"
+
+    business_date = Column(Date, primary_key=True)
+    revision = Column(Integer, nullable=False, index=True)  # 全営業日で単調増加する変更番号
@@ -0,0 +1,292 @@
+"""
+リクエストごとのSQL計測（クエリ数・DB時間）とプロファイル
+
+SQLAlchemy のエンジンイベントでSQL文の実行回数と所要時間を数え、
+リクエスト単位で Server-Timing / X-Query-Count ヘッダーに出力する。
+
+- QUERY_ACCOUNTING=1 で全リクエスト、未設定でも X-Query-Accounting: 1 ヘッダー付きのリクエストだけ計測
+- PROFILE_REQUESTS=1 のとき ?profile=1 を付けると cProfile の集計をレスポンスに添付
+  （JSONは {"response": 元のレスポンス, "profile": {...}} に包む、それ以外はテキストの集計のみ返す）
+  ステータスコードと元のヘッダー（ETag・Retry-After など）はそのまま返す。本文を持てない応答（304など）は
+  そのまま返し、集計はログに出力する
+  重い集計API（ワーカースレッドで実行）は profile_worker() でそのスレッドも計測して合算する
+- エンドポイントごとのクエリ数上限（QUERY_BUDGETS）を超えたら警告ログ、
+  QUERY_BUDGET_STRICT=1（検証用）では 500 エラーにして N+1 の混入をすぐに検出する
+  全ルートの上限は tests/test_query_budgets.py で確認する（ルートを追加したら呼び出し例も追加すること）
+"""
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+from urllib.parse import parse_qs
+
+from sqlalchemy import event
+
+from .database import set_query_source, reset_query_source
+
+logger = logging.getLogger(__name__)
+
+# 計測設定（環境変数から取得）
+QUERY_ACCOUNTING = os.getenv("QUERY_ACCOUNTING", "0") == "1"          # 全リクエストを計測
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "0") == "1"          # ?profile=1 を許可
+QUERY_BUDGET_STRICT = os.getenv("QUERY_BUDGET_STRICT", "0") == "1"    # 上限超過を500エラーにする
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "30"))
+
+ACCOUNTING_HEADER = b"x-query-accounting"
+
+# エンドポイント（ルートのパス）ごとのクエリ数上限
+# デバイス数・日数に比例して増えるとN+1なので、デバイス数によらない定数にしておく
+# （登録情報キャッシュが空のときの読み込み1回分を含む。ストリーミングAPIは本文送信中に読むため対象外）
+QUERY_BUDGETS = {
+    "/api/devices": 3,
+    "/api/devices/config": 1,
+    "/api/devices/{device_id}/history": 2,
+    "/api/devices/{device_addr}/timeline": 4,
+    "/api/devices/current-operation-rate": 2,
+    "/api/devices/{device_addr}/current-operation-rate": 2,
+    "/api/devices/{device_addr}/data-logs": 2,
+    "/api/devices/{device_addr}/hourly-operation-rate": 4,
+    "/api/overall/current-status": 3,
+    "/api/overall/hourly-status": 5,
+    "/api/overall/hourly-green-apples": 5,
+    "/api/overall/daily-operation-rate": 4,
+    "/api/overall/daily-green-apples": 4,
+    "/api/overall/period-trend": 2,
+    "/api/dashboard/bootstrap": 8,
+    "/api/shifts/compare": 2,
+    "/api/shifts/trend": 2,
+    "/api/stops/summary": 2,
+    "/api/stops/longest": 2,
+}
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """クエリ数の上限超過（QUERY_BUDGET_STRICT=1 のとき）"""
+
+
+@dataclass
+class QueryStats:
+    """1リクエスト分のSQL計測結果"""
+    count: int = 0
+    db_seconds: float = 0.0
+    started: float = field(default_factory=time.perf_counter)
+
+    @property
+    def total_seconds(self) -> float:
+        return time.perf_counter() - self.started
+
+
+# 計測中のリクエストの集計先（スレッドプールで実行される処理にもコンテキストごと引き継がれる）
+_current_stats: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+
+# プロファイル中のリクエストの計測結果（スレッドごとの cProfile、ワーカースレッドにも引き継がれる）
+_current_profiles: ContextVar[Optional[List[cProfile.Profile]]] = ContextVar("request_profiles", default=None)
+
+# 本文を持てないステータスコード
+NO_BODY_STATUSES = (204, 304)
+
+
+def current_stats() -> Optional[QueryStats]:
+    return _current_stats.get()
+
+
+@contextmanager
+def profile_worker():
+    """プロファイル中のリクエストなら、このスレッドでの実行も計測する（ワーカースレッド用）
+
+    cProfile は有効にしたスレッドしか計測しないため、スレッドごとに計測して
+    リクエストの集計に合算する。
+    """
+    profiles = _current_profiles.get()
+    if profiles is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiles.append(profiler)
+
+
+def install_query_accounting(engine):
+    """エンジンにSQL計測用のイベントを登録（起動時に1回）"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_start"].pop()
+        stats = _current_stats.get()
+        if stats is not None:
+            stats.count += 1
+            stats.db_seconds += time.perf_counter() - started
+
+    @event.listens_for(engine, "handle_error")
+    def _error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get("query_start"):
+            conn.info["query_start"].pop()
+
+
+def timing_headers(stats: QueryStats) -> List[tuple]:
+    """Server-Timing / X-Query-Count ヘッダー"""
+    server_timing = (
+        f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.count} queries", '
+        f'app;dur={stats.total_seconds * 1000:.1f}'
+    )
+    return [
+        (b"server-timing", server_timing.encode()),
+        (b"x-query-count", str(stats.count).encode()),
+    ]
+
+
+def _route_path(scope) -> Optional[str]:
+    route = scope.get("route")
+    return getattr(route, "path", None)
+
+
+def _request_source(scope) -> Callable[[], str]:
+    """遅いSQLの記録用の呼び出し元（ルートはルーティング後に scope に入るため、記録時に解決する）"""
+    def source():
+        return f"{scope.get('method')} {_route_path(scope) or scope.get('path')}"
+    return source
+
+
+def _check_budget(scope, stats: QueryStats):
+    path = _route_path(scope)
+    budget = QUERY_BUDGETS.get(path)
+    if budget is None or stats.count <= budget:
+        return
+    message = f"クエリ数が上限を超えました: {scope.get('method')} {path} {stats.count}件（上限 {budget}件）"
+    if QUERY_BUDGET_STRICT:
+        raise QueryBudgetExceeded(message)
+    logger.warning(message)
+
+
+def _profile_summary(profiles: List[cProfile.Profile]) -> str:
+    buffer = io.StringIO()
+    stats = pstats.Stats(profiles[0], stream=buffer)
+    for profiler in profiles[1:]:
+        stats.add(profiler)
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+    return buffer.getvalue()
+
+
+class QueryAccountingMiddleware:
+    """SQL計測・プロファイル用のASGIミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        source_token = set_query_source(_request_source(scope))
+        try:
+            await self._dispatch(scope, receive, send)
+        finally:
+            reset_query_source(source_token)
+
+    async def _dispatch(self, scope, receive, send):
+        headers = dict(scope.get("headers") or [])
+        profile = PROFILE_REQUESTS and parse_qs(scope.get("query_string", b"").decode()).get("profile") == ["1"]
+        if not (QUERY_ACCOUNTING or QUERY_BUDGET_STRICT or profile or headers.get(ACCOUNTING_HEADER) == b"1"):
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats()
+        token = _current_stats.set(stats)
+        try:
+            if profile:
+                await self._profiled(scope, receive, send, stats)
+            else:
+                await self._accounted(scope, receive, send, stats)
+        finally:
+            _current_stats.reset(token)
+
+    async def _accounted(self, scope, receive, send, stats: QueryStats):
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                # ストリーミングの場合はヘッダー送信時点までの計測値
+                _check_budget(scope, stats)
+                message = {**message, "headers": list(message.get("headers", [])) + timing_headers(stats)}
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
+
+    async def _profiled(self, scope, receive, send, stats: QueryStats):
+        # 集計を添付できるよう圧縮させない
+        scope = {**scope, "headers": [(k, v) for k, v in scope.get("headers", []) if k != b"accept-encoding"]}
+        start_message = {}
+        body = bytearray()
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                start_message.update(message)
+            elif message["type"] == "http.response.body":
+                body.extend(message.get("body", b""))
+
+        profiler = cProfile.Profile()
+        profiles = [profiler]
+        profiles_token = _current_profiles.set(profiles)
+        profiler.enable()
+        try:
+            await self.app(scope, receive, capture)
+        finally:
+            profiler.disable()
+            _current_profiles.reset(profiles_token)
+
+        summary = _profile_summary(profiles)
+        status = start_message.get("status", 500)
+        original_headers = list(start_message.get("headers", []))
+        if status in NO_BODY_STATUSES:
+            # 本文を付けられないため元の応答を返し、集計はログに出す
+            logger.info(f"プロファイル: {scope.get('method')} {scope.get('path')} {status}\n{summary}")
+            await send({**start_message, "headers": original_headers + timing_headers(stats)})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        response_headers = dict(original_headers)
+        if response_headers.get(b"content-type", b"").startswith(b"application/json"):
+            try:
+                original = json.loads(bytes(body)) if body else None
+            except ValueError:
+                original = None
+            content = json.dumps({
+                "response": original,
+                "profile": {
+                    "status_code": status,
+                    "query_count": stats.count,
+                    "db_ms": round(stats.db_seconds * 1000, 1),
+                    "total_ms": round(stats.total_seconds * 1000, 1),
+                    "stats": summary.splitlines(),
+                },
+            }, ensure_ascii=False).encode("utf-8")
+            content_type = b"application/json"
+        else:
+            content = summary.encode("utf-8")
+            content_type = b"text/plain; charset=utf-8"
+
+        # 元のヘッダー（ETag・Retry-After など）は残し、本文に関するものだけ差し替える
+        passthrough = [(k, v) for k, v in original_headers if k.lower() not in (b"content-type", b"content-length")]
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": passthrough + [(b"content-type", content_type), (b"content-length", str(len(content)).encode())]
+                       + timing_headers(stats),
+        })
+        await send({"type": "http.response.body", "body": content})
@@ -0,0 +1,341 @@
+"""
+レスポンスキャッシュ（確定済み営業日 / 当日の短期キャッシュ）
+
+過去の営業日（締め済み）のタイムライン・時間帯別集計は、履歴が書き換えられない限り変わらない。
+計算結果をJSONのバイト列のまま保持し、強いETagと Cache-Control を付けて返す。
+
+- メモリ上のLRU（件数上限あり）、RESPONSE_CACHE_DIR を設定した場合はディスクにも保存
+- 有効性は history_revision テーブル（device_historyのトリガーで更新）で判定する
+  対象日以前のいずれかの営業日の履歴が変わればキャッシュは無効（直前状態の持ち越しがあるため）
+- バックフィル等の別プロセスからの書き込みもトリガー経由で検知できる
+
+当日の全体集計（ダッシュボードが毎分ポーリングする）は LIVE_CACHE_TTL_SECONDS 秒だけ共有し、
+同時に届いた同一リクエストは1回の計算結果を待ち合わせる（single-flight）。
+"""
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime, date as ddate
+from typing import Dict, Optional, Tuple
+
+from fastapi import Response
+from sqlalchemy import func, text
+
+from .admission import ClientDisconnected
+from .business_calendar import business_calendar
+from .models import DeviceRegistration, HistoryRevision
+from .responses import json_bytes
+
+logger = logging.getLogger(__name__)
+
+# キャッシュ設定（環境変数から取得）
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "512"))
+RESPONSE_CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", "")  # 空ならディスク保存しない
+
+LIVE_CACHE_TTL_SECONDS = float(os.getenv("LIVE_CACHE_TTL_SECONDS", "20"))  # 0でキャッシュ無効
+
+# 締め済みの日でもバックフィルで変わり得るため、ブラウザには毎回ETagで再検証させる
+CACHE_CONTROL = "no-cache"
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    """キャッシュ済みレスポンス（検証キー・ETag・JSON本体）"""
+    validator: str
+    etag: str
+    body: bytes
+
+
+class PastDayCache:
+    """確定済み営業日のレスポンスを保持するLRUキャッシュ（ディスク保存はオプション）"""
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES, cache_dir: str = RESPONSE_CACHE_DIR):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir or None
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode()).hexdigest() + ".json")
+
+    def get(self, key: str, validator: str) -> Optional[CachedResponse]:
+        """有効なエントリを取得（検証キーが変わっていれば破棄）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.validator == validator:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                del self._entries[key]
+
+        entry = self._load(key, validator)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._store(key, entry)
+        return entry
+
+    def put(self, key: str, validator: str, payload) -> CachedResponse:
+        """レスポンスをJSONに変換して保存"""
+        body = json_bytes(payload)
+        entry = CachedResponse(validator, '"' + hashlib.sha256(body).hexdigest()[:32] + '"', body)
+        with self._lock:
+            self._store(key, entry)
+        self._save(key, entry)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _store(self, key: str, entry: CachedResponse):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load(self, key: str, validator: str) -> Optional[CachedResponse]:
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                header, body = f.read().split(b"\n", 1)
+            meta = json.loads(header)
+        except (OSError, ValueError):
+            return None
+        if meta.get("key") != key or meta.get("validator") != validator:
+            return None
+        return CachedResponse(validator, meta["etag"], body)
+
+    def _save(self, key: str, entry: CachedResponse):
+        if not self.cache_dir:
+            return
+        path = self._path(key)
+        tmp_path = path + ".tmp"
+        try:
+            header = json.dumps({"key": key, "validator": entry.validator, "etag": entry.etag})
+            with open(tmp_path, "wb") as f:
+                f.write(header.encode("utf-8") + b"\n" + entry.body)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"レスポンスキャッシュ保存エラー: {e}")
+
+
+# アプリ全体で共有するキャッシュ
+past_day_cache = PastDayCache()
+
+
+# ---------- 履歴リビジョン ----------
+
+def _business_date_sql(column: str) -> str:
+    """naive UTC のタイムスタンプ列から営業日を求めるSQL式（固定オフセット前提）"""
+    offset = business_calendar.tz.utcoffset(datetime(2000, 1, 1))
+    offset_minutes = int(offset.total_seconds() // 60)
+    day_start_minutes = business_calendar.day_start.hour * 60 + business_calendar.day_start.minute
+    return f"date({column}, '{offset_minutes:+d} minutes', '{-day_start_minutes:+d} minutes')"
+
+
+def _bump_sql(column: str) -> str:
+    return (
+        "INSERT INTO history_revision (business_date, revision) "
+        f"VALUES ({_business_date_sql(column)}, "
+        "(SELECT COALESCE(MAX(revision), 0) + 1 FROM history_revision)) "
+        "ON CONFLICT(business_date) DO UPDATE SET revision = excluded.revision;"
+    )
+
+
+def install_history_revision_triggers(engine):
+    """device_history の変更で history_revision を更新するトリガーを作成（起動時に実行）"""
+    statements = [
+        "CREATE TRIGGER IF NOT EXISTS trg_device_history_revision_insert "
+        f"AFTER INSERT ON device_history BEGIN {_bump_sql('NEW.timestamp')} END",
+        "CREATE TRIGGER IF NOT EXISTS trg_device_history_revision_delete "
+        f"AFTER DELETE ON device_history BEGIN {_bump_sql('OLD.timestamp')} END",
+        "CREATE TRIGGER IF NOT EXISTS trg_device_history_revision_update "
+        f"AFTER UPDATE ON device_history BEGIN {_bump_sql('OLD.timestamp')} {_bump_sql('NEW.timestamp')} END",
+    ]
+    with engine.begin() as conn:
+        for statement in statements:
+            conn.execute(text(statement))
+
+
+def cache_validator(db, target_date: ddate) -> str:
+    """対象日のキャッシュ検証キー（対象日以前の履歴リビジョン + デバイス登録状況）"""
+    revision = db.query(func.max(HistoryRevision.revision)).filter(
+        HistoryRevision.business_date <= target_date
+    ).scalar() or 0
+    reg_count, reg_updated = db.query(
+        func.count(DeviceRegistration.id), func.max(DeviceRegistration.updated_at)
+    ).one()
+    return f"{revision}:{reg_count}:{reg_updated.isoformat() if reg_updated else ''}"
+
+
+# ---------- エンドポイント用デコレーター ----------
+
+def _parse_date(value) -> Optional[ddate]:
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        return None
+
+
+def cache_key(path: str, params) -> str:
+    """パスとクエリ (名前, 値) の組（順序を正規化）からキャッシュキーを作成"""
+    return path + "?" + "&".join(f"{k}={v}" for k, v in sorted(params))
+
+
+def _request_key(request) -> str:
+    return cache_key(request.url.path, request.query_params.multi_items())
+
+
+def _etag_matches(request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in [tag.strip() for tag in header.split(",")]
+
+
+def past_day_cached(date_param: str = "date"):
+    """確定済み営業日のリクエストだけをキャッシュするデコレーター
+
+    エンドポイントは request: Request と db: Session を引数に持つこと。
+    日付省略・当日以降・日付不正の場合はそのままエンドポイントを実行する。
+    """
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            request = kwargs["request"]
+            db = kwargs["db"]
+            target_date = _parse_date(kwargs.get(date_param))
+            if target_date is None or target_date >= business_calendar.business_date():
+                return await endpoint(*args, **kwargs)
+
+            key = _request_key(request)
+            validator = cache_validator(db, target_date)
+            entry = past_day_cache.get(key, validator)
+            if entry is None:
+                payload = await endpoint(*args, **kwargs)
+                if isinstance(payload, Response):
+                    return payload
+                entry = past_day_cache.put(key, validator, payload)
+
+            headers = {"ETag": entry.etag, "Cache-Control": CACHE_CONTROL}
+            if _etag_matches(request, entry.etag):
+                return Response(status_code=304, headers=headers)
+            return Response(content=entry.body, media_type="application/json", headers=headers)
+        return wrapper
+    return decorator
+
+
+def warm_past_day(path: str, params, validator: str, payload) -> CachedResponse:
+    """確定済み営業日のレスポンスを事前に格納
+
+    params はリクエストのクエリと同じ (名前, 値) の組、validator は cache_validator() の値。
+    """
+    return past_day_cache.put(cache_key(path, params), validator, payload)
+
+
+# ---------- 当日の短期キャッシュ（single-flight） ----------
+
+class SingleFlightCache:
+    """TTL付きキャッシュ（同一キーの同時計算は1回にまとめる）"""
+
+    def __init__(self, ttl_seconds: float = LIVE_CACHE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._entries: Dict[str, Tuple[float, bytes]] = {}   # キー → (有効期限, JSON本体)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get_or_compute(self, key: str, compute) -> bytes:
+        """有効なキャッシュを返す。計算中なら完了を待ち、なければ compute() を実行"""
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > now:
+            self.hits += 1
+            return entry[1]
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if future.cancelled():
+                    # 計算していたリクエストが切断された場合は引き継いで計算
+                    return await self.get_or_compute(key, compute)
+                raise
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            body = await compute()
+        except (asyncio.CancelledError, ClientDisconnected):
+            future.cancel()
+            raise
+        except Exception as e:
+            # エラーはキャッシュせず、待機中のリクエストにだけ伝える
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+        self._prune(now)
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, body)
+        future.set_result(body)
+        return body
+
+    def clear(self):
+        self._entries.clear()
+
+    def _prune(self, now: float):
+        for key in [k for k, (expires, _) in self._entries.items() if expires <= now]:
+            del self._entries[key]
+
+
+# アプリ全体で共有する当日用キャッシュ
+live_cache = SingleFlightCache()
+
+
+def live_cached(date_param: Optional[str] = None):
+    """当日の集計エンドポイントを短時間共有するデコレーター
+
+    エンドポイントは request: Request を引数に持ち、dictを返すこと（例外はキャッシュしない）。
+    date_param を指定した場合、過去の営業日のリクエストは対象外（past_day_cached に任せる）。
+    """
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(*args, **kwargs):
+            if live_cache.ttl_seconds <= 0:
+                return await endpoint(*args, **kwargs)
+            if date_param:
+                target_date = _parse_date(kwargs.get(date_param))
+                if target_date is not None and target_date < business_calendar.business_date():
+                    return await endpoint(*args, **kwargs)
+
+            async def compute() -> bytes:
+                return json_bytes(await endpoint(*args, **kwargs))
+
+            body = await live_cache.get_or_compute(_request_key(kwargs["request"]), compute)
+            return Response(content=body, media_type="application/json")
+        return wrapper
+    return decorator
@@ -0,0 +1,78 @@
+"""
+JSONレスポンスの生成（直列化と圧縮）
+
+orjson がインストールされていれば高速な直列化を使い、なければ標準の json を使う。
+大きなレスポンスはクライアントが対応していれば brotli（インストール時のみ）または gzip で圧縮して返す。
+"""
+import gzip
+import json
+import os
+
+from fastapi import Request, Response
+
+try:
+    import orjson
+except ImportError:  # オプション: pip install orjson
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # オプション: pip install brotli
+    brotli = None
+
+# 圧縮設定（環境変数から取得）
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))   # これ未満のレスポンスは圧縮しない
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+
+def json_bytes(payload) -> bytes:
+    """FastAPI標準のJSONResponseと同じ形式で直列化（orjson があれば使用）"""
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def accepted_encodings(request: Request) -> set:
+    """Accept-Encoding ヘッダーから受け入れ可能なエンコーディング（q=0は除外）"""
+    encodings = set()
+    for item in request.headers.get("accept-encoding", "").split(","):
+        parts = [p.strip() for p in item.split(";")]
+        if not parts[0]:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            encodings.add(parts[0].lower())
+    return encodings
+
+
+def compress(body: bytes, encodings: set):
+    """受け入れ可能なエンコーディングで圧縮 (本体, Content-Encoding)。圧縮しない場合は None"""
+    if len(body) < COMPRESSION_MIN_SIZE:
+        return body, None
+    if brotli is not None and "br" in encodings:
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+    if "gzip" in encodings:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), "gzip"
+    return body, None
+
+
+def negotiated_response(request: Request, body: bytes, media_type: str = "application/json", headers: dict = None) -> Response:
+    """クライアントの Accept-Encoding に応じて圧縮したレスポンス"""
+    headers = dict(headers or {})
+    headers["Vary"] = "Accept-Encoding"
+    body, encoding = compress(body, accepted_encodings(request))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type=media_type, headers=headers)
+
+
+def json_response(request: Request, payload, headers: dict = None) -> Response:
+    """dictをJSONに変換し、必要に応じて圧縮して返す"""
+    return negotiated_response(request, json_bytes(payload), headers=headers)
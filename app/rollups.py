@@ -0,0 +1,152 @@
+"""
+期間別ロールアップ（ISO週/月/年）
+
+日次集計テーブル（daily_operation_rate / daily_green_apple_count）から
+デバイス別・設置場所別の期間集計を作成する。
+日次締め（毎朝6:00の日次集計）時に、対象日を含む週・月・年を再計算する。
+"""
+import calendar
+from datetime import date as ddate, timedelta
+from typing import Iterable, List, Tuple
+
+from sqlalchemy import func
+
+from .models import (
+    DailyOperationRate, DailyGreenAppleCount, DeviceRegistration,
+    PeriodOperationRate, PeriodLocationSummary,
+)
+
+PERIOD_TYPES = ("week", "month", "year")
+
+
+def period_bounds(period_type: str, d: ddate) -> Tuple[ddate, ddate]:
+    """日付を含む期間の (開始日, 終了日) を取得（両端含む）"""
+    if period_type == "week":
+        start = d - timedelta(days=d.weekday())  # ISO週（月曜始まり）
+        return start, start + timedelta(days=6)
+    if period_type == "month":
+        return d.replace(day=1), d.replace(day=calendar.monthrange(d.year, d.month)[1])
+    if period_type == "year":
+        return ddate(d.year, 1, 1), ddate(d.year, 12, 31)
+    raise ValueError(f"未知の期間種別: {period_type}")
+
+
+def period_label(period_type: str, start: ddate) -> str:
+    """期間の表示ラベル（例: 2026-W03 / 2026-01 / 2026）"""
+    if period_type == "week":
+        iso_year, iso_week, _ = start.isocalendar()
+        return f"{iso_year}-W{iso_week:02d}"
+    if period_type == "month":
+        return start.strftime('%Y-%m')
+    return str(start.year)
+
+
+def recent_period_starts(period_type: str, count: int, until: ddate) -> List[ddate]:
+    """until を含む直近 count 期間の開始日（古い順）"""
+    starts = []
+    start, _ = period_bounds(period_type, until)
+    for _ in range(count):
+        starts.append(start)
+        start, _ = period_bounds(period_type, start - timedelta(days=1))
+    return starts[::-1]
+
+
+def rollup_period(db, period_type: str, start: ddate, end: ddate, location_map: dict):
+    """1期間分のデバイス別・設置場所別ロールアップを再計算（コミットは呼び出し側）"""
+    device_rows = db.query(
+        DailyOperationRate.device_addr,
+        func.sum(DailyOperationRate.running_minutes_regular),
+        func.sum(DailyOperationRate.window_minutes_regular),
+        func.sum(DailyOperationRate.running_minutes_overtime),
+        func.sum(DailyOperationRate.window_minutes_overtime),
+        func.count(DailyOperationRate.id),
+    ).filter(
+        DailyOperationRate.target_date >= start,
+        DailyOperationRate.target_date <= end
+    ).group_by(DailyOperationRate.device_addr).all()
+
+    apple_rows = db.query(
+        DailyGreenAppleCount.location,
+        func.sum(DailyGreenAppleCount.apple_count),
+    ).filter(
+        DailyGreenAppleCount.target_date >= start,
+        DailyGreenAppleCount.target_date <= end
+    ).group_by(DailyGreenAppleCount.location).all()
+
+    # 既存行を置き換える（設置場所の変更で消えたグループを残さないため）
+    db.query(PeriodOperationRate).filter(
+        PeriodOperationRate.period_type == period_type,
+        PeriodOperationRate.period_start == start
+    ).delete(synchronize_session=False)
+    db.query(PeriodLocationSummary).filter(
+        PeriodLocationSummary.period_type == period_type,
+        PeriodLocationSummary.period_start == start
+    ).delete(synchronize_session=False)
+
+    # 設置場所別（""=全体）の合算
+    locations = {}
+
+    def _location(key):
+        if key not in locations:
+            locations[key] = {"run_r": 0.0, "win_r": 0.0, "run_o": 0.0, "win_o": 0.0, "apples": 0, "days": 0}
+        return locations[key]
+
+    for addr, run_r, win_r, run_o, win_o, days in device_rows:
+        db.add(PeriodOperationRate(
+            period_type=period_type,
+            period_start=start,
+            period_end=end,
+            device_addr=addr,
+            running_minutes_regular=run_r or 0.0,
+            window_minutes_regular=win_r or 0.0,
+            running_minutes_overtime=run_o or 0.0,
+            window_minutes_overtime=win_o or 0.0,
+            days=days,
+        ))
+        keys = [""]
+        if location_map.get(addr):
+            keys.append(location_map[addr])
+        for key in keys:
+            loc = _location(key)
+            loc["run_r"] += run_r or 0.0
+            loc["win_r"] += win_r or 0.0
+            loc["run_o"] += run_o or 0.0
+            loc["win_o"] += win_o or 0.0
+            loc["days"] = max(loc["days"], days)
+
+    for key, apples in apple_rows:
+        _location(key or "")["apples"] = int(apples or 0)
+
+    for key, loc in locations.items():
+        db.add(PeriodLocationSummary(
+            period_type=period_type,
+            period_start=start,
+            period_end=end,
+            location=key,
+            running_minutes_regular=loc["run_r"],
+            window_minutes_regular=loc["win_r"],
+            running_minutes_overtime=loc["run_o"],
+            window_minutes_overtime=loc["win_o"],
+            apple_count=loc["apples"],
+            days=loc["days"],
+        ))
+
+
+def rebuild_rollups(db, dates: Iterable[ddate]):
+    """指定日を含む全期間（週/月/年）のロールアップを再計算（コミットは呼び出し側）"""
+    location_map = {
+        reg.device_addr: reg.location or ""
+        for reg in db.query(DeviceRegistration.device_addr, DeviceRegistration.location).all()
+    }
+    periods = set()
+    for d in dates:
+        for period_type in PERIOD_TYPES:
+            periods.add((period_type,) + period_bounds(period_type, d))
+    for period_type, start, end in sorted(periods):
+        rollup_period(db, period_type, start, end, location_map)
+    return len(periods)
+
+
+def rollup_day(db, target_date: ddate):
+    """日次締め時: 対象日を含む週・月・年のロールアップを更新"""
+    return rebuild_rollups(db, [target_date])
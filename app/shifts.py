@@ -0,0 +1,160 @@
+"""
+シフト別（日勤/夜勤）ロールアップ
+
+シフト終了時に状態別分数と停止回数を確定し、稼働中のシフトは定期的に更新する。
+シフト比較APIはこのテーブルだけを読み、生の履歴には戻らない。
+"""
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import func
+
+from .aggregation import load_traces, window_state_minutes
+from .business_calendar import business_calendar
+from .device_registry import device_registry
+from .models import ShiftSummary, StopEvent
+
+SHIFT_NAMES = ("day", "night")
+
+# 未確定のまま終わったシフトを確定し直す範囲（営業日数、サーバー停止などで取りこぼしたシフト）
+SHIFT_CLOSE_LOOKBACK_DAYS = int(os.getenv("SHIFT_CLOSE_LOOKBACK_DAYS", "7"))
+
+
+def current_shift(now_utc: Optional[datetime] = None):
+    """現在のシフト (BusinessDay, シフト名, Window)"""
+    now_utc = now_utc or datetime.utcnow()
+    bday = business_calendar.day(business_calendar.business_date_of_utc(now_utc))
+    for name, window in bday.shifts:
+        if window.start_utc <= now_utc < window.end_utc:
+            return bday, name, window
+    return bday, "night", bday.night_shift
+
+
+def previous_shift(bday, shift_name: str):
+    """直前のシフト (BusinessDay, シフト名, Window)"""
+    if shift_name == "night":
+        return bday, "day", bday.day_shift
+    prev_day = business_calendar.day(bday.date - timedelta(days=1))
+    return prev_day, "night", prev_day.night_shift
+
+
+def refresh_shift(db, bday, shift_name: str, window, now_utc: Optional[datetime] = None) -> int:
+    """1シフト分のロールアップを全デバイス分計算してupsert（コミットは呼び出し側）"""
+    now_utc = now_utc or datetime.utcnow()
+    is_closed = now_utc >= window.end_utc
+    period_end = window.clipped_end_utc(now_utc)
+
+    device_addrs = device_registry.snapshot(db).device_addrs(enabled_only=True)
+    traces = load_traces(db, device_addrs, window.start_utc, window.end_utc)
+
+    # シフト内に開始した停止の回数（デバイス×色）
+    stop_counts = {}
+    for addr, color, count in db.query(
+        StopEvent.device_addr, StopEvent.color, func.count(StopEvent.id)
+    ).filter(
+        StopEvent.device_addr.in_(device_addrs),
+        StopEvent.start_time >= window.start_utc,
+        StopEvent.start_time < window.end_utc
+    ).group_by(StopEvent.device_addr, StopEvent.color).all():
+        stop_counts[(addr, color)] = count
+
+    existing = {
+        row.device_addr: row for row in db.query(ShiftSummary).filter(
+            ShiftSummary.business_date == bday.date,
+            ShiftSummary.shift == shift_name
+        ).all()
+    }
+
+    for addr in device_addrs:
+        minutes = window_state_minutes(traces[addr], window.start_utc, window.end_utc, period_end)
+        row = existing.get(addr)
+        if row is None:
+            row = ShiftSummary(device_addr=addr, business_date=bday.date, shift=shift_name)
+            db.add(row)
+        row.running_minutes = minutes["running"]
+        row.stop_yellow_minutes = minutes["stop_yellow"]
+        row.stop_red_minutes = minutes["stop_red"]
+        row.idle_minutes = minutes["idle"]
+        row.yellow_stop_count = stop_counts.get((addr, "yellow"), 0)
+        row.red_stop_count = stop_counts.get((addr, "red"), 0)
+        row.is_closed = is_closed
+        row.updated_at = now_utc
+    return len(device_addrs)
+
+
+def unclosed_shifts(db, bday, shift_name: str, now_utc: datetime):
+    """終了したのに未確定の行が残っているシフト（直近 SHIFT_CLOSE_LOOKBACK_DAYS 営業日）
+
+    直前のシフトは行が1件もない場合（シフト中ずっとサーバーが止まっていた）も含める。
+    """
+    since = bday.date - timedelta(days=SHIFT_CLOSE_LOOKBACK_DAYS)
+    keys = set(db.query(ShiftSummary.business_date, ShiftSummary.shift).filter(
+        ShiftSummary.business_date >= since,
+        ShiftSummary.business_date <= bday.date,
+        ShiftSummary.is_closed == False
+    ).distinct().all())
+
+    prev_day, prev_name, _ = previous_shift(bday, shift_name)
+    has_rows = db.query(ShiftSummary.id).filter(
+        ShiftSummary.business_date == prev_day.date,
+        ShiftSummary.shift == prev_name
+    ).first()
+    if has_rows is None:
+        keys.add((prev_day.date, prev_name))
+
+    shifts = []
+    for business_date, name in sorted(keys):
+        day = business_calendar.day(business_date)
+        window = dict(day.shifts)[name]
+        if window.end_utc <= now_utc:
+            shifts.append((day, name, window))
+    return shifts
+
+
+def update_shift_summaries(db, now_utc: Optional[datetime] = None):
+    """終了したのに未確定のシフトを確定し、稼働中のシフトを更新（コミットは呼び出し側）"""
+    now_utc = now_utc or datetime.utcnow()
+    bday, name, window = current_shift(now_utc)
+
+    for closed_day, closed_name, closed_window in unclosed_shifts(db, bday, name, now_utc):
+        refresh_shift(db, closed_day, closed_name, closed_window, now_utc)
+
+    refresh_shift(db, bday, name, window, now_utc)
+
+
+def shift_to_dict(row: Optional[ShiftSummary]) -> dict:
+    """シフト集計行をAPIレスポンス用に変換"""
+    if row is None:
+        return {
+            "running_minutes": 0, "stop_yellow_minutes": 0, "stop_red_minutes": 0, "idle_minutes": 0,
+            "operation_rate": 0, "yellow_stop_count": 0, "red_stop_count": 0, "stop_count": 0, "is_closed": False
+        }
+    total = row.running_minutes + row.stop_yellow_minutes + row.stop_red_minutes + row.idle_minutes
+    return {
+        "running_minutes": round(row.running_minutes, 1),
+        "stop_yellow_minutes": round(row.stop_yellow_minutes, 1),
+        "stop_red_minutes": round(row.stop_red_minutes, 1),
+        "idle_minutes": round(row.idle_minutes, 1),
+        "operation_rate": round(row.running_minutes / total * 100, 1) if total > 0 else 0,
+        "yellow_stop_count": row.yellow_stop_count,
+        "red_stop_count": row.red_stop_count,
+        "stop_count": row.yellow_stop_count + row.red_stop_count,
+        "is_closed": row.is_closed,
+    }
+
+
+def merge_rows(rows) -> Optional[ShiftSummary]:
+    """複数デバイスのシフト集計行を合算（設置場所別・全体用）"""
+    rows = list(rows)
+    if not rows:
+        return None
+    return ShiftSummary(
+        running_minutes=sum(r.running_minutes for r in rows),
+        stop_yellow_minutes=sum(r.stop_yellow_minutes for r in rows),
+        stop_red_minutes=sum(r.stop_red_minutes for r in rows),
+        idle_minutes=sum(r.idle_minutes for r in rows),
+        yellow_stop_count=sum(r.yellow_stop_count for r in rows),
+        red_stop_count=sum(r.red_stop_count for r in rows),
+        is_closed=all(r.is_closed for r in rows),
+    )
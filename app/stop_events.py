@@ -0,0 +1,135 @@
+"""
+停止イベント（黄/赤ライトの連続区間）の記録と MTBF / MTTR 集計
+
+状態遷移を受信するたびに stop_event テーブルを更新し、
+保守向けの集計は生の履歴ではなくこのテーブルから行う。
+"""
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from .business_calendar import business_calendar
+from .models import DeviceHistory, StopEvent
+from .utils import get_status_from_lights
+
+
+def stop_color(red: bool, yellow: bool, green: bool) -> Optional[str]:
+    """ライト状態から停止色を取得（停止でなければNone）"""
+    status, color = get_status_from_lights(red, yellow, green)
+    return color if status in ("stop_yellow", "stop_red") else None
+
+
+def _close(stop: StopEvent, end_time: datetime):
+    stop.end_time = end_time
+    stop.duration_minutes = max(0.0, (end_time - stop.start_time).total_seconds() / 60)
+
+
+def record_transition(db, device_addr: str, red: bool, yellow: bool, green: bool, timestamp: datetime):
+    """状態遷移を停止イベントに反映（コミットは呼び出し側）"""
+    color = stop_color(red, yellow, green)
+
+    open_stop = db.query(StopEvent).filter(
+        StopEvent.device_addr == device_addr,
+        StopEvent.end_time == None
+    ).order_by(StopEvent.start_time.desc()).first()
+
+    if open_stop:
+        if open_stop.color == color or timestamp < open_stop.start_time:
+            # 同じ停止が継続中、または継続中の停止より古い遷移（遅れて届いたリセット等）
+            return
+        _close(open_stop, timestamp)
+
+    if color:
+        db.add(StopEvent(
+            device_addr=device_addr,
+            color=color,
+            start_time=timestamp,
+            business_date=business_calendar.business_date_of_utc(timestamp),
+        ))
+
+
+def rebuild_stop_events(db, device_addrs: list) -> int:
+    """履歴から停止イベントを再構築（既存のイベントは置き換え、コミットは呼び出し側）"""
+    db.query(StopEvent).filter(
+        StopEvent.device_addr.in_(device_addrs)
+    ).delete(synchronize_session=False)
+
+    rows = db.query(
+        DeviceHistory.device_addr, DeviceHistory.timestamp,
+        DeviceHistory.red, DeviceHistory.yellow, DeviceHistory.green
+    ).filter(
+        DeviceHistory.device_addr.in_(device_addrs)
+    ).order_by(DeviceHistory.device_addr, DeviceHistory.timestamp, DeviceHistory.id).yield_per(1000)
+
+    count = 0
+    open_stops: Dict[str, StopEvent] = {}
+    for addr, timestamp, red, yellow, green in rows:
+        color = stop_color(red, yellow, green)
+        current = open_stops.get(addr)
+        if current and current.color == color:
+            continue
+        if current:
+            _close(current, timestamp)
+            del open_stops[addr]
+        if color:
+            stop = StopEvent(
+                device_addr=addr,
+                color=color,
+                start_time=timestamp,
+                business_date=business_calendar.business_date_of_utc(timestamp),
+            )
+            db.add(stop)
+            open_stops[addr] = stop
+            count += 1
+    return count
+
+
+def query_stops(db, device_addrs: list, start_utc: datetime, end_utc: datetime, color: Optional[str] = None):
+    """期間内に開始した停止イベントのクエリ（start_timeインデックスを使用）"""
+    query = db.query(StopEvent).filter(
+        StopEvent.device_addr.in_(device_addrs),
+        StopEvent.start_time >= start_utc,
+        StopEvent.start_time < end_utc
+    )
+    if color:
+        query = query.filter(StopEvent.color == color)
+    return query
+
+
+def summarize_stops(stops: List[StopEvent]) -> dict:
+    """停止イベント一覧から件数・MTTR・MTBFを計算
+
+    MTTR: 終了済み停止の平均停止時間（分）
+    MTBF: 停止終了から次の停止開始までの平均間隔（分、同一デバイス内）
+    """
+    closed = [s for s in stops if s.end_time is not None]
+    total_stop_minutes = sum(s.duration_minutes for s in closed)
+
+    intervals = []
+    last_end = {}
+    for stop in sorted(stops, key=lambda s: (s.device_addr, s.start_time)):
+        prev_end = last_end.get(stop.device_addr)
+        if prev_end is not None:
+            intervals.append(max(0.0, (stop.start_time - prev_end).total_seconds() / 60))
+        last_end[stop.device_addr] = stop.end_time
+
+    return {
+        "stop_count": len(stops),
+        "yellow_count": sum(1 for s in stops if s.color == "yellow"),
+        "red_count": sum(1 for s in stops if s.color == "red"),
+        "open_stops": len(stops) - len(closed),
+        "total_stop_minutes": round(total_stop_minutes, 1),
+        "mttr_minutes": round(total_stop_minutes / len(closed), 1) if closed else None,
+        "mtbf_minutes": round(sum(intervals) / len(intervals), 1) if intervals else None,
+    }
+
+
+def stop_to_dict(stop: StopEvent) -> dict:
+    """停止イベントをAPIレスポンス用に変換（時刻はJST）"""
+    return {
+        "device_addr": stop.device_addr,
+        "color": stop.color,
+        "start": business_calendar.to_local(stop.start_time).isoformat(),
+        "end": business_calendar.to_local(stop.end_time).isoformat() if stop.end_time else None,
+        "duration_minutes": round(stop.duration_minutes, 1) if stop.duration_minutes is not None else None,
+        "business_date": stop.business_date.isoformat(),
+    }
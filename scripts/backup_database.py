@@ -2,7 +2,7 @@
 データベースバックアップスクリプト
 """
 import os
-import shutil
+import sqlite3
 from datetime import datetime
 import pytz
 
@@ -40,8 +40,14 @@ def backup_database():
     print()
 
     try:
-        # コピー実行
-        shutil.copy2(db_file, backup_file)
+        # SQLiteのバックアップAPIでコピー（WALファイル内の未反映分も含めた一貫した状態を保存）
+        src = sqlite3.connect(db_file)
+        dst = sqlite3.connect(backup_file)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
         print(f"✓ バックアップが完了しました")
         print(f"✓ 保存先: {backup_file}")
         print()
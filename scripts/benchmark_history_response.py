@@ -0,0 +1,155 @@
+"""
+履歴APIレスポンスのベンチマーク
+
+一時DBに100台×24時間分の履歴を作成し、全デバイスの
+GET /api/devices/{device_id}/history?hours=24 を取得する時間と転送バイト数を測定する。
+比較用に旧実装（ORMオブジェクト → to_dict() → FastAPI標準のJSONエンコード、無圧縮）を
+ベンチマーク用のルートとして追加して測定する。
+
+本番DB（lighttower.db）には触れない。
+
+使い方:
+  cd kado
+  python scripts/benchmark_history_response.py                       # 100台・60秒間隔
+  python scripts/benchmark_history_response.py --devices 20 --interval 10
+"""
+import sys
+import os
+import argparse
+import logging
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fastapi import Depends
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.database import Base, get_db
+from app.models import DeviceHistory
+from app.main import app
+from app import responses
+
+# (status_code, status_text, red, yellow, green)
+STATES = [
+    ("01", "Running", False, False, True),
+    ("02", "Warning", False, True, False),
+    ("03", "Error", True, False, False),
+    ("00", "Not Working", False, False, False),
+]
+
+
+def seed(session_factory, devices: int, interval: int, now: datetime):
+    """devices台 × 24時間分の履歴を作成（interval秒ごとに1件）"""
+    db = session_factory()
+    rng = random.Random(0)
+    start = now - timedelta(hours=24)
+    count = int(24 * 3600 / interval)
+    for device_id in range(1, devices + 1):
+        addr = f"AA:BB:CC:DD:{device_id // 256:02X}:{device_id % 256:02X}"
+        rows = []
+        for i in range(count):
+            code, text, red, yellow, green = rng.choice(STATES)
+            rows.append({
+                "device_id": device_id, "device_addr": addr, "battery": rng.randint(60, 100),
+                "red": red, "yellow": yellow, "green": green,
+                "status_code": code, "status_text": text,
+                "timestamp": start + timedelta(seconds=i * interval),
+            })
+        db.bulk_insert_mappings(DeviceHistory, rows)
+    db.commit()
+    db.close()
+    return devices * count
+
+
+def add_legacy_route():
+    """旧実装相当のエンドポイント（ORMオブジェクト → to_dict() → FastAPI標準のJSONエンコード）を追加"""
+    @app.get("/_benchmark/legacy-history/{device_id}")
+    async def legacy_history(device_id: int, hours: int = 24, db: Session = Depends(get_db)):
+        since = datetime.utcnow() - timedelta(hours=hours)
+        history = db.query(DeviceHistory).filter(
+            DeviceHistory.device_id == device_id,
+            DeviceHistory.timestamp >= since
+        ).order_by(DeviceHistory.timestamp.desc()).all()
+        return [h.to_dict() for h in history]
+
+
+def dump(client: TestClient, path: str, devices: int, accept_encoding: str):
+    """全デバイスの24時間分を取得 (転送バイト数, 展開後バイト数)"""
+    wire_bytes = 0
+    body_bytes = 0
+    for device_id in range(1, devices + 1):
+        response = client.get(
+            path.format(device_id=device_id), params={"hours": 24},
+            headers={"Accept-Encoding": accept_encoding}
+        )
+        response.raise_for_status()
+        wire_bytes += int(response.headers.get("content-length", len(response.content)))
+        body_bytes += len(response.content)
+    return wire_bytes, body_bytes
+
+
+def timed(func, repeat: int):
+    """repeat回実行して最短時間と結果を返す"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="履歴APIレスポンスのベンチマーク")
+    parser.add_argument("--devices", type=int, default=100, help="デバイス数（デフォルト: 100）")
+    parser.add_argument("--interval", type=int, default=60, help="履歴の記録間隔（秒、デフォルト: 60）")
+    parser.add_argument("--repeat", type=int, default=3, help="各ケースの測定回数（最短時間を採用）")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}", connect_args={"check_same_thread": False})
+        Base.metadata.create_all(bind=engine)
+        session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+        now = datetime.utcnow()
+        total_rows = seed(session_factory, args.devices, args.interval, now)
+        print(f"履歴 {total_rows:,} 件（{args.devices}台 × 24時間、{args.interval}秒間隔）")
+        print(f"orjson: {'あり' if responses.orjson else 'なし'} / brotli: {'あり' if responses.brotli else 'なし'}")
+        print()
+
+        def override_get_db():
+            db = session_factory()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app.dependency_overrides[get_db] = override_get_db
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+        # startup イベント（MQTT・スケジューラー）は実行しない
+        client = TestClient(app)
+
+        add_legacy_route()
+        cases = [("旧実装（ORM + 標準JSON、無圧縮）", "/_benchmark/legacy-history/{device_id}", "identity")]
+        for encoding in ["identity", "gzip", "br"]:
+            if encoding == "br" and responses.brotli is None:
+                continue
+            cases.append((f"現行（Accept-Encoding: {encoding}）", "/api/devices/{device_id}/history", encoding))
+
+        print(f"{'ケース':<36} {'時間(秒)':>10} {'転送(KB)':>12} {'展開後(KB)':>12}")
+        for label, path, encoding in cases:
+            elapsed, (wire_bytes, body_bytes) = timed(lambda: dump(client, path, args.devices, encoding), args.repeat)
+            print(f"{label:<36} {elapsed:>10.3f} {wire_bytes / 1024:>12,.1f} {body_bytes / 1024:>12,.1f}")
+
+        app.dependency_overrides.clear()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
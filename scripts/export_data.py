@@ -0,0 +1,74 @@
+"""
+データエクスポートスクリプト（CSV / Parquet）
+
+稼働中のDBをロックせずに、受信履歴・日次稼働率・時間帯別集計をファイルに出力する。
+（DB Browser 等でDBファイルを直接開く代わりに使う。Webアプリ起動中でも実行できる）
+
+使い方:
+  cd kado
+  python scripts/export_data.py history --start 2025-01-01 --end 2025-01-31
+  python scripts/export_data.py hourly --start 2025-01-01 --end 2025-01-07 --location 第1工場
+  python scripts/export_data.py daily-operation-rate --start 2025-01-01 --end 2025-03-31 --format parquet
+  python scripts/export_data.py history --start 2025-01-01 --end 2025-01-01 --device AA:BB:CC:DD:EE:FF -o out.csv
+
+データセット: history / daily-operation-rate / hourly
+Parquet出力には pyarrow が必要（pip install pyarrow）
+"""
+import sys
+import os
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.export import DATASETS, EXPORT_FORMATS, ExportFilter, ExportError, validate, iter_export, export_filename
+
+
+def parse_date(value: str):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"日付形式が不正です（YYYY-MM-DD）: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="データエクスポート（CSV / Parquet）")
+    parser.add_argument("dataset", choices=list(DATASETS), help="出力するデータセット")
+    parser.add_argument("--start", type=parse_date, required=True, help="開始営業日（YYYY-MM-DD）")
+    parser.add_argument("--end", type=parse_date, required=True, help="終了営業日（YYYY-MM-DD、この日を含む）")
+    parser.add_argument("--device", action="append", default=[], help="MACアドレス（複数指定可）")
+    parser.add_argument("--location", help="設置場所で絞り込み")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, default="csv", help="出力形式（デフォルト: csv）")
+    parser.add_argument("-o", "--output", help="出力ファイル（省略時は自動命名、'-' で標準出力）")
+    args = parser.parse_args()
+
+    export_filter = ExportFilter(
+        start_date=args.start,
+        end_date=args.end,
+        device_addrs=tuple(addr.upper() for addr in args.device),
+        location=args.location,
+    )
+    try:
+        validate(args.dataset, args.format, export_filter)
+    except ExportError as e:
+        print(f"エラー: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.output == "-":
+        for chunk in iter_export(args.dataset, args.format, export_filter):
+            sys.stdout.buffer.write(chunk)
+        return
+
+    output = args.output or export_filename(args.dataset, args.format, export_filter)
+    tmp_output = output + ".tmp"
+    size = 0
+    with open(tmp_output, "wb") as f:
+        for chunk in iter_export(args.dataset, args.format, export_filter):
+            f.write(chunk)
+            size += len(chunk)
+    os.replace(tmp_output, output)
+    print(f"✓ 出力しました: {output}（{size / 1024 / 1024:.2f} MB）", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+テスト共通のフィクスチャ
+
+一時DBに複数の設置場所・デバイスの数日分の履歴と集計テーブルを作成し、
+アプリの get_db をそのDBに差し替えた TestClient を返す。本番DB（lighttower.db）には触れない。
+"""
+import os
+import sys
+from datetime import timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.business_calendar import business_calendar
+from app.database import Base, get_db
+from app.history_rows import ensure_history_indexes
+from app.main import app
+from app.models import DeviceHistory, DeviceRegistration, DeviceStatus, DailyOperationRate, DailyGreenAppleCount
+from app.query_accounting import install_query_accounting
+from app.response_cache import install_history_revision_triggers
+from app.rollups import rebuild_rollups
+from app.shifts import refresh_shift
+from app.stop_events import rebuild_stop_events
+
+# 設置場所ごとのデバイス数（N+1 ならデバイス数分のSQLが上限を超える）
+LOCATIONS = {"1F": 4, "2F": 3}
+HISTORY_DAYS = 3
+HISTORY_INTERVAL_MINUTES = 20
+
+# (status_code, status_text, red, yellow, green)
+STATES = [
+    ("01", "Running", False, False, True),
+    ("02", "Stop", False, True, False),
+    ("01", "Running", False, False, True),
+    ("03", "Stop", True, False, False),
+    ("00", "Not Working", False, False, False),
+]
+
+
+def device_addr(index: int) -> str:
+    return f"AABBCCDD{index:04X}"
+
+
+def seed(session_factory):
+    """登録情報・現在ステータス・履歴と、日次・週/月/年・停止イベント・シフトの集計を作成"""
+    db = session_factory()
+    now = business_calendar.to_utc(business_calendar.now())
+    today = business_calendar.business_date()
+    dates = [today - timedelta(days=i) for i in range(HISTORY_DAYS, 0, -1)]
+
+    addrs = []
+    index = 0
+    for location, count in LOCATIONS.items():
+        for _ in range(count):
+            index += 1
+            addr = device_addr(index)
+            addrs.append(addr)
+            db.add(DeviceRegistration(device_addr=addr, name=f"設備{index}", location=location, index=index))
+            code, text, red, yellow, green = STATES[index % len(STATES)]
+            db.add(DeviceStatus(
+                device_id=index, device_addr=addr, gateway_id="gw-1", battery=80,
+                red=red, yellow=yellow, green=green, status_code=code, status_text=text, last_update=now,
+            ))
+
+            rows = []
+            timestamp = business_calendar.day(dates[0]).span.start_utc
+            step = 0
+            while timestamp < now:
+                code, text, red, yellow, green = STATES[(index + step) % len(STATES)]
+                rows.append({
+                    "device_id": index, "device_addr": addr, "battery": 80,
+                    "red": red, "yellow": yellow, "green": green,
+                    "status_code": code, "status_text": text, "timestamp": timestamp,
+                })
+                timestamp += timedelta(minutes=HISTORY_INTERVAL_MINUTES)
+                step += 1
+            db.bulk_insert_mappings(DeviceHistory, rows)
+
+    for d in dates:
+        bday = business_calendar.day(d)
+        for addr in addrs:
+            db.add(DailyOperationRate(
+                device_addr=addr, target_date=d,
+                running_minutes_regular=bday.regular.minutes / 2, window_minutes_regular=bday.regular.minutes,
+                running_minutes_overtime=bday.overtime.minutes / 2, window_minutes_overtime=bday.overtime.minutes,
+            ))
+        for location in [""] + list(LOCATIONS):
+            db.add(DailyGreenAppleCount(target_date=d, location=location, apple_count=10))
+    db.commit()
+
+    rebuild_rollups(db, dates)
+    rebuild_stop_events(db, addrs)
+    db.commit()
+    for d in dates:
+        bday = business_calendar.day(d)
+        for shift_name, window in bday.shifts:
+            refresh_shift(db, bday, shift_name, window)
+    db.commit()
+    db.close()
+
+
+@pytest.fixture(scope="session")
+def client(tmp_path_factory):
+    engine = create_engine(
+        f"sqlite:///{tmp_path_factory.mktemp('db') / 'lighttower.db'}",
+        connect_args={"check_same_thread": False}
+    )
+    Base.metadata.create_all(bind=engine)
+    install_history_revision_triggers(engine)
+    ensure_history_indexes(engine)
+    install_query_accounting(engine)
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    seed(session_factory)
+
+    def override_get_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    # startup イベント（MQTT・スケジューラー）は実行しない
+    yield TestClient(app)
+    app.dependency_overrides.clear()
+    engine.dispose()
@@ -0,0 +1,50 @@
+"""
+?profile=1（PROFILE_REQUESTS=1）のテスト
+
+一時DB（conftest.py）に対して ?profile=1 付きで各APIを呼び、
+集計に実行したコードが含まれること・元のステータスコードとヘッダーが残ることを確認する。
+"""
+from datetime import timedelta
+
+import pytest
+
+from app import query_accounting
+from app.business_calendar import business_calendar
+
+from conftest import HISTORY_DAYS, device_addr
+
+
+@pytest.fixture
+def profiling(monkeypatch):
+    monkeypatch.setattr(query_accounting, "PROFILE_REQUESTS", True)
+
+
+def test_error_status_is_kept(client, profiling):
+    response = client.get(f"/api/devices/{device_addr(1)}/timeline?date=bad&profile=1")
+    assert response.status_code == 400
+    assert response.json()["profile"]["status_code"] == 400
+
+
+def test_original_headers_are_kept(client, profiling):
+    yesterday = (business_calendar.business_date() - timedelta(days=1)).isoformat()
+    url = f"/api/devices/{device_addr(2)}/timeline?date={yesterday}"
+    etag = client.get(url).headers["ETag"]
+
+    response = client.get(url + "&profile=1")
+    assert response.status_code == 200
+    assert response.headers["ETag"] == etag
+    assert "profile" in response.json()
+
+    response = client.get(url + "&profile=1", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+
+def test_heavy_endpoint_is_profiled_in_its_worker_thread(client, profiling):
+    today = business_calendar.business_date()
+    start = (today - timedelta(days=HISTORY_DAYS)).isoformat()
+    response = client.get(f"/api/overall/daily-operation-rate?start_date={start}&end_date={today}&profile=1")
+    assert response.status_code == 200
+    stats = "\n".join(response.json()["profile"]["stats"])
+    assert "get_overall_daily_operation_rate" in stats
+    assert "daily_operation_rates" in stats
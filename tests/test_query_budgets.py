@@ -0,0 +1,62 @@
+"""
+エンドポイントごとのクエリ数上限（QUERY_BUDGETS）のテスト
+
+一時DB（conftest.py）に対して X-Query-Accounting: 1 を付けて各APIを呼び、X-Query-Count が上限以内であることを確認する。
+デバイス数・日数に比例してSQLが増える（N+1）変更はここで失敗する。
+
+使い方:
+  cd kado
+  python -m pytest tests/test_query_budgets.py    # pytest と httpx（TestClient）が必要
+"""
+from datetime import timedelta
+
+import pytest
+
+from app.business_calendar import business_calendar
+from app.main import app
+from app.query_accounting import QUERY_BUDGETS
+
+from conftest import HISTORY_DAYS, device_addr
+
+
+def sample_urls() -> dict:
+    """QUERY_BUDGETS のルートごとの呼び出し例"""
+    today = business_calendar.business_date()
+    yesterday = (today - timedelta(days=1)).isoformat()
+    start = (today - timedelta(days=HISTORY_DAYS)).isoformat()
+    addr = device_addr(1)
+    return {
+        "/api/devices": "/api/devices",
+        "/api/devices/config": "/api/devices/config",
+        "/api/devices/{device_id}/history": "/api/devices/1/history?hours=48",
+        "/api/devices/{device_addr}/timeline": f"/api/devices/{addr}/timeline?date={yesterday}",
+        "/api/devices/current-operation-rate": "/api/devices/current-operation-rate",
+        "/api/devices/{device_addr}/current-operation-rate": f"/api/devices/{addr}/current-operation-rate",
+        "/api/devices/{device_addr}/data-logs": f"/api/devices/{addr}/data-logs",
+        "/api/devices/{device_addr}/hourly-operation-rate": f"/api/devices/{addr}/hourly-operation-rate?date={yesterday}",
+        "/api/overall/current-status": "/api/overall/current-status",
+        "/api/overall/hourly-status": f"/api/overall/hourly-status?date={yesterday}",
+        "/api/overall/hourly-green-apples": f"/api/overall/hourly-green-apples?date={yesterday}",
+        "/api/overall/daily-operation-rate": f"/api/overall/daily-operation-rate?start_date={start}&end_date={today}",
+        "/api/overall/daily-green-apples": f"/api/overall/daily-green-apples?start_date={start}&end_date={today}",
+        "/api/overall/period-trend": "/api/overall/period-trend?period=week&count=8",
+        "/api/dashboard/bootstrap": "/api/dashboard/bootstrap",
+        "/api/shifts/compare": f"/api/shifts/compare?date={yesterday}",
+        "/api/shifts/trend": f"/api/shifts/trend?start_date={start}&end_date={today}",
+        "/api/stops/summary": f"/api/stops/summary?start_date={start}&end_date={today}",
+        "/api/stops/longest": f"/api/stops/longest?start_date={start}&end_date={today}",
+    }
+
+
+def test_every_budget_has_a_sample_request():
+    routes = {getattr(route, "path", None) for route in app.routes}
+    assert set(sample_urls()) == set(QUERY_BUDGETS)
+    assert set(QUERY_BUDGETS) <= routes
+
+
+@pytest.mark.parametrize("route", sorted(QUERY_BUDGETS))
+def test_query_count_within_budget(client, route):
+    response = client.get(sample_urls()[route], headers={"X-Query-Accounting": "1"})
+    assert response.status_code == 200, response.text
+    count = int(response.headers["X-Query-Count"])
+    assert count <= QUERY_BUDGETS[route], f"{route}: {count}件（上限 {QUERY_BUDGETS[route]}件）"